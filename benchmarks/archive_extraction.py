@@ -0,0 +1,93 @@
+# emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks for extracting DICOM tarballs with many small files
+
+Covers the stages of datalad_hirni.support.annex_helpers._extract_archive,
+that don't need git-annex: streaming extraction and key computation.
+
+Can be run with asv or directly as a script:
+
+    python benchmarks/archive_extraction.py [N_FILES]
+"""
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import timeit
+from io import BytesIO
+
+from datalad_hirni.support.annex_helpers import (
+    _compute_keys,
+    _extract_members,
+)
+
+
+def synthetic_tarball(path, n_files, size=4096, files_per_series=200):
+    """Write a tarball with `n_files` random files of `size` bytes"""
+    with tarfile.open(path, 'w:gz', compresslevel=1) as tar:
+        for i in range(n_files):
+            info = tarfile.TarInfo('session/series{}/{}.dcm'.format(
+                i // files_per_series, i))
+            info.size = size
+            tar.addfile(info, BytesIO(os.urandom(size)))
+
+
+class ArchiveExtractionSuite(object):
+
+    params = [10000, 100000]
+    param_names = ['n_files']
+    timeout = 600
+
+    def setup_cache(self):
+        # Note: asv calls this once; tarballs are reused by all benchmarks
+        tmp = tempfile.mkdtemp(prefix='hirni-bench-')
+        for n in self.params:
+            synthetic_tarball(os.path.join(tmp, '{}.tar.gz'.format(n)), n)
+        return tmp
+
+    def setup(self, tmp, n_files):
+        self.tarball = os.path.join(tmp, '{}.tar.gz'.format(n_files))
+        self.dest = tempfile.mkdtemp(prefix='hirni-bench-extract-')
+        self.paths = _extract_members(self.tarball, self.dest)
+        self.jobs = os.cpu_count() or 1
+
+    def teardown(self, tmp, n_files):
+        shutil.rmtree(self.dest)
+
+    def time_extract(self, tmp, n_files):
+        dest = tempfile.mkdtemp(prefix='hirni-bench-extract-')
+        try:
+            _extract_members(self.tarball, dest)
+        finally:
+            shutil.rmtree(dest)
+
+    def time_compute_keys_serial(self, tmp, n_files):
+        _compute_keys(self.dest, self.paths, 'MD5E', jobs=1)
+
+    def time_compute_keys_parallel(self, tmp, n_files):
+        _compute_keys(self.dest, self.paths, 'MD5E', jobs=self.jobs)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    suite = ArchiveExtractionSuite()
+    suite.params = [n]
+    tmp = suite.setup_cache()
+    try:
+        suite.setup(tmp, n)
+        for name in ('time_extract', 'time_compute_keys_serial',
+                     'time_compute_keys_parallel'):
+            t = min(timeit.repeat(lambda: getattr(suite, name)(tmp, n),
+                                  number=1, repeat=3))
+            print("{:<40} {:>8} files: {:.3f}s".format(name, n, t))
+        suite.teardown(tmp, n)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,71 @@
+# emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks for dicom2spec's default rules
+
+Can be run with asv or directly as a script:
+
+    python benchmarks/default_rules.py [N_SERIES]
+"""
+
+import sys
+import timeit
+
+from datalad_hirni.support.default_rules import DefaultRules
+
+
+_protocols = [
+    'func_task-oneback_run-{}',
+    'anat-T1w_{}',
+    'DTI_ses-{}_64dir',
+    'fmap_field map_r{}',
+    'VEN_BOLD_{}',
+    'cmrr_mbep2d_bold_ses-pre{}',
+    'Localizer {}',
+]
+
+
+def synthetic_series(n, n_distinct=500):
+    """`n` series with `n_distinct` different protocol names"""
+    return [dict(SeriesInstanceUID='1.2.3.{}'.format(i),
+                 SeriesNumber=i,
+                 SeriesDescription='series {}'.format(i),
+                 ProtocolName=_protocols[i % len(_protocols)].format(
+                     i % n_distinct),
+                 PatientID='02_xyz',
+                 StationName='AWP66017',
+                 InstitutionName='Neurologie',
+                 Manufacturer='SIEMENS',
+                 ManufacturerModelName='Prisma')
+            for i in range(n)]
+
+
+class DefaultRulesSuite(object):
+
+    params = [1000, 100000]
+    param_names = ['n_series']
+
+    def setup(self, n_series):
+        self.series = synthetic_series(n_series)
+        self.unique_series = synthetic_series(n_series, n_distinct=n_series)
+
+    def time_default_rules(self, n_series):
+        DefaultRules(self.series)()
+
+    def time_default_rules_unique_protocols(self, n_series):
+        DefaultRules(self.unique_series)()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    suite = DefaultRulesSuite()
+    suite.setup(n)
+    for name in ('time_default_rules', 'time_default_rules_unique_protocols'):
+        t = min(timeit.repeat(lambda: getattr(suite, name)(n),
+                              number=1, repeat=3))
+        print("{:<40} {:>8} series: {:.3f}s".format(name, n, t))
@@ -29,6 +29,30 @@ command_suite = (
             'hirni-import-dcm',
             'hirni_import_dcm',
         ),
+        (
+            'datalad_hirni.commands.import_bulk',
+            'ImportDicomsBulk',
+            'hirni-import-dcm-bulk',
+            'hirni_import_dcm_bulk',
+        ),
+        (
+            'datalad_hirni.commands.aggregate_pending',
+            'AggregatePending',
+            'hirni-aggregate-pending',
+            'hirni_aggregate_pending',
+        ),
+        (
+            'datalad_hirni.commands.ingest',
+            'Ingest',
+            'hirni-ingest',
+            'hirni_ingest',
+        ),
+        (
+            'datalad_hirni.commands.cleanup',
+            'Cleanup',
+            'hirni-cleanup',
+            'hirni_cleanup',
+        ),
         (
             'datalad_hirni.commands.spec4anything',
             'Spec4Anything',
@@ -0,0 +1,90 @@
+"""Aggregate metadata of acquisitions imported with deferred aggregation"""
+
+import os.path as op
+
+from datalad.distribution.dataset import EnsureDataset
+from datalad.distribution.dataset import datasetmethod
+from datalad.distribution.dataset import require_dataset
+from datalad.interface.base import Interface
+from datalad.interface.base import build_doc
+from datalad.interface.utils import eval_results
+from datalad.support.constraints import EnsureNone
+from datalad.support.param import Parameter
+from datalad.utils import with_pathsep
+
+from datalad_hirni.support.pending_aggregation import (
+    get_pending,
+    remove_pending,
+)
+
+# bound dataset method
+import datalad_metalad.aggregate
+
+import logging
+lgr = logging.getLogger('datalad.hirni.aggregate_pending')
+
+
+@build_doc
+class AggregatePending(Interface):
+    """Aggregate metadata of all acquisitions pending aggregation.
+
+    hirni-import-dcm and hirni-import-dcm-bulk can be told to not aggregate
+    the metadata of imported acquisitions into the study dataset
+    (--defer-aggregation), which gets slower the more acquisitions a study
+    dataset has. Instead they record the imported subdatasets as pending.
+    This command aggregates the metadata of all pending subdatasets into the
+    study dataset in one go.
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='PATH',
+            doc="""study dataset to aggregate pending acquisitions into. If no
+            dataset is given, an attempt is made to identify the dataset based
+            on the current working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+    )
+
+    @staticmethod
+    @datasetmethod(name='hirni_aggregate_pending')
+    @eval_results
+    def __call__(dataset=None):
+
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose="aggregate pending acquisitions")
+
+        res_kwargs = dict(type='dataset',
+                          action='hirni aggregate pending',
+                          logger=lgr)
+        to_aggregate = []
+        vanished = []
+        for p in get_pending(ds):
+            if op.exists(p):
+                to_aggregate.append(p)
+            else:
+                vanished.append(p)
+                yield dict(res_kwargs, status='notneeded', path=p,
+                           message="subdataset doesn't exist anymore")
+        if vanished:
+            remove_pending(ds, vanished)
+        if not to_aggregate:
+            return
+
+        failed = False
+        for r in ds.meta_aggregate([with_pathsep(p) for p in to_aggregate],
+                                   into='top',
+                                   return_type='generator',
+                                   result_renderer='disabled',
+                                   on_failure='ignore'):
+            if r.get('status', None) not in ['ok', 'notneeded']:
+                failed = True
+                yield r
+        if failed:
+            # keep everything pending for a retry; aggregation is all or
+            # nothing for the aggregated metadata store
+            return
+
+        remove_pending(ds, to_aggregate)
+        for p in to_aggregate:
+            yield dict(res_kwargs, status='ok', path=p)
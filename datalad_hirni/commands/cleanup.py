@@ -0,0 +1,131 @@
+"""Do the cleanup of imported acquisitions, that was deferred"""
+
+import os.path as op
+import subprocess
+
+from datalad.distribution.dataset import Dataset
+from datalad.distribution.dataset import EnsureDataset
+from datalad.distribution.dataset import datasetmethod
+from datalad.distribution.dataset import require_dataset
+from datalad.interface.base import Interface
+from datalad.interface.base import build_doc
+from datalad.interface.utils import eval_results
+from datalad.support.constraints import EnsureChoice
+from datalad.support.constraints import EnsureInt
+from datalad.support.constraints import EnsureNone
+from datalad.support.param import Parameter
+
+from datalad_hirni.commands.dicom2spec import _get_n_jobs
+from datalad_hirni.commands.import_dicoms import _drop_extracted
+from datalad_hirni.support.pending_aggregation import (
+    get_pending,
+    remove_pending,
+)
+
+import logging
+lgr = logging.getLogger('datalad.hirni.cleanup')
+
+
+def _gc(path):
+    """Run `git gc` in `path` and return an error message or None"""
+    proc = subprocess.run(['git', 'gc', '--quiet'], cwd=path,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode:
+        return proc.stderr.strip() or "git gc failed"
+    return None
+
+
+@build_doc
+class Cleanup(Interface):
+    """Garbage collect and drop content of imported acquisitions in batches.
+
+    After importing a DICOM archive, hirni-import-dcm drops the extracted
+    DICOM files (they are still available from the archive) and runs
+    `git gc` in the acquisition's DICOM dataset. Both can be deferred by
+    configuration (`datalad.hirni.import.drop` and
+    `datalad.hirni.import.gc`), in which case the DICOM datasets are recorded
+    as pending. This command runs `git gc` for all datasets pending garbage
+    collection, several of them in parallel (see --jobs). Extracted files
+    kept for conversion are dropped by hirni-spec2bids once an acquisition
+    was converted. With --drop, they are dropped here instead.
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='PATH',
+            doc="""study dataset to clean up the acquisitions of. If no
+            dataset is given, an attempt is made to identify the dataset based
+            on the current working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+        drop=Parameter(
+            args=("--drop",),
+            action="store_true",
+            doc="""also drop the extracted DICOM files, that were kept for
+            conversion."""),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of datasets to garbage collect in parallel. "auto"
+            corresponds to the number of CPUs.""",
+            constraints=EnsureInt() | EnsureNone() | EnsureChoice('auto')),
+    )
+
+    @staticmethod
+    @datasetmethod(name='hirni_cleanup')
+    @eval_results
+    def __call__(dataset=None, drop=False, jobs=None):
+
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose="clean up imported acquisitions")
+
+        res_kwargs = dict(type='dataset', logger=lgr)
+
+        if drop:
+            dropped = []
+            for p in get_pending(ds, queue='drop'):
+                if not op.exists(p):
+                    dropped.append(p)
+                    continue
+                failed = False
+                for r in _drop_extracted(Dataset(p), return_type='generator',
+                                         on_failure='ignore',
+                                         result_renderer='disabled'):
+                    if r['status'] not in ['ok', 'notneeded']:
+                        failed = True
+                    yield r
+                if not failed:
+                    dropped.append(p)
+            remove_pending(ds, dropped, queue='drop')
+
+        to_gc = []
+        vanished = []
+        for p in get_pending(ds, queue='gc'):
+            if op.exists(p):
+                to_gc.append(p)
+            else:
+                vanished.append(p)
+                yield dict(res_kwargs, action='hirni gc', status='notneeded',
+                           path=p, message="dataset doesn't exist anymore")
+        if vanished:
+            remove_pending(ds, vanished, queue='gc')
+        if not to_gc:
+            return
+
+        # Note: git does the work; threads are enough to keep several of
+        # those busy
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(
+                max_workers=min(_get_n_jobs(jobs), len(to_gc))) as executor:
+            errors = list(executor.map(_gc, to_gc))
+
+        remove_pending(ds, [p for p, e in zip(to_gc, errors) if e is None],
+                       queue='gc')
+        for p, error in zip(to_gc, errors):
+            if error:
+                yield dict(res_kwargs, action='hirni gc', path=p,
+                           status='error', message=error)
+            else:
+                yield dict(res_kwargs, action='hirni gc', path=p,
+                           status='ok')
@@ -3,7 +3,10 @@ DICOM metadata as provided by datalad.
 """
 
 import logging
+import os
 import os.path as op
+import time
+from collections import OrderedDict
 
 from datalad.core.local.save import Save
 from datalad.distribution.dataset import EnsureDataset
@@ -14,13 +17,18 @@ from datalad.interface.base import Interface
 from datalad.interface.base import build_doc
 from datalad.interface.utils import eval_results
 from datalad.support import json_py
+from datalad.support.constraints import EnsureChoice
+from datalad.support.constraints import EnsureInt
 from datalad.support.constraints import EnsureNone
 from datalad.support.constraints import EnsureStr
 from datalad.support.exceptions import InsufficientArgumentsError
 from datalad.support.param import Parameter
 
 from datalad_hirni.commands.spec4anything import _get_edit_dict
+from datalad_hirni.support.subject_rules import SubjectRules
 from datalad_hirni.support.spec_helpers import (
+    SpecContainer,
+    _index_key,
     get_specval,
     has_specval
 )
@@ -32,6 +40,205 @@ import datalad_metalad.dump
 lgr = logging.getLogger('datalad.hirni.dicom2spec')
 
 
+class _RuleModuleCache(object):
+    """Process-wide cache of imported rule definition files
+
+    Modules are keyed by absolute path. The file's mtime and size are checked
+    on every lookup; only if they changed, the content hash is computed to
+    decide whether the file needs to be imported again. Hence, rule files are
+    compiled once per process and reloaded only when they actually change.
+    """
+
+    def __init__(self):
+        # abspath -> dict(stat=(mtime, size), digest=..., module=...)
+        self._entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(path):
+        import hashlib
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @staticmethod
+    def _import(path, digest):
+        import importlib.util
+        import sys
+        # Note: Not using datalad.utils.import_module_from_file, since it
+        # imports by the file's basename. Thereby python's own module cache
+        # would prevent a changed file from being reloaded and rule files of
+        # the same name in different locations would shadow each other.
+        name = '_datalad_hirni_rules_{}'.format(digest)
+        spec = importlib.util.spec_from_file_location(name, path)
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[name] = mod
+        try:
+            spec.loader.exec_module(mod)
+        except Exception:
+            del sys.modules[name]
+            raise
+        return mod
+
+    def get(self, path):
+        """Get the module defined by the file at `path`"""
+        path = op.abspath(path)
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        entry = self._entries.get(path)
+        if entry and entry['stat'] == stat:
+            self.hits += 1
+            return entry['module']
+        digest = self._digest(path)
+        if entry and entry['digest'] == digest:
+            # touched, but not changed:
+            entry['stat'] = stat
+            self.hits += 1
+            return entry['module']
+        self.misses += 1
+        lgr.debug("Importing rules definition file %s", path)
+        mod = self._import(path, digest)
+        self._entries[path] = dict(stat=stat, digest=digest, module=mod)
+        return mod
+
+    def get_digest(self, path):
+        """Content hash of a file previously imported via `get`"""
+        return self._entries[op.abspath(path)]['digest']
+
+    def clear(self):
+        self._entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+
+_rule_module_cache = _RuleModuleCache()
+
+
+def get_rule_cache_stats():
+    """Report usage of the process-wide cache of rule definition files
+
+    Returns
+    -------
+    dict
+      with keys 'hits', 'misses' and 'files' (number of cached files)
+    """
+    return dict(hits=_rule_module_cache.hits,
+                misses=_rule_module_cache.misses,
+                files=len(_rule_module_cache._entries))
+
+
+class _DerivationCache(object):
+    """Persistent cache of rule results for DICOM series
+
+    Results of applying a rule to the DICOM metadata of an acquisition are
+    stored as a JSON file per key underneath the dataset's
+    .git/datalad/hirni, so they never get committed. A key is made of the
+    digest of the metadata of all series (rules may need the entirety of
+    them), the content hash of the rule file and the arguments passed to the
+    rule. Editing a rule file therefore invalidates that rule's results only.
+    """
+
+    # increase, if the stored format or what goes into a key changes:
+    _version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_series_digest(dicommetadata):
+        import hashlib
+        import json
+        return hashlib.sha1(
+            json.dumps(dicommetadata, sort_keys=True,
+                       default=str).encode('utf-8')).hexdigest()
+
+    def get_key(self, rule_digest, series_digest, **kwargs):
+        import hashlib
+        import json
+        from datalad_hirni import __version__
+        return hashlib.sha1(json.dumps(
+            [self._version, __version__, rule_digest, series_digest,
+             sorted(kwargs.items())]).encode('utf-8')).hexdigest()
+
+    def _get_file(self, key):
+        return op.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        """Return list of (dict, bool) stored for `key` or None"""
+        try:
+            with open(self._get_file(key)) as f:
+                result = json_py.loads(f.read())
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [(d, v) for d, v in result]
+
+    def put(self, key, dict_list):
+        import json
+        try:
+            content = json.dumps([[d, v] for d, v in dict_list])
+        except (TypeError, ValueError) as e:
+            lgr.debug("Not caching rule results, since they can't be "
+                      "serialized: %s", e)
+            return
+        target = self._get_file(key)
+        if not op.exists(op.dirname(target)):
+            os.makedirs(op.dirname(target), exist_ok=True)
+        # write to a temp file first, so that concurrent workers never read a
+        # partially written file:
+        tmp = '{}.{}.tmp'.format(target, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, target)
+
+
+def _series_table(dicommetadata):
+    """Columnar view of DICOM metadata; one row per series, one column per
+    field"""
+    try:
+        import pandas
+    except ImportError:
+        raise ValueError("Columnar dicom2spec rules require pandas to be "
+                         "installed")
+    return pandas.DataFrame.from_records(dicommetadata)
+
+
+def _column2list(column, n):
+    """Turn a column returned by a columnar rule into a list of `n` plain
+    python values"""
+    if isinstance(column, str) or not hasattr(column, '__len__'):
+        # scalar; applies to all series
+        column = [column] * n
+    values = column.tolist() if hasattr(column, 'tolist') else list(column)
+    if len(values) != n:
+        raise ValueError("Columnar rule returned {} values for {} series"
+                         "".format(len(values), n))
+    # NaN is what pandas/numpy use for missing values
+    return [None if isinstance(v, float) and v != v else v for v in values]
+
+
+def _columns2dict_list(result, n):
+    """Translate `(columns, valid)` as returned by a columnar rule into the
+    list of (dict, bool) of the per-series rule protocol"""
+    columns, valid = result
+    columns = {k: _column2list(c, n) for k, c in columns.items()}
+    valid = _column2list(valid, n)
+    return [({k: c[i] for k, c in columns.items()}, bool(valid[i]))
+            for i in range(n)]
+
+
+def _accepts_subject_rules(rule_cls):
+    """Whether a rule class can be passed the configured subject rules"""
+    import inspect
+    try:
+        return 'subject_rules' in inspect.signature(rule_cls).parameters
+    except (TypeError, ValueError):
+        return False
+
+
 class RuleSet(object):
     """Holds and applies the current rule set for deriving BIDS terms from
     DICOM metadata"""
@@ -42,6 +249,13 @@ class RuleSet(object):
         Rules are defined by classes ... + __datalad_hirni_rules
         datalad.hirni.dicom2spec.rules  ... multiple
 
+        A rule class setting the attribute `columnar = True` gets the metadata
+        as a `pandas.DataFrame` (one row per series) instead of a list of
+        dicts. When called, it is expected to return a tuple `(columns,
+        valid)`, with `columns` being a dict of spec keys and column arrays
+        (or scalars applying to all series) and `valid` a boolean array
+        (or scalar).
+
         Parameters
         ----------
         dataset: Dataset
@@ -54,6 +268,10 @@ class RuleSet(object):
         cfg = dataset.config if dataset else dl_cfg
 
         self._rule_set = []
+        # content hashes of the rule files, corresponding to self._rule_set:
+        self._rule_digests = []
+        # names to report timings by, corresponding to self._rule_set:
+        self._rule_names = []
         # get a list of paths to build the rule set from
         # Note: assure_list is supposed to return empty list if there's nothing
         self._file_list = \
@@ -66,10 +284,9 @@ class RuleSet(object):
                             "definition: %s", file)
                 continue
 
-            from datalad.utils import import_module_from_file
             from datalad.dochelpers import exc_str
             try:
-                mod = import_module_from_file(file)
+                mod = _rule_module_cache.get(file)
             except Exception as e:
                 # any exception means full stop
                 raise ValueError("Rules definition file at {} is broken: {}"
@@ -79,10 +296,47 @@ class RuleSet(object):
             if not hasattr(mod, "__datalad_hirni_rules"):
                 raise ValueError("Rules definition file {} missed attribute "
                                  "'__datalad_hirni_rules'.".format(file))
-            self._rule_set.append(getattr(mod, "__datalad_hirni_rules"))
+            rule_cls = getattr(mod, "__datalad_hirni_rules")
+            self._rule_set.append(rule_cls)
+            self._rule_digests.append(_rule_module_cache.get_digest(file))
+            self._rule_names.append(
+                "{} ({})".format(getattr(rule_cls, '__name__', rule_cls),
+                                 file))
 
         if not self._rule_set:
             self._rule_set = [DefaultRules]
+            from datalad_hirni.support import default_rules
+            self._rule_digests = [
+                _RuleModuleCache._digest(default_rules.__file__)]
+            self._rule_names = ["DefaultRules (builtin)"]
+        lgr.debug("rule module cache: %s", get_rule_cache_stats())
+
+        # scanner site specific subject identification for rules accepting it
+        self._subject_rules = SubjectRules.from_config(
+            cfg, basepath=dataset.path if dataset else None)
+        self._takes_subject_rules = [_accepts_subject_rules(r)
+                                     for r in self._rule_set]
+
+        from datalad.config import anything2bool
+        self._cache = None
+        if dataset is not None and \
+                anything2bool(cfg.get("datalad.hirni.dicom2spec.cache",
+                                      True)):
+            self._cache = _DerivationCache(
+                op.join(str(dataset.repo.dot_git), 'datalad', 'hirni',
+                        'dicom2spec_cache'))
+
+        # per rule: number of applications, series and seconds spent
+        self.timings = OrderedDict(
+            (name, dict(calls=0, cached=0, series=0, seconds=0.0))
+            for name in self._rule_names)
+        # opt-in profiling of rules; one cProfile dump per rule and process
+        # into that dir. A relative one is kept out of the worktree.
+        self._profile_dir = cfg.get("datalad.hirni.dicom2spec.profile", None)
+        if self._profile_dir and dataset is not None:
+            self._profile_dir = op.join(str(dataset.repo.dot_git), 'datalad',
+                                        'hirni', self._profile_dir)
+        self._profilers = dict()
 
     def apply(self, dicommetadata, subject=None,
               anon_subject=None, session=None):
@@ -105,22 +359,70 @@ class RuleSet(object):
           derived dict in specification terminology
         """
 
-        # instantiate rules with metadata; note, that some possible rules might
-        # need the entirety of it, not just the current series to be treated.
-        actual_rules = [r(dicommetadata) for r in self._rule_set]
+        series_digest = _DerivationCache.get_series_digest(dicommetadata) \
+            if self._cache else None
+        # built once and shared by all columnar rules:
+        table = None
 
         # we want one specification dict per image series
         result_dicts = [dict() for i in range(len(dicommetadata))]
 
-        for rule in actual_rules:
-
-            # TODO: generic overrides instead (or none at all here and let this
-            # be done later on - not sure, what's most useful for the rules
-            # themselves. Also: If we know already we can save the effort to
-            # deduct => likely keep passing on to the rules)
-            dict_list = rule(subject=subject,
-                             anon_subject=anon_subject,
-                             session=session)
+        for rule_cls, rule_digest, rule_name, takes_subject_rules in \
+                zip(self._rule_set, self._rule_digests, self._rule_names,
+                    self._takes_subject_rules):
+
+            rule_kwargs = {'subject_rules': self._subject_rules} \
+                if takes_subject_rules else {}
+            cache_key = None
+            dict_list = None
+            if self._cache:
+                cache_key = self._cache.get_key(
+                    rule_digest, series_digest,
+                    subject=subject,
+                    anon_subject=anon_subject,
+                    session=session,
+                    subject_rules=self._subject_rules.digest
+                    if takes_subject_rules else None)
+                dict_list = self._cache.get(cache_key)
+
+            timing = self.timings[rule_name]
+            if dict_list is not None:
+                timing['cached'] += 1
+            else:
+                profiler = self._get_profiler(rule_name)
+                start = time.perf_counter()
+                if profiler:
+                    profiler.enable()
+                try:
+                    # instantiate rules with metadata; note, that some
+                    # possible rules might need the entirety of it, not just
+                    # the current series to be treated.
+                    columnar = getattr(rule_cls, 'columnar', False)
+                    if columnar and table is None:
+                        table = _series_table(dicommetadata)
+                    rule = rule_cls(table if columnar else dicommetadata,
+                                    **rule_kwargs)
+                    # TODO: generic overrides instead (or none at all here and
+                    # let this be done later on - not sure, what's most useful
+                    # for the rules themselves. Also: If we know already we
+                    # can save the effort to deduct => likely keep passing on
+                    # to the rules)
+                    dict_list = rule(subject=subject,
+                                     anon_subject=anon_subject,
+                                     session=session)
+                    if columnar:
+                        dict_list = _columns2dict_list(dict_list,
+                                                       len(dicommetadata))
+                finally:
+                    if profiler:
+                        profiler.disable()
+                if profiler:
+                    self._dump_profile(rule_name, rule_digest)
+                timing['calls'] += 1
+                timing['series'] += len(dicommetadata)
+                timing['seconds'] += time.perf_counter() - start
+                if self._cache:
+                    self._cache.put(cache_key, dict_list)
 
             # should return exactly one dict per series:
             assert len(dict_list) == len(dicommetadata)
@@ -142,11 +444,42 @@ class RuleSet(object):
                         else:
                             result_dicts[idx]['tags'] = ['hirni-dicom-converter-ignore']
 
+        if self._cache:
+            lgr.debug("dicom2spec derivation cache: %d hits, %d misses",
+                      self._cache.hits, self._cache.misses)
         return result_dicts
 
+    def _get_profiler(self, rule_name):
+        if not self._profile_dir:
+            return None
+        if rule_name not in self._profilers:
+            import cProfile
+            self._profilers[rule_name] = cProfile.Profile()
+        return self._profilers[rule_name]
+
+    def _dump_profile(self, rule_name, rule_digest):
+        # Note: Dumped after each application, since there's no notion of
+        # being done with a RuleSet. Stats accumulate over all applications
+        # within a process. Parallel workers write a file each.
+        os.makedirs(self._profile_dir, exist_ok=True)
+        prof_file = op.join(self._profile_dir, "{}-{}-{}.prof".format(
+            rule_name.split(' ', 1)[0], rule_digest[:8], os.getpid()))
+        self._profilers[rule_name].dump_stats(prof_file)
+        lgr.debug("profile of rule %s written to %s", rule_name, prof_file)
+
+    def log_timings(self):
+        """Log time spent by each rule so far"""
+        for name, t in self.timings.items():
+            lgr.debug("dicom2spec rule %s: %d calls, %d series, %.3fs "
+                      "(%.0f series/s), %d cached",
+                      name, t['calls'], t['series'], t['seconds'],
+                      t['series'] / t['seconds'] if t['seconds'] else 0,
+                      t['cached'])
+
 
 def add_to_spec(ds_metadata, spec_list, basepath,
-                subject=None, anon_subject=None, session=None, overrides=None, dataset=None):
+                subject=None, anon_subject=None, session=None, overrides=None, dataset=None,
+                rules=None):
 
     # TODO: discover procedures and write default config into spec for more convenient editing!
     # But: Would need toolbox present to create a spec. If not - what version of toolbox to use?
@@ -154,16 +487,19 @@ def add_to_spec(ds_metadata, spec_list, basepath,
 
     # Spec needs a dicomseries:all snippet before the actual dicomseries
     # snippets, since the order determines the order of execution of procedures
-    # later on.
+    # later on. There's one such snippet per location, since a spec file can
+    # cover several DICOM datasets.
     # Note, that here we only make sure such a snippet exists. It is to be
     # updated with unique values from the dicomseries snippets later on.
-    existing_all_dicoms = [i for s, i in zip(spec_list, range(len(spec_list)))
-                           if s['type'] == 'dicomseries:all']
+    if not isinstance(spec_list, SpecContainer):
+        spec_list = SpecContainer(spec_list)
+    location = op.relpath(ds_metadata['path'], basepath)
+    existing_all_dicoms = [s for s in spec_list.get_by_type('dicomseries:all')
+                           if s.get('location') in (location, None)]
     assert len(existing_all_dicoms) <= 1
 
     if not existing_all_dicoms:
-        spec_list.append({'type': 'dicomseries:all'})
-        existing_all_dicoms = len(spec_list) - 1
+        existing_all_dicoms = spec_list.append({'type': 'dicomseries:all'})
     else:
         existing_all_dicoms = existing_all_dicoms[0]
 
@@ -178,7 +514,7 @@ def add_to_spec(ds_metadata, spec_list, basepath,
             # Note: The first 4 entries aren't a dict and have no
             # "approved flag", since they are automatically managed
             'type': 'dicomseries',
-            'location': op.relpath(ds_metadata['path'], basepath),
+            'location': location,
             'uid': series['SeriesInstanceUID'],
             'dataset-id': ds_metadata['dsid'],
             'dataset-refcommit': ds_metadata['refcommit'],
@@ -187,7 +523,8 @@ def add_to_spec(ds_metadata, spec_list, basepath,
             #        if not series_is_valid(series) else [],
         })
 
-    rules_new = RuleSet(dataset=dataset)   # TODO: Pass on dataset for config access! => RF the entire thing
+    rules_new = rules if rules is not None \
+        else RuleSet(dataset=dataset)   # TODO: Pass on dataset for config access! => RF the entire thing
     derived = rules_new.apply(ds_metadata['metadata']['dicom']['Series'],
                               subject=subject,
                               anon_subject=anon_subject,
@@ -204,23 +541,23 @@ def add_to_spec(ds_metadata, spec_list, basepath,
 
         series.update(overrides)
 
-        existing = [i for s, i in
-                    zip(spec_list, range(len(spec_list)))
-                    if s['type'] == 'dicomseries' and s['uid'] == series['uid']]
+        existing = spec_list.get_by_uid(series['uid'], type_='dicomseries')
         if existing:
             lgr.debug("Updating existing spec for image series %s",
                       series['uid'])
             # we already had data of that series in the spec;
-            spec_list[existing[0]].update(series)
+            spec_list.update(existing[0], series)
         else:
             lgr.debug("Creating spec for image series %s", series['uid'])
             spec_list.append(series)
 
     # spec snippet for addressing an entire dicom acquisition:
     # fill in values of editable fields, that are unique across
-    # dicomseries
+    # dicomseries of this location
     uniques = dict()
-    for s in spec_list:
+    for s in spec_list.get_by_type('dicomseries'):
+        if s.get('location') != location:
+            continue
         for k in s.keys():
             if isinstance(s[k], dict) and 'value' in s[k]:
                 if k not in uniques:
@@ -235,7 +572,7 @@ def add_to_spec(ds_metadata, spec_list, basepath,
 
     all_dicoms.update({
         'type': 'dicomseries:all',
-        'location': op.relpath(ds_metadata['path'], basepath),
+        'location': location,
         'dataset-id': ds_metadata['dsid'],
         'dataset-refcommit': ds_metadata['refcommit'],
         'procedures': [{
@@ -249,11 +586,184 @@ def add_to_spec(ds_metadata, spec_list, basepath,
         ]
     })
 
-    spec_list[existing_all_dicoms].update(all_dicoms)
+    spec_list.update(existing_all_dicoms, all_dicoms)
 
     return spec_list
 
 
+def ignore_duplicate_runs(spec_list):
+    """Tag all but the last of repeated dicomseries runs to be ignored
+
+    Series sharing 'description' and 'bids-run' are considered reruns (prob.
+    of aborted runs). Only the one with the highest 'id' is to be converted,
+    all others get the 'hirni-dicom-converter-ignore' tag. This is a single
+    grouping pass over the specification and can be applied to any list of
+    snippets (several acquisitions and spec files at once, too).
+
+    Parameters
+    ----------
+    spec_list: iterable of dict
+      specification snippets; modified in place
+
+    Returns
+    -------
+    list of dict
+      snippets that were newly tagged to be ignored
+    """
+
+    def _group_key(snippet):
+        return tuple(_index_key(get_specval(snippet, k))
+                     for k in ('description', 'bids-run'))
+
+    # Note: Removed the following from the condition for a series to be
+    # considered, since it appears to be pointless. Value for 'converter'
+    # used to be 'heudiconv' or 'ignore' for a 'dicomseries', so
+    # it's not clear ATM what case this could possibly have catched:
+    # heuristic.has_specval(spec_series_list[i], "converter")
+    candidates = []
+    highest_id = dict()
+    for snippet in spec_list:
+        if not all(isinstance(snippet.get(k), dict) and 'value' in snippet[k]
+                   for k in ('description', 'bids-run', 'id')) or \
+                get_specval(snippet, 'id') is None:
+            continue
+        key = _group_key(snippet)
+        id_ = get_specval(snippet, 'id')
+        if key not in highest_id or id_ > highest_id[key]:
+            highest_id[key] = id_
+        if snippet['type'] == 'dicomseries' and \
+                has_specval(snippet, 'bids-run'):
+            candidates.append(snippet)
+
+    ignored = []
+    for snippet in candidates:
+        if get_specval(snippet, 'id') < highest_id[_group_key(snippet)]:
+            lgr.debug("Ignore SeriesNumber %s for conversion",
+                      get_specval(snippet, 'id'))
+            tags = snippet.setdefault('tags', [])
+            if 'hirni-dicom-converter-ignore' not in tags:
+                tags.append('hirni-dicom-converter-ignore')
+                ignored.append(snippet)
+    return ignored
+
+
+def _derive_spec(spec, metas, dataset, subject=None, anon_subject=None,
+                 overrides=None):
+    """Derive the specification for DICOM datasets and write it to `spec`
+
+    Everything going into the same specification file is done in one go, so
+    specifications for different files can be derived in parallel.
+
+    Parameters
+    ----------
+    spec: str
+      path to the specification file to update
+    metas: list of dict
+      datalad's dataset level metadata for the DICOM datasets to add to `spec`
+    dataset: Dataset or str
+      dataset to read possibly customized rules from. A path is accepted in
+      order to not need to pass a Dataset instance into worker processes.
+
+    Returns
+    -------
+    tuple
+      path to the written specification file and the timings of the rules
+      (see `RuleSet.timings`)
+    """
+
+    from datalad.distribution.dataset import Dataset
+    if not isinstance(dataset, Dataset):
+        dataset = Dataset(dataset)
+
+    spec_series_list = SpecContainer.from_file(spec)
+    # all metadata are processed with the same rules:
+    rules = RuleSet(dataset=dataset)
+    for meta in metas:
+        spec_series_list = add_to_spec(meta,
+                                       spec_series_list,
+                                       op.dirname(spec),
+                                       subject=subject,
+                                       anon_subject=anon_subject,
+                                       # session=session,
+                                       # TODO: parameter "session" was what
+                                       # we now call acquisition. This is
+                                       # NOT a good default for bids_session!
+                                       # Particularly wrt to anonymization
+                                       overrides=overrides,
+                                       dataset=dataset,
+                                       rules=rules
+                                       )
+
+    # TODO: RF needed. This rule should go elsewhere:
+    # ignore duplicates (prob. reruns of aborted runs)
+    # -> convert highest id only
+    # Note: This sorting is a q&d hack!
+    # TODO: Sorting needs to become more sophisticated + include notion of :all
+    # Note: From here on `spec_series_list` is a plain list. The indexes of
+    # the SpecContainer `add_to_spec` worked on don't apply anymore.
+    spec_series_list = sorted(spec_series_list,
+                              key=lambda x: get_specval(x, 'id')
+                                            if 'id' in x.keys() else 0)
+    ignore_duplicate_runs(spec_series_list)
+
+    lgr.debug("Storing specification (%s)", spec)
+    # store as a stream (one record per file) to be able to
+    # easily concat files without having to parse them, or
+    # process them line by line without having to fully parse them
+    from datalad_hirni.support.spec_helpers import sort_spec
+    # Note: Sorting paradigm needs to change. See above.
+    # spec_series_list = sorted(spec_series_list, key=lambda x: sort_spec(x))
+    json_py.dump2stream(spec_series_list, spec)
+    rules.log_timings()
+    return spec, rules.timings
+
+
+def _get_dataset_metadata(dataset, paths):
+    """Yield dataset level metadata for `paths` as reported by meta_dump
+
+    Metadata of subdatasets, whose aggregation into `dataset` is pending (see
+    hirni-aggregate-pending), is read from the subdatasets themselves.
+    """
+    from datalad.distribution.dataset import Dataset
+    from datalad_hirni.support.pending_aggregation import get_pending
+    pending = set(get_pending(dataset))
+    aggregated = [p for p in paths if p not in pending]
+    for p in paths:
+        if p in pending:
+            yield from Dataset(p).meta_dump(
+                reporton='datasets',
+                return_type='generator',
+                result_renderer='disabled')
+    if aggregated:
+        yield from dataset.meta_dump(
+            aggregated,
+            recursive=False,  # always False?
+            reporton='datasets',
+            return_type='generator',
+            result_renderer='disabled')
+
+
+def _ensure_specs_in_git(dataset, spec_files):
+    """Set annex.largefiles=nothing for `spec_files` in .gitattributes of
+    `dataset` where needed"""
+    spec_attrs = dataset.repo.get_gitattributes(spec_files)
+    to_set = []
+    for spec_path in spec_files:
+        spec_relpath = op.relpath(spec_path, dataset.path)
+        if spec_relpath not in spec_attrs.keys() or \
+                'annex.largefiles' not in spec_attrs[spec_relpath].keys() or \
+                spec_attrs[spec_relpath]['annex.largefiles'] != 'nothing':
+            to_set.append((spec_path, {'annex.largefiles': 'nothing'}))
+    if to_set:
+        dataset.repo.set_gitattributes(to_set, '.gitattributes')
+
+
+def _get_n_jobs(jobs):
+    if jobs == 'auto':
+        return os.cpu_count() or 1
+    return jobs or 1
+
+
 @build_doc
 class Dicom2Spec(Interface):
     """Derives a specification snippet from DICOM metadata and stores it in a
@@ -280,12 +790,19 @@ class Dicom2Spec(Interface):
                     args=("path",),
                     metavar="PATH",
                     nargs="+",
-                    doc="""path to DICOM files""",
+                    doc="""path(s) to DICOM files. Several acquisitions can be
+                    given at once, all changes are then saved in a single
+                    commit""",
                     constraints=EnsureStr() | EnsureNone()),
             spec=Parameter(
                     args=("-s", "--spec",),
                     metavar="SPEC",
-                    doc="""file to store the specification in""",
+                    doc="""file to store the specification in. If not given,
+                    the specification for each DICOM dataset is stored in a
+                    file next to it (i.e. in the acquisition directory). Its
+                    name defaults to 'studyspec.json' and can be configured via
+                    the 'datalad.hirni.studyspec.filename' config variable. If
+                    given, specifications for all PATHs go into this file""",
                     constraints=EnsureStr() | EnsureNone()),
             subject=Parameter(
                     args=("--subject",),
@@ -309,13 +826,23 @@ class Dicom2Spec(Interface):
                     metavar="PATH or JSON string",
                     doc="""""",
                     constraints=EnsureStr() | EnsureNone()),
+            jobs=Parameter(
+                    args=("-J", "--jobs"),
+                    metavar="NJOBS",
+                    doc="""number of worker processes to derive specifications
+                    for different specification files in parallel. "auto"
+                    corresponds to the number of CPUs. By default, everything
+                    is done in the current process""",
+                    constraints=EnsureInt() | EnsureNone() |
+                    EnsureChoice('auto')),
     )
 
     @staticmethod
     @datasetmethod(name='hirni_dicom2spec')
     @eval_results
     def __call__(path=None, spec=None, dataset=None, subject=None,
-                 anon_subject=None, acquisition=None, properties=None):
+                 anon_subject=None, acquisition=None, properties=None,
+                 jobs=None):
 
         # TODO: acquisition can probably be removed (or made an alternative to
         # derive spec and/or dicom location from)
@@ -335,37 +862,28 @@ class Dicom2Spec(Interface):
             raise InsufficientArgumentsError(
                 "insufficient arguments for dicom2spec: a path is required")
 
-        # TODO: We should be able to deal with several paths at once
-        #       ATM we aren't (see also commit + message of actual spec)
-        assert len(path) == 1
-
-        if not spec:
-            raise InsufficientArgumentsError(
-                "insufficient arguments for dicom2spec: a spec file is required")
-
-            # TODO: That's prob. wrong. We can derive default spec from acquisition
-        else:
+        if spec:
             spec = str(resolve_path(spec, dataset))
-
-        spec_series_list = \
-            [r for r in json_py.load_stream(spec)] if op.exists(spec) else list()
-
-        # get dataset level metadata:
-        found_some = False
-        for meta in dataset.meta_dump(
-                path,
-                recursive=False,  # always False?
-                reporton='datasets',
-                return_type='generator',
-                result_renderer='disabled'):
+        spec_filename = dataset.config.get("datalad.hirni.studyspec.filename",
+                                           "studyspec.json")
+
+        overrides = dict()
+        if properties:
+            # load from file or json string
+            props = json_py.load(properties) \
+                    if op.exists(properties) else json_py.loads(properties)
+            # turn into editable, pre-approved records
+            props = {k: dict(value=v, approved=True) for k, v in props.items()}
+            overrides.update(props)
+
+        # get dataset level metadata for all paths in one go and assign them
+        # to the specification files they go into:
+        metas_by_spec = OrderedDict()
+        for meta in _get_dataset_metadata(dataset, path):
             if meta.get('status', None) not in ['ok', 'notneeded']:
                 yield meta
                 continue
 
-
-
-
-
             if 'dicom' not in meta['metadata']:
 
                 # TODO: Really "notneeded" or simply not a result at all?
@@ -391,32 +909,13 @@ class Dicom2Spec(Interface):
                         logger=lgr)
                 continue
 
-            found_some = True
-
-            overrides = dict()
-            if properties:
-                # load from file or json string
-                props = json_py.load(properties) \
-                        if op.exists(properties) else json_py.loads(properties)
-                # turn into editable, pre-approved records
-                props = {k: dict(value=v, approved=True) for k, v in props.items()}
-                overrides.update(props)
-
-            spec_series_list = add_to_spec(meta,
-                                           spec_series_list,
-                                           op.dirname(spec),
-                                           subject=subject,
-                                           anon_subject=anon_subject,
-                                           # session=session,
-                                           # TODO: parameter "session" was what
-                                           # we now call acquisition. This is
-                                           # NOT a good default for bids_session!
-                                           # Particularly wrt to anonymization
-                                           overrides=overrides,
-                                           dataset=dataset
-                                           )
-
-        if not found_some:
+            # without an explicit spec file, the spec goes into the
+            # acquisition directory the DICOM dataset is in:
+            meta_spec = spec if spec else \
+                op.join(op.dirname(meta['path']), spec_filename)
+            metas_by_spec.setdefault(meta_spec, []).append(meta)
+
+        if not metas_by_spec:
             yield dict(status='impossible',
                        message="found no DICOM metadata",
                        path=path,
@@ -425,69 +924,72 @@ class Dicom2Spec(Interface):
                        logger=lgr)
             return
 
-        # TODO: RF needed. This rule should go elsewhere:
-        # ignore duplicates (prob. reruns of aborted runs)
-        # -> convert highest id only
-        # Note: This sorting is a q&d hack!
-        # TODO: Sorting needs to become more sophisticated + include notion of :all
-        spec_series_list = sorted(spec_series_list,
-                                  key=lambda x: get_specval(x, 'id')
-                                                if 'id' in x.keys() else 0)
-        for i in range(len(spec_series_list)):
-            # Note: Removed the following line from condition below,
-            # since it appears to be pointless. Value for 'converter'
-            # used to be 'heudiconv' or 'ignore' for a 'dicomseries', so
-            # it's not clear ATM what case this could possibly have catched:
-            # heuristic.has_specval(spec_series_list[i], "converter") and \
-            if spec_series_list[i]["type"] == "dicomseries" and \
-                has_specval(spec_series_list[i], "bids-run") and \
-                get_specval(spec_series_list[i], "bids-run") in \
-                    [get_specval(s, "bids-run")
-                     for s in spec_series_list[i + 1:]
-                     if get_specval(
-                            s,
-                            "description") == get_specval(
-                                spec_series_list[i], "description") and \
-                     get_specval(s, "id") > get_specval(
-                                             spec_series_list[i], "id")
-                     ]:
-                lgr.debug("Ignore SeriesNumber %s for conversion" % i)
-                spec_series_list[i]["tags"].append(
-                        'hirni-dicom-converter-ignore')
-
-        lgr.debug("Storing specification (%s)", spec)
-        # store as a stream (one record per file) to be able to
-        # easily concat files without having to parse them, or
-        # process them line by line without having to fully parse them
-        from datalad_hirni.support.spec_helpers import sort_spec
-        # Note: Sorting paradigm needs to change. See above.
-        # spec_series_list = sorted(spec_series_list, key=lambda x: sort_spec(x))
-        json_py.dump2stream(spec_series_list, spec)
-
-        # make sure spec is tracked in git:
-        spec_attrs = dataset.repo.get_gitattributes(spec)
-        spec_relpath = op.relpath(spec, dataset.path)
-        if spec_relpath not in spec_attrs.keys() or \
-                'annex.largefiles' not in spec_attrs[spec_relpath].keys() or \
-                spec_attrs[spec_relpath]['annex.largefiles'] != 'nothing':
-            dataset.repo.set_gitattributes([(spec,
-                                             {'annex.largefiles': 'nothing'})],
-                                           '.gitattributes')
+        derive_kwargs = dict(subject=subject,
+                             anon_subject=anon_subject,
+                             overrides=overrides)
+        n_jobs = min(_get_n_jobs(jobs), len(metas_by_spec))
+        spec_files = []
+        timings = dict()
+        if n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            # Note: Workers get the dataset's path rather than the Dataset
+            # instance and read rule configuration from there on their own.
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [(spec_path,
+                            executor.submit(_derive_spec, spec_path, metas,
+                                            dataset.path, **derive_kwargs))
+                           for spec_path, metas in metas_by_spec.items()]
+                for spec_path, future in futures:
+                    try:
+                        spec_file, timings[spec_path] = future.result()
+                        spec_files.append(spec_file)
+                    except Exception as e:
+                        from datalad.dochelpers import exc_str
+                        yield dict(status='error',
+                                   message=("failed to derive specification: "
+                                            "%s", exc_str(e)),
+                                   path=spec_path,
+                                   type='file',
+                                   action='dicom2spec',
+                                   logger=lgr)
+        else:
+            for spec_path, metas in metas_by_spec.items():
+                spec_file, timings[spec_path] = \
+                    _derive_spec(spec_path, metas, dataset, **derive_kwargs)
+                spec_files.append(spec_file)
+
+        if not spec_files:
+            return
 
+        # make sure specs are tracked in git:
+        _ensure_specs_in_git(dataset, spec_files)
+
+        acq_paths = [op.relpath(m['path'], dataset.path)
+                     for metas in metas_by_spec.values() for m in metas]
+        from datalad.dochelpers import single_or_plural
+        from os import linesep
+        message = "[HIRNI] Added study specification {n_snippets} for " \
+                  "{paths}".format(
+                      n_snippets=single_or_plural("snippet", "snippets",
+                                                  len(acq_paths)),
+                      paths=linesep.join(" - " + p for p in acq_paths)
+                      if len(acq_paths) > 1 else acq_paths[0])
+
+        gitattributes = op.join(dataset.path, '.gitattributes')
         for r in Save.__call__(dataset=dataset,
-                               path=[spec, '.gitattributes'],
+                               path=spec_files + ['.gitattributes'],
                                to_git=True,
-                               message="[HIRNI] Added study specification "
-                                       "snippet for %s" %
-                                       op.relpath(path[0], dataset.path),
+                               message=message,
                                return_type='generator',
                                result_renderer='disabled'):
             if r.get('status', None) not in ['ok', 'notneeded']:
                 yield r
-            elif r['path'] in [spec, op.join(dataset.path, '.gitattributes')] \
+            elif r['path'] in spec_files + [gitattributes] \
                     and r['type'] == 'file':
                 r['action'] = 'dicom2spec'
                 r['logger'] = lgr
+                if r['path'] in timings:
+                    r['timings'] = timings[r['path']]
                 yield r
             elif r['type'] == 'dataset':
                 # 'ok' or 'notneeded' for a dataset is okay, since we commit
@@ -497,7 +999,7 @@ class Dicom2Spec(Interface):
                 # anything else shouldn't happen
                 yield dict(status='error',
                            message=("unexpected result from save: %s", r),
-                           path=spec,  # TODO: This actually isn't clear - get it from `r`
+                           path=r['path'],
                            type='file',
                            action='dicom2spec',
                            logger=lgr)
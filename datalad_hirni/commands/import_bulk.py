@@ -0,0 +1,407 @@
+"""Import many DICOM tarballs into a study dataset at once"""
+
+from glob import glob
+from os import linesep
+from os import makedirs
+import os.path as op
+
+from datalad.core.local.save import Save
+from datalad.distribution.dataset import Dataset
+from datalad.distribution.dataset import EnsureDataset
+from datalad.distribution.dataset import datasetmethod
+from datalad.distribution.dataset import require_dataset
+from datalad.dochelpers import exc_str
+from datalad.interface.base import Interface
+from datalad.interface.base import build_doc
+from datalad.interface.utils import eval_results
+from datalad.support import json_py
+from datalad.support.constraints import EnsureChoice
+from datalad.support.constraints import EnsureInt
+from datalad.support.constraints import EnsureNone
+from datalad.support.constraints import EnsureStr
+from datalad.support.exceptions import InsufficientArgumentsError
+from datalad.support.network import RI, PathRI
+from datalad.support.param import Parameter
+from datalad.utils import (
+    assure_list,
+    with_pathsep
+)
+
+from datalad_hirni.commands.dicom2spec import (
+    _derive_spec,
+    _ensure_specs_in_git,
+    _get_n_jobs,
+)
+from datalad_hirni.commands.import_dicoms import (
+    _check_imported,
+    _cleanup_imported,
+    _create_subds_from_tarball,
+    _get_cleanup_policies,
+    _get_extract_jobs,
+    _get_import_modes,
+    _ignore_known_series,
+    _prescan_acquisition_id,
+    _record_import,
+    _was_started,
+)
+from datalad_hirni.support.pending_aggregation import add_pending
+
+# bound dataset method
+import datalad_metalad.aggregate
+import datalad_metalad.dump
+
+import logging
+lgr = logging.getLogger('datalad.hirni.import_bulk')
+
+
+def _read_manifest(path):
+    """Read a manifest of tarballs to import
+
+    One tarball per line, optionally followed by whitespace and the
+    acquisition ID to import it as. Empty lines and lines starting with '#'
+    are ignored. Relative paths are relative to the manifest's location.
+
+    Returns
+    -------
+    list of tuple
+      (tarball, acquisition ID or None)
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            tarball = fields[0]
+            if isinstance(RI(tarball), PathRI):
+                tarball = op.join(op.dirname(op.abspath(path)), tarball)
+            entries.append((tarball, fields[1].strip()
+                            if len(fields) > 1 else None))
+    return entries
+
+
+def _import_acquisition(ds_path, tarball, acqid, mode='auto',
+                        extract_jobs=None, subject=None, anon_subject=None,
+                        overrides=None, known_series=None, drop='import',
+                        gc='import'):
+    """Import a tarball into `acqid` of a dataset and derive its spec
+
+    Everything that only touches the new subdataset and the acquisition's
+    spec file is done here, so several acquisitions can be imported in
+    parallel. Neither the subdataset nor the spec are saved to the
+    superdataset.
+
+    Series in `known_series` (see `_check_imported`), that were imported
+    into other acquisitions before, are tagged to be ignored for conversion.
+    `drop` and `gc` are the policies from `_get_cleanup_policies`.
+
+    Returns
+    -------
+    dict
+      paths of the subdataset and the spec file, statistics of the import,
+      the ignored series and the queues for deferred cleanup
+    """
+
+    ds = Dataset(ds_path)
+    acq_dir = op.join(ds_path, acqid)
+    if not op.exists(acq_dir):
+        makedirs(acq_dir)
+    dicom_ds, stats = _create_subds_from_tarball(tarball, acq_dir, mode=mode,
+                                                 extract_jobs=extract_jobs)
+
+    # aggregate into the subdataset itself, while the extracted files are
+    # still there. Aggregation into the superdataset can reuse it.
+    dicom_ds.meta_aggregate()
+    meta = dicom_ds.meta_dump(reporton='datasets',
+                              return_type='item-or-list',
+                              result_renderer='disabled')
+    spec_path = op.join(acq_dir, ds.config.get(
+        "datalad.hirni.studyspec.filename", "studyspec.json"))
+    _derive_spec(spec_path, [meta], ds, subject=subject,
+                 anon_subject=anon_subject, overrides=overrides)
+    ignored = _ignore_known_series(spec_path, known_series or dict(), acqid)
+
+    deferred = _cleanup_imported(dicom_ds, drop=drop, gc=gc)
+
+    return dict(stats, dicom_ds=dicom_ds.path, spec=spec_path,
+                ignored=ignored, deferred=deferred)
+
+
+def _save_acquisitions(ds, imported, defer_aggregation=False):
+    """Save imported acquisitions to `ds` and aggregate their metadata
+
+    This is the serialized stage of importing acquisitions in parallel: a
+    single save and aggregation for all of them.
+
+    Parameters
+    ----------
+    imported: list of tuple
+      acquisition ID and the dict returned by `_import_acquisition`
+
+    Yields
+    ------
+    dict
+      results of failed saves and one for each imported acquisition
+    """
+    if not imported:
+        return
+
+    dicom_paths = [stats['dicom_ds'] for acqid, stats in imported]
+    spec_files = [stats['spec'] for acqid, stats in imported]
+    _ensure_specs_in_git(ds, spec_files)
+    message = "[HIRNI] Add {} acquisitions{}{}".format(
+        len(imported), linesep,
+        linesep.join(" - " + acqid for acqid, stats in imported))
+    failed = set()
+    for r in Save.__call__(dataset=ds,
+                           path=dicom_paths + spec_files +
+                           ['.gitattributes'],
+                           message=message,
+                           return_type='generator',
+                           result_renderer='disabled'):
+        if r.get('status', None) not in ['ok', 'notneeded']:
+            failed.add(r['path'])
+            yield r
+
+    saved = [p for p in dicom_paths if p not in failed]
+    for queue in ('drop', 'gc'):
+        add_pending(ds, [stats['dicom_ds'] for acqid, stats in imported
+                         if stats['dicom_ds'] in saved and
+                         queue in stats['deferred']],
+                    queue=queue)
+    if defer_aggregation:
+        # subdatasets have their own metadata aggregated already
+        add_pending(ds, saved)
+    elif saved:
+        ds.meta_aggregate([with_pathsep(p) for p in saved], into='top')
+
+    for acqid, stats in imported:
+        if stats['dicom_ds'] in failed:
+            continue
+        _record_import(ds, acqid, stats['key'], stats['spec'])
+        seconds = stats['add_seconds'] + stats['extract_seconds']
+        yield dict(
+            status='ok',
+            path=stats['dicom_ds'],
+            type='dataset',
+            action='import DICOM tarball',
+            tarball_size=stats['size'],
+            tarball_mode=stats['mode'],
+            import_stages=stats['stages'],
+            ignored_series=stats['ignored'],
+            add_seconds=stats['add_seconds'],
+            extract_seconds=stats['extract_seconds'],
+            throughput=stats['size'] / seconds
+            if seconds and stats['size'] else None,
+            logger=lgr)
+
+
+@build_doc
+class ImportDicomsBulk(Interface):
+    """Import many DICOM archives into a study raw dataset at once.
+
+    For every archive this does the same as hirni-import-dcm: It creates a
+    subdataset with the extracted DICOM files under ACQUISITION ID/dicoms and
+    derives a study specification from the DICOM metadata. However, the
+    acquisitions are imported in parallel (see --jobs) and all of them are
+    saved to the study dataset in a single commit, followed by a single
+    metadata aggregation.
+
+    Archives can be given as paths, glob patterns or via a manifest file.
+    Acquisition IDs that aren't given in a manifest are derived from the
+    first DICOM header in the archive, based on the configuration
+    `datalad.hirni.import.acquisition-format` (see hirni-import-dcm). If that
+    isn't possible for an archive, it's not imported. Archives that were
+    imported before are skipped, too (see hirni-import-dcm).
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='PATH',
+            doc="""specify the dataset to import the DICOM archives into.  If
+            no dataset is given, an attempt is made to identify the dataset
+            based on the current working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+        path=Parameter(
+            args=("path",),
+            metavar='PATH',
+            doc="""path or glob pattern of the DICOM archives (or
+            directories) to be imported.""",
+            nargs="*",
+            constraints=EnsureStr() | EnsureNone()),
+        manifest=Parameter(
+            args=("--manifest",),
+            metavar="PATH",
+            doc="""file listing the DICOM archives to import. One archive per
+            line, optionally followed by whitespace and the acquisition ID to
+            import it as. Lines starting with '#' are ignored. Relative paths
+            are interpreted relative to the manifest's location.""",
+            constraints=EnsureStr() | EnsureNone()),
+        anon_subject=Parameter(
+            args=("--anon-subject",),
+            metavar="ANON_SUBJECT",
+            doc="""an anonymized subject identifier to store in the
+            specifications of all imported acquisitions.""",
+            constraints=EnsureStr() | EnsureNone()),
+        properties=Parameter(
+            args=("--properties",),
+            metavar="PATH or JSON string",
+            doc="""a JSON string or a path to a JSON file, to provide
+            overrides/additions to the to be created specification snippets of
+            all imported acquisitions.""",
+            constraints=EnsureStr() | EnsureNone()),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of worker processes to import acquisitions in
+            parallel. "auto" corresponds to the number of CPUs. By default,
+            acquisitions are imported one after another""",
+            constraints=EnsureInt() | EnsureNone() | EnsureChoice('auto')),
+        defer_aggregation=Parameter(
+            args=("--defer-aggregation",),
+            action="store_true",
+            doc="""don't aggregate the acquisitions' metadata into the
+            dataset, but record them as pending. Use hirni-aggregate-pending
+            to aggregate all pending acquisitions at once."""),
+    )
+
+    @staticmethod
+    @datasetmethod(name='hirni_import_dcm_bulk')
+    @eval_results
+    def __call__(path=None, dataset=None, manifest=None, anon_subject=None,
+                 properties=None, jobs=None, defer_aggregation=False):
+
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose="import DICOM sessions")
+
+        entries = []
+        for p in assure_list(path):
+            matches = sorted(glob(p)) \
+                if isinstance(RI(p), PathRI) and not op.exists(p) else [p]
+            if not matches:
+                lgr.warning("No DICOM archive matches %s", p)
+            entries.extend((m, None) for m in matches)
+        if manifest:
+            entries.extend(_read_manifest(manifest))
+        if not entries:
+            raise InsufficientArgumentsError(
+                "insufficient arguments for hirni-import-dcm-bulk: no DICOM "
+                "archive to import")
+
+        overrides = dict()
+        if properties:
+            props = json_py.load(properties) \
+                    if op.exists(properties) else json_py.loads(properties)
+            overrides.update({k: dict(value=v, approved=True)
+                              for k, v in props.items()})
+
+        try:
+            mode, dedup = _get_import_modes(ds)
+            drop, gc = _get_cleanup_policies(ds)
+        except ValueError as e:
+            yield dict(status='impossible',
+                       path=ds.path,
+                       type='dataset',
+                       action='import DICOM tarball',
+                       logger=lgr,
+                       message=str(e))
+            return
+        # TODO: Move default to config definition (see hirni-import-dcm)
+        format_string = ds.config.get(
+            "datalad.hirni.import.acquisition-format", default="{PatientID}")
+
+        # determine all acquisitions upfront, so conflicts are detected before
+        # anything is imported:
+        tasks = []
+        acqids = set()
+        for tarball, acqid in entries:
+            res = dict(path=tarball,
+                       type='file',
+                       action='import DICOM tarball',
+                       logger=lgr)
+            existing, known = _check_imported(ds, tarball, dedup=dedup)
+            if existing:
+                yield dict(res, status='notneeded',
+                           acquisitions=existing,
+                           message=("already imported as %s",
+                                    ", ".join(existing)))
+                continue
+            prescanned = False
+            if not acqid:
+                acqid = _prescan_acquisition_id(tarball, format_string)
+                prescanned = acqid is not None
+            if not acqid:
+                yield dict(res, status='impossible',
+                           message="could not derive acquisition ID from "
+                                   "DICOM headers; specify it in a manifest "
+                                   "or use hirni-import-dcm")
+            elif prescanned and op.lexists(op.join(ds.path, acqid)) and \
+                    not _was_started(
+                        Dataset(op.join(ds.path, acqid, 'dicoms')), tarball):
+                # same as hirni-import-dcm
+                yield dict(res, status='impossible',
+                           message=("acquisition %s exists already; specify "
+                                    "it in a manifest to add %s to it",
+                                    acqid, tarball))
+            elif acqid in acqids:
+                # Note: An existing acquisition given in the manifest is fine
+                # (an interrupted import is resumed or the tarball added), but
+                # two tarballs can't be imported into the same acquisition in
+                # parallel.
+                yield dict(res, status='impossible',
+                           message=("acquisition %s is listed more than "
+                                    "once", acqid))
+            else:
+                acqids.add(acqid)
+                tasks.append((tarball, acqid, known))
+
+        import_kwargs = dict(mode=mode, drop=drop, gc=gc,
+                             anon_subject=anon_subject,
+                             extract_jobs=_get_extract_jobs(ds),
+                             overrides=overrides)
+        imported = []
+        n_jobs = min(_get_n_jobs(jobs), len(tasks))
+        if n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [(tarball, acqid,
+                            executor.submit(_import_acquisition, ds.path,
+                                            tarball, acqid,
+                                            known_series=known,
+                                            **import_kwargs))
+                           for tarball, acqid, known in tasks]
+                results = []
+                for tarball, acqid, future in futures:
+                    try:
+                        results.append((tarball, acqid, future.result(),
+                                        None))
+                    except Exception as e:
+                        results.append((tarball, acqid, None, e))
+        else:
+            def _run(tarball, acqid, known):
+                try:
+                    return (tarball, acqid,
+                            _import_acquisition(ds.path, tarball, acqid,
+                                                known_series=known,
+                                                **import_kwargs), None)
+                except Exception as e:
+                    return tarball, acqid, None, e
+            results = (_run(*task) for task in tasks)
+
+        for tarball, acqid, stats, error in results:
+            if error is not None:
+                yield dict(status='error',
+                           path=tarball,
+                           type='file',
+                           action='import DICOM tarball',
+                           message=("failed to import as %s: %s",
+                                    acqid, exc_str(error)),
+                           logger=lgr)
+                continue
+            imported.append((acqid, stats))
+
+        for r in _save_acquisitions(ds, imported,
+                                    defer_aggregation=defer_aggregation):
+            yield r
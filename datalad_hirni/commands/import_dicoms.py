@@ -1,13 +1,16 @@
 """Import a DICOM tarball into a study dataset"""
 
+import os
 from os import listdir
 from os import makedirs
 from os import rename
 import os.path as op
 import shutil
+import time
 from datalad.consts import ARCHIVES_SPECIAL_REMOTE
 from datalad.consts import DATALAD_SPECIAL_REMOTES_UUIDS
 from datalad.interface.base import build_doc, Interface
+from datalad.support import json_py
 from datalad.support.constraints import EnsureStr
 from datalad.support.constraints import EnsureNone
 from datalad.support.constraints import EnsureKeyChoice
@@ -23,6 +26,23 @@ from datalad.utils import (
     with_pathsep
 )
 from datalad.dochelpers import exc_str
+from datalad.support.exceptions import CommandError
+
+from datalad_hirni.support.annex_helpers import (
+    _annex_key,
+    _extract_archive,
+    _get_backend,
+    _get_hash_name,
+    _get_key_size,
+    _import_directory,
+    _put_with_hash,
+)
+from datalad_hirni.support.import_index import (
+    add_to_index,
+    find_archive,
+    find_series,
+)
+from datalad_hirni.support.pending_aggregation import add_pending
 
 # bound dataset method
 import datalad_hirni.commands.dicom2spec
@@ -34,85 +54,675 @@ import logging
 lgr = logging.getLogger('datalad.hirni.import_dicoms')
 
 
-# TODO: Commit-Message to contain hint on the imported tarball
-def _import_dicom_tarball(target_ds, tarball, filename):
-
-    current_user_branch = target_ds.repo.get_active_branch()
-    # # TODO: doesn't work for updates yet:
-    # # - branches are expected to not exist yet
-    target_ds.repo.checkout('incoming', options=['-b'])
-    target_ds.repo.init_remote(
-        ARCHIVES_SPECIAL_REMOTE,
-        options=['encryption=none', 'type=external',
-                 'externaltype=%s' % ARCHIVES_SPECIAL_REMOTE,
-                 'autoenable=true',
-                 'uuid={}'.format(
-                     DATALAD_SPECIAL_REMOTES_UUIDS[ARCHIVES_SPECIAL_REMOTE])
-                 ])
-
-    if isinstance(RI(tarball), PathRI):
-        shutil.copy2(tarball, op.join(target_ds.path, filename))
-        target_ds.repo.add(filename)
-
+def _add_local_tarball(repo, tarball, filename, mode='auto'):
+    """Get a local tarball into the annex reading it only once
+
+    Rather than copying the tarball into the worktree and letting git-annex
+    read it again in order to compute its key, the key is computed while the
+    tarball is put into the annex' temp directory (on the same filesystem as
+    the object store). The content is then moved into the object store via
+    `git annex setkey`.
+
+    Returns
+    -------
+    str
+      mode actually used; 'add' if we had to fall back to plain `annex add`
+    """
+    backend = _get_backend(repo, filename)
+    hash_name = _get_hash_name(backend)
+    if mode == 'add' or hash_name is None:
+        # fall back to what git-annex does on its own
+        shutil.copy2(tarball, op.join(repo.path, filename))
+        repo.add(filename)
+        return 'add'
+
+    tmp_dir = op.join(str(repo.dot_git), 'annex', 'tmp')
+    makedirs(tmp_dir, exist_ok=True)
+    tmp_file = op.join(tmp_dir, 'hirni-import-' + filename)
+    try:
+        digest, used_mode = _put_with_hash(tarball, tmp_file, hash_name,
+                                           mode=mode)
+        key = _annex_key(backend, digest, op.getsize(tmp_file), filename)
+        repo.call_annex(['setkey', key, tmp_file])
+        repo.call_annex(['fromkey', key, filename])
+    except (OSError, CommandError) as e:
+        if mode != 'auto':
+            raise
+        lgr.warning("Failed to stream %s into the annex (%s). "
+                    "Falling back to a regular copy.", tarball, exc_str(e))
+        if op.lexists(tmp_file):
+            os.unlink(tmp_file)
+        return _add_local_tarball(repo, tarball, filename, mode='add')
+    return used_mode
+
+
+def _get_archive_key(repo, branch, filename):
+    """Annex key of `filename` in `branch` or None if it isn't there"""
+    if not repo.call_git_success(['cat-file', '-e',
+                                  '{}:{}'.format(branch, filename)]):
+        return None
+    # symlink target or pointer file; both end in the key:
+    return op.basename(repo.call_git_oneline(
+        ['cat-file', '-p', '{}:{}'.format(branch, filename)]))
+
+
+def _is_extracted(repo, key, trailer='hirni-archive-key'):
+    """Whether the archive with `key` was extracted into incoming-processed
+
+    With `trailer` 'hirni-source-directory', `key` is the path of an imported
+    directory instead.
+    """
+    if 'incoming-processed' not in repo.get_branches():
+        return False
+    return bool(repo.call_git(
+        ['log', 'incoming-processed', '--format=%H', '-1',
+         '--fixed-strings', '--grep', '{}: {}'.format(trailer, key)]
+    ).strip())
+
+
+def _was_started(dicom_ds, path):
+    """Whether an import of `path` into `dicom_ds` was started before, so it
+    can be resumed"""
+    if not dicom_ds.is_installed():
+        return False
+    if op.isdir(path):
+        return _is_extracted(dicom_ds.repo, op.realpath(path),
+                             trailer='hirni-source-directory')
+    return _get_archive_key(dicom_ds.repo, 'incoming',
+                            op.basename(path)) is not None
+
+
+def _begin_import(repo):
+    """Get `repo` ready for an import and return the branch to merge into
+
+    A dataset left on one of the import branches by an interrupted import is
+    reset and the branch the import started from is returned. If that branch
+    wasn't recorded, the only other branch or the default branch is returned.
+
+    Raises
+    ------
+    ValueError
+      if there's no branch to return to
+    """
+    current_user_branch = repo.get_active_branch()
+    if current_user_branch in ('incoming', 'incoming-processed'):
+        # an earlier import died half-way; throw away uncommitted leftovers
+        lgr.info("Resuming interrupted import into %s", repo.path)
+        repo.call_git(['reset', '--hard'])
+        repo.call_git(['clean', '-fd'])
+        current_user_branch = repo.config.get('datalad.hirni.import.branch',
+                                              None)
+        if current_user_branch is None:
+            branches = [b for b in repo.get_branches()
+                        if b not in ('incoming', 'incoming-processed',
+                                     'git-annex')]
+            default = repo.config.get('init.defaultbranch', 'master')
+            if len(branches) == 1:
+                current_user_branch = branches[0]
+            elif default in branches:
+                current_user_branch = default
+            else:
+                raise ValueError(
+                    "don't know which branch to resume the import into; "
+                    "set datalad.hirni.import.branch in {}".format(repo.path))
+            lgr.warning("Branch of interrupted import into %s unknown. "
+                        "Using %s", repo.path, current_user_branch)
     else:
-        target_ds.repo.add_url_to_file(file_=filename, url=tarball, batch=False)
-
-    target_ds.repo.commit(msg="Retrieved %s" % tarball)
-    target_ds.repo.checkout('incoming-processed', options=['--orphan'])
-    if target_ds.repo.dirty:
-        target_ds.repo.remove('.', r=True, f=True)
-
-    target_ds.repo.merge('incoming', options=["-s", "ours", "--no-commit"],
-                         expect_stderr=True)
-    target_ds.repo.call_git(["read-tree", "-m", "-u", "incoming"])
-
-    from datalad.coreapi import add_archive_content
-    # # TODO: Reconsider value of --existing
-    add_archive_content(archive=filename,
-                        annex=target_ds.repo,
-                        existing='archive-suffix',
-                        delete=True,
-                        commit=False,
-                        allow_dirty=True)
-
-    target_ds.repo.commit(msg="Extracted %s" % tarball)
-    target_ds.repo.checkout(current_user_branch)
-    target_ds.repo.merge('incoming-processed', options=["--allow-unrelated"])
+        # remember where to return to, in case we get interrupted
+        repo.config.set('datalad.hirni.import.branch', current_user_branch,
+                        where='local')
+    return current_user_branch
+
+
+def _merge_import(repo, branch, stages):
+    """Merge incoming-processed into `branch`, unless it's there already"""
+    repo.checkout(branch)
+    if not repo.is_ancestor('incoming-processed', branch):
+        repo.merge('incoming-processed', options=["--allow-unrelated"])
+        stages.append('merge')
+
+
+def _import_dicom_tarball(target_ds, tarball, filename, mode='auto',
+                          extract_jobs=None):
+    """Import a tarball into `target_ds` and extract it
+
+    The import consists of checkpointed stages, whose state is detected from
+    the branches involved:
+
+    - 'retrieve': the tarball is committed to the `incoming` branch
+    - 'extract': its content is committed to the `incoming-processed` branch,
+      with the key of the tarball recorded in the commit message
+    - 'merge': `incoming-processed` is merged into the user's branch
+
+    Rerunning an interrupted import continues with the first incomplete
+    stage. Importing another tarball into an existing dataset adds it to
+    `incoming` and its extracted content to `incoming-processed`.
+
+    With `extract_jobs`, the tarball is extracted by `_extract_archive`
+    using that many `git annex add` jobs, rather than by datalad's
+    add_archive_content.
+
+    Returns
+    -------
+    dict
+      statistics of the import: size of the tarball, seconds spent, the mode
+      used to get the tarball into the annex (see `_add_local_tarball`) and
+      the stages done in this run
+    """
+
+    repo = target_ds.repo
+    branches = repo.get_branches()
+    current_user_branch = _begin_import(repo)
+
+    if 'incoming' in branches:
+        repo.checkout('incoming')
+    else:
+        repo.checkout('incoming', options=['-b'])
+    if DATALAD_SPECIAL_REMOTES_UUIDS[ARCHIVES_SPECIAL_REMOTE] not in \
+            repo.get_special_remotes():
+        repo.init_remote(
+            ARCHIVES_SPECIAL_REMOTE,
+            options=['encryption=none', 'type=external',
+                     'externaltype=%s' % ARCHIVES_SPECIAL_REMOTE,
+                     'autoenable=true',
+                     'uuid={}'.format(
+                         DATALAD_SPECIAL_REMOTES_UUIDS[ARCHIVES_SPECIAL_REMOTE])
+                     ])
+
+    stages = []
+    start = time.perf_counter()
+    key = _get_archive_key(repo, 'incoming', filename)
+    used_mode = None
+    local = isinstance(RI(tarball), PathRI)
+    # Note: Without rehashing the tarball, its size is what we can compare
+    # the committed one with to tell whether it's the same.
+    if key is None or (local and '-s{}--'.format(op.getsize(tarball))
+                       not in key):
+        if local:
+            used_mode = _add_local_tarball(repo, tarball, filename,
+                                           mode=mode)
+        else:
+            repo.add_url_to_file(file_=filename, url=tarball, batch=False)
+            used_mode = 'url'
+        repo.commit(msg="Retrieved %s" % tarball)
+        key = _get_archive_key(repo, 'incoming', filename)
+        stages.append('retrieve')
+    size = _get_key_size(key)
+    added = time.perf_counter()
+
+    if not _is_extracted(repo, key):
+        if 'incoming-processed' in repo.get_branches():
+            repo.checkout('incoming-processed')
+            repo.merge('incoming', options=["-s", "ours", "--no-commit"],
+                       expect_stderr=True)
+            # bring in the new tarball only; previously extracted content
+            # stays as is
+            repo.call_git(['checkout', 'incoming', '--', filename])
+        else:
+            repo.checkout('incoming-processed', options=['--orphan'])
+            if repo.dirty:
+                repo.remove('.', r=True, f=True)
 
+            repo.merge('incoming', options=["-s", "ours", "--no-commit"],
+                       expect_stderr=True)
+            repo.call_git(["read-tree", "-m", "-u", "incoming"])
 
-def _create_subds_from_tarball(tarball, targetdir):
+        done = False
+        if extract_jobs and not repo.is_managed_branch():
+            try:
+                n_files = _extract_archive(repo, filename, key,
+                                           jobs=extract_jobs)
+                lgr.debug("Extracted %d files from %s", n_files, tarball)
+                done = True
+            except ValueError as e:
+                lgr.debug("Can't extract %s in parallel: %s", tarball,
+                          exc_str(e))
+        if not done:
+            from datalad.coreapi import add_archive_content
+            # Note: The archive is extracted in a single pass into datalad's
+            # archive cache, from where the content is annexed.
+            # # TODO: Reconsider value of --existing
+            add_archive_content(archive=filename,
+                                annex=repo,
+                                existing='archive-suffix',
+                                delete=True,
+                                commit=False,
+                                allow_dirty=True)
+
+        repo.commit(msg="Extracted {}\n\nhirni-archive-key: {}"
+                        "".format(tarball, key))
+        stages.append('extract')
+
+    _merge_import(repo, current_user_branch, stages)
+    extracted = time.perf_counter()
+
+    return dict(size=size,
+                key=key,
+                mode=used_mode,
+                stages=stages,
+                add_seconds=added - start,
+                extract_seconds=extracted - added)
+
+
+def _import_dicom_directory(target_ds, directory, mode='auto',
+                            extract_jobs=None):
+    """Import a directory of DICOM files into `target_ds`
+
+    The files are annexed in the `incoming-processed` branch underneath the
+    directory's name, which is merged into the user's branch afterwards (see
+    `_import_dicom_tarball`). There's no archive and therefore nothing in
+    `incoming`. Within a filesystem, the content is reflinked or hard linked
+    into the annex according to `mode` (see `_add_local_tarball`).
+
+    Returns
+    -------
+    dict
+      statistics of the import like `_import_dicom_tarball`
+    """
+
+    repo = target_ds.repo
+    current_user_branch = _begin_import(repo)
+    source = op.realpath(directory)
+
+    stages = []
+    start = time.perf_counter()
+    used_mode = None
+    size = None
+    if not _is_extracted(repo, source, trailer='hirni-source-directory'):
+        if 'incoming-processed' in repo.get_branches():
+            repo.checkout('incoming-processed')
+        else:
+            repo.checkout('incoming-processed', options=['--orphan'])
+            if repo.dirty:
+                repo.remove('.', r=True, f=True)
+        try:
+            n_files, size, used_mode = _import_directory(
+                repo, directory, mode='copy' if mode == 'add' else mode,
+                jobs=extract_jobs or 1)
+            lgr.debug("Imported %d files from %s", n_files, directory)
+        except ValueError as e:
+            if mode not in ('auto', 'add'):
+                raise
+            lgr.debug("Can't link %s into the annex: %s", directory,
+                      exc_str(e))
+            name = op.basename(source)
+            shutil.copytree(directory, op.join(repo.path, name))
+            repo.add(name)
+            used_mode = 'add'
+        repo.commit(msg="Imported {}\n\nhirni-source-directory: {}"
+                        "".format(directory, source))
+        stages.append('import')
+    added = time.perf_counter()
+
+    _merge_import(repo, current_user_branch, stages)
+    merged = time.perf_counter()
+
+    return dict(size=size,
+                key=None,
+                mode=used_mode,
+                stages=stages,
+                add_seconds=added - start,
+                extract_seconds=merged - added)
+
+
+def _create_subds_from_tarball(tarball, targetdir, mode='auto',
+                               extract_jobs=None):
 
     filename = op.basename(tarball)
 
-    importds = Dataset(op.join(targetdir, "dicoms")).create(
-        return_type='item-or-list',
-        result_xfm='datasets',
-        result_filter=EnsureKeyChoice('action', ('create',)) \
-        & EnsureKeyChoice('status', ('ok', 'notneeded'))
-    )
+    importds = Dataset(op.join(targetdir, "dicoms"))
+    if not importds.is_installed():
+        importds = importds.create(
+            return_type='item-or-list',
+            result_xfm='datasets',
+            result_filter=EnsureKeyChoice('action', ('create',)) \
+            & EnsureKeyChoice('status', ('ok', 'notneeded'))
+        )
+    # else: resume an interrupted import or add another tarball
 
-    _import_dicom_tarball(importds, tarball, filename)
+    if op.isdir(tarball):
+        stats = _import_dicom_directory(importds, tarball, mode=mode,
+                                        extract_jobs=extract_jobs)
+    else:
+        stats = _import_dicom_tarball(importds, tarball, filename, mode=mode,
+                                      extract_jobs=extract_jobs)
 
-    importds.config.add(
+    # Note: `set` rather than `add`, so a rerun doesn't duplicate the values
+    importds.config.set(
         var="datalad.metadata.nativetype",
         value="dicom",
         where="dataset"
     )
-    importds.config.add(
+    importds.config.set(
         var="datalad.metadata.aggregate-content-dicom",
         value='false',
         where="dataset")
     # TODO: file an issue: config.add can't convert False to 'false' on its own
     # (But vice versa while reading IIRC)
 
-    importds.config.add(
+    importds.config.set(
         var="datalad.metadata.maxfieldsize",
         value='10000000',
         where="dataset")
+    # Note: nothing to save, if the config was there already
     importds.save(op.join(".datalad", "config"),
                   message="[HIRNI] initial config for DICOM metadata")
 
-    return importds
+    return importds, stats
+
+
+def _get_extract_jobs(ds):
+    """Number of processes to extract tarballs with as configured for `ds`
+
+    None means to use datalad's add_archive_content.
+    """
+    from datalad_hirni.commands.dicom2spec import _get_n_jobs
+    jobs = ds.config.get("datalad.hirni.import.extract-jobs", None)
+    if jobs is None:
+        return None
+    return _get_n_jobs(jobs if jobs == 'auto' else int(jobs))
+
+
+def _get_import_modes(ds):
+    """Return how to get tarballs into the annex and how to detect imports
+    done before
+
+    Returns
+    -------
+    tuple
+      the values of `datalad.hirni.import.tarball-mode` and
+      `datalad.hirni.import.dedup`
+
+    Raises
+    ------
+    ValueError
+      for invalid values
+    """
+    mode = ds.config.get("datalad.hirni.import.tarball-mode", "auto")
+    dedup = ds.config.get("datalad.hirni.import.dedup", "archive")
+    if mode not in ('auto', 'reflink', 'hardlink', 'copy', 'add'):
+        raise ValueError(
+            "invalid datalad.hirni.import.tarball-mode: {}".format(mode))
+    if dedup not in ('archive', 'series', 'off'):
+        raise ValueError("invalid datalad.hirni.import.dedup: {}".format(
+            dedup))
+    return mode, dedup
+
+
+def _get_cleanup_policies(ds):
+    """Return when to drop extracted DICOM files and to gc imported datasets
+
+    Returns
+    -------
+    tuple
+      the values of `datalad.hirni.import.drop` ('import', 'convert' or
+      'never') and `datalad.hirni.import.gc` ('import' or 'deferred')
+
+    Raises
+    ------
+    ValueError
+      for invalid values
+    """
+    drop = ds.config.get("datalad.hirni.import.drop", "import")
+    gc = ds.config.get("datalad.hirni.import.gc", "import")
+    if drop not in ('import', 'convert', 'never'):
+        raise ValueError("invalid datalad.hirni.import.drop: {}".format(drop))
+    if gc not in ('import', 'deferred'):
+        raise ValueError("invalid datalad.hirni.import.gc: {}".format(gc))
+    return drop, gc
+
+
+def _drop_extracted(dicom_ds, **kwargs):
+    """Drop the extracted DICOM files of an imported dataset
+
+    They remain available from the archive they were extracted from.
+    """
+    return dicom_ds.drop([f for f in listdir(dicom_ds.path)
+                          if f != ".datalad" and f != ".git"], **kwargs)
+
+
+def _cleanup_imported(dicom_ds, drop='import', gc='import'):
+    """Drop extracted files and gc an imported dataset as configured
+
+    Returns
+    -------
+    list of str
+      queues (see `add_pending`) to add the dataset to for what was deferred
+    """
+    deferred = []
+    if drop == 'import':
+        _drop_extracted(dicom_ds)
+    elif drop == 'convert':
+        # keep the content for hirni-spec2bids
+        deferred.append('drop')
+    if gc == 'import':
+        dicom_ds.repo.call_git(['gc'])
+    else:
+        deferred.append('gc')
+    return deferred
+
+
+def _header2dict(header):
+    """Turn a pydicom dataset into a dict of (top-level, non-binary) fields"""
+    from pydicom.multival import MultiValue
+    result = dict()
+    for elem in header:
+        if not elem.keyword or elem.VR in ('SQ', 'OB', 'OW', 'OF', 'UN'):
+            continue
+        value = elem.value
+        if isinstance(value, bytes):
+            continue
+        if isinstance(value, MultiValue):
+            value = list(value)
+        elif not isinstance(value, (int, float)):
+            value = str(value)
+        result[elem.keyword] = value
+    return result
+
+
+def _read_dicom_header(f, size, name, head_size):
+    """Read the header of DICOM file object `f` of `size` bytes or None"""
+    from io import BytesIO
+    from pydicom import dcmread
+    from pydicom.errors import InvalidDicomError
+
+    content = f.read(head_size)
+    complete = len(content) >= size
+    while True:
+        try:
+            header = dcmread(BytesIO(content), stop_before_pixels=True)
+        except Exception as e:
+            header = None
+            if complete and not isinstance(e, InvalidDicomError):
+                lgr.debug("Failed to read DICOM header from %s: %s",
+                          name, exc_str(e))
+        if header is not None and \
+                ('SOPClassUID' in header or 'PatientID' in header):
+            return header
+        if complete or content[128:132] != b'DICM':
+            # not a DICOM image; don't read large non-DICOM files
+            return None
+        # header didn't fit; read the entire file
+        content += f.read()
+        complete = True
+
+
+def _iter_dicom_headers(tarball, head_size=1024 * 1024):
+    """Stream through a tarball and yield the headers of its DICOM files
+
+    `tarball` may be a directory as well, which is walked in sorted order.
+    Only the first `head_size` bytes of a file are read, unless the header
+    doesn't fit in. Pixel data is never parsed.
+
+    Yields
+    ------
+    pydicom.dataset.FileDataset
+    """
+    import tarfile
+
+    if op.isdir(tarball):
+        for root, dirs, files in os.walk(tarball):
+            dirs.sort()
+            for name in sorted(files):
+                path = op.join(root, name)
+                if name.upper() == 'DICOMDIR' or op.islink(path):
+                    continue
+                with open(path, 'rb') as f:
+                    header = _read_dicom_header(f, op.getsize(path), path,
+                                                head_size)
+                if header is not None:
+                    yield header
+        return
+
+    # Note: '|' opens the archive as a stream; it's read sequentially once
+    # and only as far as the consumer asks for
+    with tarfile.open(tarball, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile() or \
+                    op.basename(member.name).upper() == 'DICOMDIR':
+                continue
+            header = _read_dicom_header(
+                tar.extractfile(member), member.size,
+                "{} in {}".format(member.name, tarball), head_size)
+            if header is not None:
+                yield header
+
+
+def _read_first_dicom_header(tarball, head_size=1024 * 1024):
+    """Return the header of the first DICOM file in a tarball (or directory)
+
+    Returns
+    -------
+    dict or None
+    """
+    for header in _iter_dicom_headers(tarball, head_size=head_size):
+        return _header2dict(header)
+    return None
+
+
+def _scan_series_uids(tarball):
+    """Return the SeriesInstanceUIDs of all DICOM files in a tarball (or
+    directory)
+
+    This reads the entire tarball once, but doesn't write anything.
+
+    Returns
+    -------
+    set of str
+    """
+    return set(str(header.SeriesInstanceUID)
+               for header in _iter_dicom_headers(tarball)
+               if 'SeriesInstanceUID' in header)
+
+
+def _prescan_acquisition_id(tarball, format_string):
+    """Derive the acquisition ID from the first DICOM header in a tarball
+
+    This is much cheaper than importing the tarball, aggregating and querying
+    its metadata, but only looks at the first DICOM file in the archive
+    instead of the first image series datalad's DICOM extractor reports.
+    Those may differ for fields, that aren't the same for all series.
+
+    Returns
+    -------
+    str or None
+      None if no acquisition ID could be derived
+    """
+    if '{' not in format_string:
+        return format_string
+    if not isinstance(RI(tarball), PathRI):
+        return None
+    try:
+        header = _read_first_dicom_header(tarball)
+    except Exception as e:
+        lgr.debug("Pre-scan of %s failed: %s", tarball, exc_str(e))
+        return None
+    if header is None:
+        lgr.debug("Pre-scan found no DICOM file in %s", tarball)
+        return None
+    try:
+        return format_string.format(**header)
+    except (KeyError, IndexError, ValueError) as e:
+        lgr.debug("Pre-scan of %s couldn't format acquisition ID: %s",
+                  tarball, exc_str(e))
+        return None
+
+
+def _check_imported(ds, tarball, dedup='archive'):
+    """Look up a tarball in the import index of `ds`
+
+    With `dedup` 'archive' only the tarball itself is looked up. With
+    'series' the SeriesInstanceUIDs of its DICOM files are looked up, too.
+    Nothing is looked up for tarballs that aren't local files. For
+    directories only the series are looked up.
+
+    Returns
+    -------
+    tuple
+      list of the acquisitions the tarball's content was imported into
+      already (empty, if there's something new in it) and a dict mapping the
+      SeriesInstanceUIDs of its series that were imported before to their
+      acquisition
+    """
+    if dedup == 'off' or not isinstance(RI(tarball), PathRI):
+        return [], dict()
+    existing = None if op.isdir(tarball) else find_archive(ds, tarball)
+    if existing:
+        return [existing], dict()
+    if dedup != 'series':
+        return [], dict()
+    try:
+        uids = _scan_series_uids(tarball)
+    except Exception as e:
+        lgr.debug("Failed to scan series of %s: %s", tarball, exc_str(e))
+        return [], dict()
+    known = find_series(ds, uids)
+    if uids and len(known) == len(uids):
+        return sorted(set(known.values())), known
+    return [], known
+
+
+def _spec_series_uids(spec_file):
+    """SeriesInstanceUIDs of the image series in a specification file"""
+    if not op.exists(spec_file):
+        return []
+    return [s['uid'] for s in json_py.load_stream(spec_file)
+            if s.get('type') == 'dicomseries' and s.get('uid')]
+
+
+def _ignore_known_series(spec_file, known, acqid):
+    """Tag series imported into other acquisitions before to be ignored
+
+    Returns
+    -------
+    list of str
+      SeriesInstanceUIDs of the newly tagged series
+    """
+    known = {uid: acq for uid, acq in known.items() if acq != acqid}
+    if not known or not op.exists(spec_file):
+        return []
+    spec = list(json_py.load_stream(spec_file))
+    tagged = []
+    for snippet in spec:
+        if snippet.get('type') != 'dicomseries' or \
+                snippet.get('uid') not in known:
+            continue
+        tags = snippet.setdefault('tags', [])
+        if 'hirni-dicom-converter-ignore' not in tags:
+            lgr.debug("Ignore series %s for conversion (imported into %s "
+                      "already)", snippet['uid'], known[snippet['uid']])
+            tags.append('hirni-dicom-converter-ignore')
+            tagged.append(snippet['uid'])
+    if tagged:
+        json_py.dump2stream(spec, spec_file)
+    return tagged
+
+
+def _record_import(ds, acqid, archive_key, spec_file):
+    """Add an imported tarball and its series to the import index"""
+    add_to_index(ds, acqid,
+                 archive_keys=[archive_key] if archive_key else None,
+                 series_uids=_spec_series_uids(spec_file))
 
 
 def _guess_acquisition_and_move(ds, target_ds):
@@ -158,7 +768,19 @@ class ImportDicoms(Interface):
     the metadata in DICOM headers. The specification is written to AQUISTION ID/studyspec.json by default.
     To this end after the creation of the subdataset and the extraction of DICOM metadata, hirni-dicom2spec is called internally.
     Therefore whatever you configure regarding dicom2spec applies here as well. Please refer to hirni-dicom2spec's documentation
-    on how to configure the deduction from DICOM metadata to a study specification."""
+    on how to configure the deduction from DICOM metadata to a study specification.
+
+    If an import was interrupted, running the same command again continues where it stopped. Importing another archive
+    into an existing acquisition, that is given explicitly, adds its content to that acquisition's DICOM dataset. An
+    acquisition ID derived from DICOM metadata must not exist yet.
+
+    Instead of an archive, a directory of DICOM files can be imported. Its files are added to the DICOM dataset
+    underneath the directory's name without being copied, if the filesystem allows for that (see the configuration
+    `datalad.hirni.import.tarball-mode`).
+
+    Archives and image series that were imported are recorded in an index. An archive that was imported before (even
+    under a different name) is not imported again, but reported as 'notneeded' with the acquisition it was imported
+    into. See the configuration `datalad.hirni.import.dedup` for detecting image series imported before."""
 
     _params_ = dict(
         dataset=Parameter(
@@ -171,7 +793,8 @@ class ImportDicoms(Interface):
         path=Parameter(
             args=("path",),
             metavar='PATH',
-            doc="""path or URL of the dicom archive to be imported.""",
+            doc="""path or URL of the dicom archive to be imported. This can
+            also be the path of a directory containing DICOM files.""",
             constraints=EnsureStr()),
         acqid=Parameter(
             args=("acqid",),
@@ -203,34 +826,104 @@ class ImportDicoms(Interface):
             overrides/additions to the to be created specification snippets for this acquisition.
             """,
             constraints=EnsureStr() | EnsureNone()),
-
+        defer_aggregation=Parameter(
+            args=("--defer-aggregation",),
+            action="store_true",
+            doc="""don't aggregate the acquisition's metadata into the
+            dataset, but record it as pending. Use hirni-aggregate-pending to
+            aggregate all pending acquisitions at once. Until then, the
+            metadata is read from the acquisition's DICOM dataset itself."""),
     )
 
     @staticmethod
     @datasetmethod(name='hirni_import_dcm')
     @eval_results
     def __call__(path, acqid=None, dataset=None,
-                 subject=None, anon_subject=None, properties=None):
+                 subject=None, anon_subject=None, properties=None,
+                 defer_aggregation=False):
         ds = require_dataset(dataset, check_installed=True,
                              purpose="import DICOM session")
+        try:
+            mode, dedup = _get_import_modes(ds)
+            drop, gc = _get_cleanup_policies(ds)
+        except ValueError as e:
+            yield dict(status='impossible',
+                       path=path,
+                       type='file',
+                       action='import DICOM tarball',
+                       logger=lgr,
+                       message=str(e))
+            return
+        existing, known_series = _check_imported(ds, path, dedup=dedup)
+        if existing:
+            yield dict(status='notneeded',
+                       path=path,
+                       type='file',
+                       action='import DICOM tarball',
+                       acquisitions=existing,
+                       logger=lgr,
+                       message=("already imported as %s",
+                                ", ".join(existing)))
+            return
+        extract_jobs = _get_extract_jobs(ds)
+        from datalad.config import anything2bool
+        prescanned = False
+        if not acqid and anything2bool(
+                ds.config.get("datalad.hirni.import.prescan", True)):
+            # TODO: Move default to config definition (see
+            # _guess_acquisition_and_move)
+            acqid = _prescan_acquisition_id(
+                path,
+                ds.config.get("datalad.hirni.import.acquisition-format",
+                              default="{PatientID}"))
+            lgr.debug("Acquisition ID from pre-scan of %s: %s", path, acqid)
+            prescanned = acqid is not None
+
         if acqid:
             # acquisition was specified => we know where to create subds
             acq_dir = op.join(ds.path, acqid)
+            if prescanned and op.lexists(acq_dir) and not _was_started(
+                    Dataset(op.join(acq_dir, 'dicoms')), path):
+                # only add to an existing acquisition, if we were told to
+                yield dict(status='impossible',
+                           path=acq_dir,
+                           type='file',
+                           action='import DICOM tarball',
+                           logger=lgr,
+                           message=("acquisition %s exists already; specify "
+                                    "it to add %s to it", acqid, path))
+                return
             if not op.exists(acq_dir):
                 makedirs(acq_dir)
-            # TODO: if exists: needs to be empty?
-
-            dicom_ds = _create_subds_from_tarball(path, acq_dir)
+            # Note: If the acquisition exists already, an interrupted import
+            # is resumed or the tarball is added to the acquisition.
 
         else:
             # we don't know the acquisition id yet => create in tmp
 
             acq_dir = op.join(ds.path, '.git', 'datalad', 'hirni_import')
-            assert not op.exists(acq_dir)
-            # TODO: don't assert; check and adapt instead
-
+            if _was_started(Dataset(op.join(acq_dir, 'dicoms')), path):
+                lgr.info("Resuming interrupted import of %s", path)
+            elif op.exists(acq_dir):
+                # leftover of another import; can't be of use
+                rmtree(acq_dir)
+            # Note: The temporary dataset is kept if the import fails, so a
+            # rerun can resume it.
+
+        try:
+            dicom_ds, stats = _create_subds_from_tarball(
+                path, acq_dir, mode=mode, extract_jobs=extract_jobs)
+        except ValueError as e:
+            yield dict(status='impossible',
+                       path=path,
+                       type='file',
+                       action='import DICOM tarball',
+                       logger=lgr,
+                       message=exc_str(e))
+            return
+
+        if not acqid:
             try:
-                dicom_ds = _create_subds_from_tarball(path, acq_dir)
                 dicom_ds = _guess_acquisition_and_move(dicom_ds, ds)
             except OSError as e:
                 # TODO: Was FileExistsError. Find more accurate PY2/3 solution
@@ -241,45 +934,66 @@ class ImportDicoms(Interface):
                            action='import DICOM tarball',
                            logger=lgr,
                            message=exc_str(e))
+                lgr.debug("Killing temp dataset at %s ...", acq_dir)
                 rmtree(acq_dir)
                 return  # we can't do anything
-            finally:
-                if op.exists(acq_dir):
-                    lgr.debug("Killing temp dataset at %s ...", acq_dir)
-                    rmtree(acq_dir)
 
         acqid = op.basename(op.dirname(dicom_ds.path))
+        if defer_aggregation:
+            # aggregate into the subdataset only, so dicom2spec can read it
+            # from there. Note, that this commits to the subdataset and
+            # therefore needs to happen before saving it:
+            dicom_ds.meta_aggregate()
         ds.save(
             dicom_ds.path,
             message="[HIRNI] Add aquisition {}".format(acqid)
         )
 
-        # Note: use path with trailing slash to indicate we want metadata about the content of this subds,
-        # not the subds itself.
-        ds.meta_aggregate(with_pathsep(dicom_ds.path), into='top')
+        if defer_aggregation:
+            add_pending(ds, [dicom_ds.path])
+        else:
+            # Note: use path with trailing slash to indicate we want metadata about the content of this subds,
+            # not the subds itself.
+            ds.meta_aggregate(with_pathsep(dicom_ds.path), into='top')
 
+        spec_file = op.normpath(op.join(
+            dicom_ds.path, op.pardir, "studyspec.json"))
         ds.hirni_dicom2spec(
             path=dicom_ds.path,
-            spec=op.normpath(op.join(
-                dicom_ds.path, op.pardir, "studyspec.json")),
+            spec=spec_file,
             subject=subject,
             anon_subject=anon_subject,
             acquisition=acqid,
             properties=properties
         )
-
-        # TODO: This should probably be optional
-        # We have the tarball and can drop extracted stuff:
-        dicom_ds.drop([f for f in listdir(dicom_ds.path)
-                       if f != ".datalad" and f != ".git"])
-
-        # finally clean up git objects:
-        dicom_ds.repo.call_git(['gc'])
+        ignored = _ignore_known_series(spec_file, known_series, acqid)
+        if ignored:
+            ds.save(spec_file,
+                    message="[HIRNI] Ignore {} series of {} imported before"
+                            "".format(len(ignored), acqid))
+
+        # We have the tarball and can drop extracted stuff and clean up git
+        # objects (now or later):
+        for queue in _cleanup_imported(dicom_ds, drop=drop, gc=gc):
+            add_pending(ds, [dicom_ds.path], queue=queue)
+        # Note: Recorded last, since the steps above aren't checkpointed.
+        # Until the import is recorded, a rerun does them again.
+        _record_import(ds, acqid, stats['key'], spec_file)
 
         # TODO: yield error results etc.
+        seconds = stats['add_seconds'] + stats['extract_seconds']
         yield dict(
             status='ok',
             path=dicom_ds.path,
             type='dataset',
             action='import DICOM tarball',
+            tarball_size=stats['size'],
+            tarball_mode=stats['mode'],
+            import_stages=stats['stages'],
+            ignored_series=ignored,
+            add_seconds=stats['add_seconds'],
+            extract_seconds=stats['extract_seconds'],
+            # bytes per second:
+            throughput=stats['size'] / seconds
+            if seconds and stats['size'] else None,
             logger=lgr)
@@ -0,0 +1,362 @@
+"""Continuously import DICOM archives dropped into a directory"""
+
+import os
+import os.path as op
+import time
+
+from datalad.distribution.dataset import EnsureDataset
+from datalad.distribution.dataset import datasetmethod
+from datalad.distribution.dataset import require_dataset
+from datalad.dochelpers import exc_str
+from datalad.interface.base import Interface
+from datalad.interface.base import build_doc
+from datalad.interface.utils import eval_results
+from datalad.support.constraints import EnsureChoice
+from datalad.support.constraints import EnsureInt
+from datalad.support.constraints import EnsureNone
+from datalad.support.constraints import EnsureStr
+from datalad.support.param import Parameter
+
+from datalad_hirni.commands.dicom2spec import _get_n_jobs
+from datalad_hirni.commands.import_bulk import (
+    _import_acquisition,
+    _save_acquisitions,
+)
+from datalad_hirni.commands.import_dicoms import (
+    _check_imported,
+    _get_cleanup_policies,
+    _get_extract_jobs,
+    _get_import_modes,
+    _prescan_acquisition_id,
+)
+from datalad_hirni.support.ingest_journal import IngestJournal
+
+import logging
+lgr = logging.getLogger('datalad.hirni.ingest')
+
+
+def _get_signature(path):
+    """Size and modification time of a file or directory tree
+
+    For a directory, this is the total size of its files, the latest
+    modification time within it and the number of files.
+    """
+    st = os.stat(path)
+    if not op.isdir(path):
+        return [st.st_size, st.st_mtime]
+    size, mtime, n = 0, st.st_mtime, 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(op.join(root, name))
+            mtime = max(mtime, st.st_mtime)
+            if name in files:
+                size += st.st_size
+                n += 1
+    return [size, mtime, n]
+
+
+def _get_inotify(path):
+    """Return an inotify instance watching `path` or None if unavailable"""
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        lgr.debug("inotify_simple isn't available; polling %s", path)
+        return None
+    inotify = INotify()
+    inotify.add_watch(path, flags.CREATE | flags.MOVED_TO | flags.MODIFY |
+                      flags.CLOSE_WRITE | flags.ATTRIB)
+    return inotify
+
+
+class _StabilityTracker(object):
+    """Tell when entries of a directory stopped changing for `settle`
+    seconds"""
+
+    def __init__(self, settle):
+        self.settle = settle
+        # path -> (signature, first seen, last change)
+        self._candidates = dict()
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def update(self, paths, now=None):
+        """Check `paths` for changes and return those, that are stable
+
+        Returns
+        -------
+        list of tuple
+          path, its signature and when it was first seen
+        """
+        now = time.time() if now is None else now
+        stable = []
+        for path in sorted(set(paths) | set(self._candidates)):
+            try:
+                signature = _get_signature(path)
+            except OSError:
+                # vanished (or is being moved)
+                self._candidates.pop(path, None)
+                continue
+            if path not in self._candidates:
+                self._candidates[path] = (signature, now, now)
+                continue
+            old, seen, changed = self._candidates[path]
+            if signature != old:
+                self._candidates[path] = (signature, seen, now)
+            elif now - changed >= self.settle:
+                del self._candidates[path]
+                stable.append((path, signature, seen))
+        return stable
+
+
+@build_doc
+class Ingest(Interface):
+    """Continuously import DICOM archives dropped into a directory.
+
+    This watches a drop directory (like the one a scanner exports sessions
+    to) and imports every archive or directory of DICOM files appearing in
+    it into the study dataset, as hirni-import-dcm-bulk would. Entries of the
+    drop directory, whose names start with a dot, are ignored.
+
+    An entry is considered complete, once its size and modification time
+    didn't change for a while (see --settle). Changes are detected via
+    inotify, if the Python package inotify_simple is installed, and by
+    polling otherwise. Up to --jobs archives are imported in parallel and
+    saved to the study dataset as soon as they are done. Acquisition IDs are
+    derived from the first DICOM header of an archive as configured by
+    `datalad.hirni.import.acquisition-format`.
+
+    All archives are tracked in a journal in .git/datalad/hirni/ of the study
+    dataset. When restarted, imports that were queued or running are
+    resumed. Archives that were imported or failed to import are picked up
+    again only if they changed. The status of the ingestion, including the
+    latency of each stage (settle, queue, import, commit and total) is
+    written to .git/datalad/hirni/ingest_status.json.
+
+    Only one ingestion can run for a dataset at a time. It runs until it's
+    interrupted, unless --once is given.
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='PATH',
+            doc="""study dataset to import the DICOM archives into. If no
+            dataset is given, an attempt is made to identify the dataset based
+            on the current working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+        path=Parameter(
+            args=("path",),
+            metavar='PATH',
+            doc="""drop directory to watch for DICOM archives.""",
+            constraints=EnsureStr()),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""maximum number of archives to import in parallel. "auto"
+            corresponds to the number of CPUs.""",
+            constraints=EnsureInt() | EnsureChoice('auto')),
+        settle=Parameter(
+            args=("--settle",),
+            metavar="SECONDS",
+            doc="""number of seconds an archive's size and modification time
+            must not change, before it is considered complete.""",
+            constraints=EnsureInt()),
+        interval=Parameter(
+            args=("--interval",),
+            metavar="SECONDS",
+            doc="""number of seconds between checks of the drop directory and
+            the archives in it.""",
+            constraints=EnsureInt()),
+        once=Parameter(
+            args=("--once",),
+            action="store_true",
+            doc="""exit, once everything that is in the drop directory was
+            processed, rather than waiting for more."""),
+        defer_aggregation=Parameter(
+            args=("--defer-aggregation",),
+            action="store_true",
+            doc="""don't aggregate the acquisitions' metadata into the
+            dataset, but record them as pending. Use hirni-aggregate-pending
+            to aggregate all pending acquisitions at once."""),
+    )
+
+    @staticmethod
+    @datasetmethod(name='hirni_ingest')
+    @eval_results
+    def __call__(path, dataset=None, jobs=1, settle=30, interval=5,
+                 once=False, defer_aggregation=False):
+
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose="ingest DICOM sessions")
+        drop_dir = op.abspath(path)
+        res_kwargs = dict(type='file',
+                          action='import DICOM tarball',
+                          logger=lgr)
+
+        from fasteners import InterProcessLock
+        hirni_dir = op.join(str(ds.repo.dot_git), 'datalad', 'hirni')
+        os.makedirs(hirni_dir, exist_ok=True)
+        lock = InterProcessLock(op.join(hirni_dir, 'ingest.lck'))
+        if not lock.acquire(blocking=False):
+            yield dict(res_kwargs, status='impossible', path=drop_dir,
+                       type='directory',
+                       message="another ingestion is running for this "
+                               "dataset")
+            return
+
+        try:
+            journal = IngestJournal(ds)
+            for r in _ingest(ds, drop_dir, journal, _get_n_jobs(jobs),
+                             settle, interval, once, defer_aggregation,
+                             res_kwargs):
+                yield r
+        finally:
+            lock.release()
+
+
+def _ingest(ds, drop_dir, journal, n_jobs, settle, interval, once,
+            defer_aggregation, res_kwargs):
+
+    try:
+        mode, dedup = _get_import_modes(ds)
+        drop, gc = _get_cleanup_policies(ds)
+    except ValueError as e:
+        yield dict(res_kwargs, status='impossible', path=drop_dir,
+                   type='directory', message=str(e))
+        return
+    # TODO: Move default to config definition (see hirni-import-dcm)
+    format_string = ds.config.get(
+        "datalad.hirni.import.acquisition-format", default="{PatientID}")
+    import_kwargs = dict(mode=mode, drop=drop, gc=gc,
+                         extract_jobs=_get_extract_jobs(ds))
+
+    # resume what was queued or running when we stopped last time:
+    for entry in journal.in_state('queued', 'importing'):
+        lgr.info("Resuming ingestion of %s", entry['path'])
+        journal.update(entry['path'], state='queued')
+
+    tracker = _StabilityTracker(settle)
+    inotify = _get_inotify(drop_dir)
+    running = dict()
+
+    from concurrent.futures import (
+        FIRST_COMPLETED,
+        ProcessPoolExecutor,
+        wait,
+    )
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while True:
+            # newly appeared or changed entries of the drop directory:
+            candidates = []
+            for name in sorted(os.listdir(drop_dir)):
+                if name.startswith('.'):
+                    continue
+                p = op.join(drop_dir, name)
+                entry = journal.get(p)
+                if entry and entry['state'] in ('queued', 'importing'):
+                    continue
+                if entry:
+                    try:
+                        if entry['signature'] == _get_signature(p):
+                            continue
+                    except OSError:
+                        # vanished (or is being moved)
+                        continue
+                candidates.append(p)
+
+            for p, signature, seen in tracker.update(candidates):
+                now = time.time()
+                journal.add_latency('settle', now - seen)
+                journal.update(p, state='queued', signature=signature,
+                               acqid=None, seen=seen, stable=now)
+
+            # collect finished imports and save them in one go:
+            done = [f for f in running if f.done()]
+            imported = []
+            for future in done:
+                p = running.pop(future)
+                entry = journal.get(p)
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    journal.update(p, state='failed', message=exc_str(e))
+                    yield dict(res_kwargs, status='error', path=p,
+                               message=("failed to import as %s: %s",
+                                        entry['acqid'], exc_str(e)))
+                    continue
+                journal.add_latency('import', time.time() - entry['started'])
+                journal.update(p, imported=time.time())
+                imported.append((p, entry['acqid'], stats))
+            if imported:
+                saved = set()
+                for r in _save_acquisitions(
+                        ds, [(acqid, stats) for p, acqid, stats in imported],
+                        defer_aggregation=defer_aggregation):
+                    if r['status'] == 'ok':
+                        saved.add(r['path'])
+                    yield r
+                now = time.time()
+                for p, acqid, stats in imported:
+                    entry = journal.get(p)
+                    if stats['dicom_ds'] not in saved:
+                        journal.update(p, state='failed',
+                                       message="failed to save")
+                        continue
+                    journal.add_latency('commit', now - entry['imported'])
+                    journal.add_latency('total', now - entry['seen'])
+                    journal.update(p, state='done', finished=now)
+
+            # start queued imports as long as there are free workers:
+            busy = set(journal.get(p)['acqid'] for p in running.values())
+            for entry in journal.in_state('queued'):
+                if len(running) >= n_jobs:
+                    break
+                p = entry['path']
+                if not op.exists(p):
+                    journal.update(p, state='failed', message="vanished")
+                    continue
+                acqid = entry['acqid']
+                if not acqid:
+                    existing, known = _check_imported(ds, p, dedup=dedup)
+                    if existing:
+                        journal.update(p, state='done', finished=time.time(),
+                                       message="imported before")
+                        yield dict(res_kwargs, status='notneeded', path=p,
+                                   acquisitions=existing,
+                                   message=("already imported as %s",
+                                            ", ".join(existing)))
+                        continue
+                    acqid = _prescan_acquisition_id(p, format_string)
+                    if not acqid:
+                        journal.update(p, state='failed',
+                                       message="no acquisition ID")
+                        yield dict(res_kwargs, status='impossible', path=p,
+                                   message="could not derive acquisition ID "
+                                           "from DICOM headers")
+                        continue
+                    journal.update(p, acqid=acqid, known=known)
+                if acqid in busy:
+                    # the same acquisition can't be imported twice at once
+                    continue
+                busy.add(acqid)
+                now = time.time()
+                journal.add_latency('queue', now - entry['stable'])
+                journal.update(p, state='importing', started=now)
+                running[executor.submit(
+                    _import_acquisition, ds.path, p, acqid,
+                    known_series=entry.get('known'),
+                    **import_kwargs)] = p
+
+            journal.write_status(drop_dir, waiting=len(tracker))
+            if once and not running and not len(tracker) and \
+                    not journal.in_state('queued'):
+                break
+            if running:
+                wait(list(running), timeout=interval,
+                     return_when=FIRST_COMPLETED)
+            elif inotify is not None and not len(tracker):
+                # nothing to do, until something happens in the drop dir
+                inotify.read(timeout=interval * 1000)
+            else:
+                time.sleep(interval)
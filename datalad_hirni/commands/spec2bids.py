@@ -2,44 +2,612 @@
 
 __docformat__ = 'restructuredtext'
 
+import os
 import os.path as op
+import shutil
+import tempfile
 from os.path import isabs
 from os.path import join as opj
 from os.path import basename
 from os.path import lexists
 from os.path import relpath
 
+from datalad.cmd import WitlessRunner
+from datalad.core.local.run import format_command
 from datalad.interface.base import Interface
 from datalad.interface.base import build_doc
 from datalad.support.param import Parameter
+from datalad.distribution.dataset import Dataset
 from datalad.distribution.dataset import datasetmethod
 from datalad.distribution.dataset import EnsureDataset
 from datalad.distribution.dataset import require_dataset
 from datalad.distribution.dataset import resolve_path
 from datalad.interface.results import get_status_dict
 from datalad.interface.utils import eval_results
+from datalad.support.constraints import EnsureChoice
+from datalad.support.constraints import EnsureInt
 from datalad.support.constraints import EnsureStr
 from datalad.support.constraints import EnsureNone
+from datalad.support.exceptions import CommandError
 from datalad.support.exceptions import InsufficientArgumentsError
 from datalad.support.json_py import load_stream
 from datalad.utils import assure_list
+from datalad.utils import get_dataset_root
+from datalad.utils import guard_for_format
+from datalad.utils import path_is_subpath
+from datalad.utils import quote_cmdlinearg
 from datalad.utils import rmtree
 from datalad.config import anything2bool
+from datalad.dochelpers import exc_str
 
 from datalad.coreapi import remove
 from datalad_container import containers_run
 import logging
+from datalad_hirni.commands.dicom2spec import _get_n_jobs
 from datalad_hirni.support.spec_helpers import (
     get_specval,
     has_specval
 )
+from datalad_hirni.support.conversion_manifest import (
+    add_to_manifest,
+    get_digest,
+    get_manifest,
+    get_manifest_file,
+    get_procedure_version,
+)
+from datalad_hirni.support.task_graph import TaskGraph
 
 lgr = logging.getLogger("datalad.hirni.spec2bids")
 
 
+def _drop_converted(spec_path):
+    """Drop extracted DICOM files of an acquisition, that were kept for
+    conversion (see `datalad.hirni.import.drop`)"""
+    from datalad.distribution.dataset import Dataset
+    from datalad_hirni.commands.import_dicoms import _drop_extracted
+    from datalad_hirni.support.pending_aggregation import (
+        get_pending,
+        remove_pending,
+    )
+    study_root = get_dataset_root(op.dirname(spec_path))
+    if not study_root:
+        return
+    study_ds = Dataset(study_root)
+    acq_dir = op.dirname(spec_path)
+    converted = [p for p in get_pending(study_ds, queue='drop')
+                 if path_is_subpath(p, acq_dir)]
+    dropped = []
+    for p in converted:
+        if not op.exists(p):
+            dropped.append(p)
+            continue
+        failed = False
+        for r in _drop_extracted(Dataset(p), return_type='generator',
+                                 on_failure='ignore',
+                                 result_renderer='disabled'):
+            if r['status'] not in ['ok', 'notneeded']:
+                failed = True
+            yield r
+        if not failed:
+            dropped.append(p)
+    remove_pending(study_ds, dropped, queue='drop')
+
+
+def _get_replacements(spec_snippet, rel_spec_path, anonymize):
+    """Build a dict available for placeholders in format strings
+
+    Note: This is flattening the structure since we don't need value/approved
+    for the substitutions. In addition 'subject' and 'anon_subject' are not
+    passed on, but a new key 'bids_subject' instead the value of which
+    depends on `anonymize`. Additionally 'location' is recomputed to be
+    relative to the dataset, since this is where the procedures are running
+    from within.
+    """
+    replacements = dict()
+    for k, v in spec_snippet.items():
+        if k == 'subject':
+            if not anonymize:
+                replacements['bids-subject'] = v['value']
+        elif k == 'anon-subject':
+            if anonymize:
+                replacements['bids-subject'] = v['value']
+        elif k == 'location':
+            replacements[k] = op.join(op.dirname(rel_spec_path), v)
+        elif k == 'procedures':
+            # 'procedures' is a list of dicts (not suitable for
+            # substitutions) and it makes little sense to be
+            # referenced by converter format strings anyway:
+            continue
+        else:
+            replacements[k] = v['value'] if isinstance(v, dict) else v
+    return replacements
+
+
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def _find_procedure(dataset, proc_name, procedures):
+    """Return path, call format and version (a digest of its content) of a
+    procedure or None if there is none
+
+    Lookups are cached in `procedures`, since discovering a procedure
+    involves looking into all subdatasets.
+    """
+    if proc_name not in procedures:
+        from datalad.interface.run_procedure import (
+            _get_procedure_implementation,
+            _guess_exec,
+        )
+        procedures[proc_name] = None
+        # the first match is what run-procedure would run:
+        for m, name, call_format, help_ in \
+                _get_procedure_implementation(proc_name, ds=dataset):
+            procedures[proc_name] = (m, call_format or
+                                     _guess_exec(m)['template'],
+                                     get_procedure_version(m))
+            break
+    return procedures[proc_name]
+
+
+def _format_command(call_format, script, ds_path):
+    """Return the command to execute a procedure with datalad-run
+
+    Placeholders {script} and {ds} of the call format are filled in the same
+    way datalad-run-procedure would do it. Run substitutions (doubled
+    braces) are left to datalad-run, so that the command can be recorded
+    without the snippet's values.
+    """
+    return call_format.format(
+        script=guard_for_format(quote_cmdlinearg(script)),
+        ds=guard_for_format(quote_cmdlinearg(ds_path)),
+        args='',
+    )
+
+
+def _plan_conversion(dataset, spec_path, rel_spec_path, anonymize, only_type,
+                     procedures):
+    """Find the procedures to run for the snippets of a specification
+
+    Returns
+    -------
+    tuple
+      results for snippets, that don't need to be converted, and a list of
+      tasks (dict) to run in the order they are specified in
+    """
+    results = []
+    tasks = []
+    # check each dict (snippet) in the specification for what to do
+    # wrt conversion:
+    for snippet_idx, spec_snippet in enumerate(load_stream(spec_path)):
+
+        if only_type and not spec_snippet['type'].startswith(only_type):
+            # ignore snippets not matching `only_type`
+            # Note/TODO: the .startswith part is meant for
+            # matching "dicomseries:all" to given "dicomseries" but not
+            # vice versa. This prob. needs refinement (and doc)
+            continue
+
+        procedure_list = spec_snippet.get('procedures')
+        if not procedure_list:
+            # no conversion procedures defined at all:
+            results.append(get_status_dict(
+                    action='spec2bids',
+                    path=spec_path,
+                    snippet=spec_snippet,
+                    status='notneeded',
+            ))
+            continue
+
+        # accept a single dict as a one item list:
+        if isinstance(procedure_list, dict):
+            procedure_list = [procedure_list]
+
+        replacements = _get_replacements(spec_snippet, rel_spec_path,
+                                         anonymize)
+        replacements['specpath'] = rel_spec_path
+        replacements['anonymize'] = str(anonymize)
+
+        # procedures get the replacements as run substitutions in their
+        # environment as well, so their own datalad-run calls can use them.
+        # Note, that this requires names of substitutions to not contain
+        # underscores, since they would be translated to '.' by
+        # ConfigManager when reading them from within the procedure's
+        # datalad-run calls.
+        substitutions = {k: str(v) for k, v in replacements.items()}
+        env_subs = dict()
+        for k, v in replacements.items():
+            env_subs['DATALAD_RUN_SUBSTITUTIONS_{}'
+                     ''.format(k.upper().replace('-', '__'))] = str(v)
+
+        for proc in procedure_list:
+            if has_specval(proc, 'procedure-name'):
+                proc_name = get_specval(proc, 'procedure-name')
+            else:
+                # invalid procedure spec
+                lgr.warning("conversion procedure missing key "
+                            "'procedure-name' in %s: %s",
+                            spec_path, proc)
+                # TODO: continue or yield impossible/error so it can be
+                # dealt with via on_failure?
+                continue
+
+            if has_specval(proc, 'on-anonymize') \
+                and anything2bool(
+                    get_specval(proc, 'on-anonymize')
+                    ) and not anonymize:
+                # don't run that procedure, if we weren't called with
+                # --anonymize while procedure is specified to be run on
+                # that switch only
+                continue
+
+            proc_call = get_specval(proc, 'procedure-call') \
+                if has_specval(proc, 'procedure-call') \
+                else None
+
+            task = dict(
+                spec_path=spec_path,
+                snippet=spec_snippet,
+                snippet_idx=snippet_idx,
+                type=spec_snippet.get('type'),
+                location=replacements.get('location'),
+                proc_name=proc_name,
+                cmd=None,
+                call=None,
+                substitutions=substitutions,
+                env=env_subs,
+            )
+            procedure = _find_procedure(dataset, proc_name, procedures)
+            if procedure is None:
+                task['error'] = "Cannot find procedure with name '{}'" \
+                                "".format(proc_name)
+            else:
+                # if spec comes with call format string, it takes precedence
+                # over what is generally configured for the procedure
+                # TODO: Not sure yet whether this is how we should deal with
+                # it
+                call_format = proc_call or procedure[1]
+                if not call_format:
+                    task['error'] = "No idea how to execute procedure {}. " \
+                                    "Missing 'execute' permissions?" \
+                                    "".format(procedure[0])
+                    tasks.append(task)
+                    continue
+                try:
+                    task['cmd'] = _format_command(
+                        call_format, procedure[0], dataset.path)
+                    # the command as it is going to be executed:
+                    task['call'] = task['cmd'].format_map(
+                        _KeepMissing(substitutions))
+                    # identical calls do the same thing, unless the
+                    # procedure gets the snippet's values from its
+                    # environment only:
+                    task['dedup_key'] = (proc_name, task['call']) \
+                        if task['call'] != task['cmd'].format_map(
+                            _KeepMissing()) \
+                        else (proc_name, task['call'],
+                              tuple(sorted(env_subs.items())))
+                    # Note: The call format rather than the command, since
+                    # the latter contains the dataset's path:
+                    task['digest'] = get_digest(spec_snippet, call_format,
+                                                replacements, procedure[2])
+                except (KeyError, IndexError, ValueError) as e:
+                    task['error'] = "invalid call format {!r}: {}".format(
+                        call_format, exc_str(e))
+            tasks.append(task)
+    return results, tasks
+
+
+def _build_task_graph(tasks):
+    """Build the dependency graph of the tasks of a specification
+
+    A task depends on the preceding procedures of its snippet, on the
+    procedures of snippets of the aggregating type ('dicomseries:all' for
+    'dicomseries') and on preceding procedures affecting the same location.
+    Since the procedures of a snippet and those of a location depend on each
+    other in turn, it's sufficient to link a task to the latest of them.
+    """
+    # snippets of an aggregating type go first:
+    tasks = sorted(tasks, key=lambda t: not (t['type'] or '').endswith(':all'))
+    graph = TaskGraph()
+    # latest task by snippet and by location:
+    by_snippet = dict()
+    by_location = dict()
+    # aggregating type -> latest task by snippet of that type:
+    by_all_type = dict()
+    for i, task in enumerate(tasks):
+        after = set(by_all_type.get(
+            '{}:all'.format(task['type']), dict()).values())
+        for latest, k in ((by_snippet, task['snippet_idx']),
+                          (by_location, task['location'])):
+            if k in latest:
+                after.add(latest[k])
+            latest[k] = i
+        graph.add(i, task, after=after)
+        if (task['type'] or '').endswith(':all'):
+            by_all_type.setdefault(task['type'], dict())[
+                task['snippet_idx']] = i
+    return graph
+
+
+def _run_task(dataset, task):
+    """Run the procedure of a task and report on it"""
+    if task.get('error'):
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'impossible',
+               'message': task['error']}
+        return
+
+    # Note, that datalad-run can't be given an environment for the command
+    # it executes and run-procedure would run the procedure without any
+    # outputs to save anyway. Hence, do what they would do, but pass the
+    # substitutions on via the environment of the procedure only rather than
+    # ours. That way neither os.environ nor the dataset's config need to be
+    # patched and the snippet's values (like the non-anonymized subject)
+    # don't become part of a command, that would be recorded.
+    lgr.info("Running procedure %s", task['proc_name'])
+    lgr.debug("Full procedure command: %r", task['cmd'])
+    run_results = list()
+    message = "acquisition conversion failed. See previous message(s)."
+    try:
+        cmd_expanded = format_command(dataset, task['cmd'], **dict(
+            task['substitutions'],
+            pwd=dataset.path,
+            dspath=dataset.path,
+            tmpdir=tempfile.mkdtemp(prefix="datalad-run-")
+            if "{tmpdir}" in task['cmd'] else "",
+            inputs=None,
+            outputs=None))
+    except KeyError as e:
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'impossible',
+               'message': ("command has an unrecognized placeholder: %s",
+                           exc_str(e))}
+        return
+    try:
+        WitlessRunner(cwd=dataset.path).run(
+            cmd_expanded,
+            env=dict(os.environ, **task['env']))
+    except CommandError as e:
+        # the procedure failed; things depending on it will be skipped
+        run_results.append(dict(status='error'))
+        message = ("acquisition conversion failed: %s", exc_str(e))
+
+    if not all(r['status'] in ['ok', 'notneeded'] for r in run_results):
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'error',
+               'message': message}
+    else:
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'ok',
+               'message': "acquisition converted."}
+
+
+def _convert_task(dataset, graph, key, rel_spec_path, manifest, history,
+                  ran, recorded, calls):
+    """Run a task unless its conversion is in the manifest already or the
+    very same call was made before
+
+    Successful conversions are added to `recorded`. Keys of tasks, that were
+    run, are added to `ran`. Tasks depending on those are always run.
+    `manifest` is None, if conversions shouldn't be skipped. `calls` maps the
+    calls made so far to whether they succeeded.
+    """
+    task = graph[key]
+    done = manifest.get(task.get('digest')) if manifest else None
+    if done and done['commit'] in history and \
+            not graph.dependencies(key) & ran:
+        calls.setdefault(task['dedup_key'], True)
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'notneeded',
+               'message': ("unchanged since conversion in %s",
+                           done['commit'])}
+        return
+    if task.get('dedup_key') in calls:
+        yield {'action': task['proc_name'],
+               'path': task['spec_path'],
+               'snippet': task['snippet'],
+               'status': 'notneeded' if calls[task['dedup_key']]
+                         else 'impossible',
+               'message': ("same call %s before: %s",
+                           "was made" if calls[task['dedup_key']]
+                           else "failed", task['cmd'])}
+        return
+    ran.add(key)
+    ok = True
+    for r in _run_task(dataset, task):
+        if r['status'] not in ['ok', 'notneeded']:
+            ok = False
+        yield r
+    if 'dedup_key' in task:
+        calls[task['dedup_key']] = ok
+    if ok:
+        recorded[task['digest']] = dict(commit=dataset.repo.get_hexsha(),
+                                        spec=rel_spec_path,
+                                        procedure=task['proc_name'])
+
+
+def _group_by_acquisition(dataset, specfiles):
+    """Group spec files by acquisition directory in order of appearance
+
+    Returns
+    -------
+    list of list
+      paths relative to `dataset`
+    """
+    groups = dict()
+    for p in specfiles:
+        acq_dir = p if op.isdir(p) else op.dirname(p)
+        groups.setdefault(acq_dir, []).append(relpath(p, dataset.path))
+    return list(groups.values())
+
+
+def _convert_in_clone(ds_path, clone_path, branch, specfiles, anonymize,
+                      only_type, incremental):
+    """Convert acquisition(s) in an ephemeral clone of a BIDS dataset
+
+    Conversion is committed to `branch` of the clone. Spec files are given
+    relative to the dataset. Returns the results of the conversion and the
+    clone's conversion manifest.
+    """
+    from datalad.api import clone
+    ds = clone(source=ds_path, path=clone_path, reckless='ephemeral',
+               result_renderer='disabled', return_type='item-or-list',
+               result_xfm='datasets')
+    ds.repo.call_git(['checkout', '-q', '-b', branch])
+    manifest_file = get_manifest_file(Dataset(ds_path))
+    if op.exists(manifest_file):
+        os.makedirs(op.dirname(get_manifest_file(ds)), exist_ok=True)
+        shutil.copyfile(manifest_file, get_manifest_file(ds))
+    # install the (sub)datasets the specification lives in; everything else
+    # is up to the conversion procedures. Subdatasets installed in the
+    # original dataset are cloned from there and share its annex as well.
+    # Others are cloned from their recorded URL, which costs a full clone
+    # per acquisition.
+    ds.get(sorted(set(op.dirname(p) or op.curdir for p in specfiles)),
+           get_data=False, reckless='ephemeral', on_failure='ignore',
+           result_renderer='disabled')
+    results = []
+    for r in Spec2Bids.__call__([opj(ds.path, p) for p in specfiles],
+                                dataset=ds, anonymize=anonymize,
+                                only_type=only_type,
+                                incremental=incremental,
+                                return_type='generator',
+                                on_failure='ignore',
+                                result_renderer='disabled'):
+        r = {k: v for k, v in r.items() if k != 'logger'}
+        # report paths in terms of the original dataset:
+        for k in ('path', 'refds', 'parentds'):
+            if isinstance(r.get(k), str) and \
+                    path_is_subpath(r[k], clone_path):
+                r[k] = opj(ds_path, relpath(r[k], clone_path))
+        results.append(r)
+    return results, get_manifest(ds)
+
+
+def _merge_converted(dataset, clone_path, branch):
+    """Merge a conversion done by `_convert_in_clone` into `dataset`
+
+    Rows added to participants.tsv by different conversions are combined.
+    On conflicts the merge is aborted and `branch` is kept in `dataset` to
+    be merged manually.
+    """
+    from datalad.support.annexrepo import AnnexRepo
+    repo = dataset.repo
+    hirni_dir = op.join(str(repo.dot_git), 'datalad', 'hirni')
+    attributes = op.join(hirni_dir, 'spec2bids_attributes')
+    if not op.exists(attributes):
+        with open(attributes, 'w') as f:
+            f.write("participants.tsv merge=union\n")
+    repo.call_git(['fetch', '-q', clone_path,
+                   '{0}:{0}'.format(branch)])
+    try:
+        repo.call_git(['-c', 'core.attributesFile={}'.format(attributes),
+                       'merge', '--no-edit', '-q', branch])
+    except CommandError:
+        repo.call_git(['merge', '--abort'])
+        raise
+    repo.remove_branch(branch)
+    if isinstance(repo, AnnexRepo):
+        # annexed outputs are in our object store already (the clone's
+        # annex is a symlink to it), but annex needs to learn about them:
+        changed = [p for p in repo.call_git(
+            ['diff', '--name-only', 'ORIG_HEAD', 'HEAD']).splitlines() if p]
+        if changed:
+            repo.fsck(paths=changed, fast=True)
+
+
+def _convert_parallel(dataset, groups, anonymize, only_type, incremental,
+                      n_jobs):
+    """Convert groups of spec files in parallel, each in its own clone"""
+    from concurrent.futures import (
+        ProcessPoolExecutor,
+        as_completed,
+    )
+    hirni_dir = op.join(str(dataset.repo.dot_git), 'datalad', 'hirni')
+    os.makedirs(hirni_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = dict()
+        for specfiles in groups:
+            clone_path = tempfile.mkdtemp(prefix='spec2bids-', dir=hirni_dir)
+            branch = 'hirni-spec2bids-{}'.format(
+                op.basename(clone_path)[len('spec2bids-'):])
+            futures[executor.submit(
+                _convert_in_clone, dataset.path, clone_path, branch,
+                specfiles, anonymize, only_type, incremental)] = \
+                (specfiles, clone_path, branch)
+        # Note: Merging happens here only, one acquisition at a time, so
+        # there's a single process writing to the dataset's index.
+        for future in as_completed(futures):
+            specfiles, clone_path, branch = futures[future]
+            spec_paths = [opj(dataset.path, p) for p in specfiles]
+            try:
+                results, manifest = future.result()
+            except Exception as e:
+                rmtree(clone_path)
+                for p in spec_paths:
+                    yield get_status_dict(
+                        action='spec2bids', path=p, status='error',
+                        message=("conversion failed: %s", exc_str(e)))
+                continue
+            # the final result for a spec file is reported, once the
+            # conversion is merged:
+            converted = []
+            failed = False
+            for r in results:
+                if r['status'] not in ['ok', 'notneeded']:
+                    failed = True
+                if r.get('action') == 'spec2bids' and r['status'] == 'ok' \
+                        and 'snippet' not in r:
+                    converted.append(r)
+                else:
+                    yield r
+            try:
+                _merge_converted(dataset, clone_path, branch)
+            except CommandError as e:
+                for r in converted:
+                    yield dict(r, status='error',
+                               message=("failed to merge conversion; it's "
+                                        "available from branch %s: %s",
+                                        branch, exc_str(e)))
+                continue
+            finally:
+                rmtree(clone_path)
+            # conversions are merged, so their commits are ours now:
+            add_to_manifest(dataset, manifest)
+            for r in converted:
+                if not failed and not only_type:
+                    for dr in _drop_converted(r['path']):
+                        yield dr
+                yield r
+
+
 @build_doc
 class Spec2Bids(Interface):
     """Convert to BIDS based on study specification
+
+    With --jobs, acquisitions are converted in parallel. Every acquisition is
+    converted in a temporary (ephemeral) clone of the dataset. Subdatasets
+    the specification lives in are cloned ephemerally from the dataset's
+    installed subdatasets, too. Conversions
+    are then merged into the dataset one after another, so that the
+    procedures' commits, including their run records, are kept. Snippets of
+    an acquisition are still converted in order. Since the conversions of
+    different acquisitions don't see each other's results, procedures must
+    not depend on them. Rows added to participants.tsv are combined when
+    merging. Other conflicting changes fail the merge, leaving the
+    conversion on a branch 'hirni-spec2bids-*' to be merged manually.
     """
 
     _params_ = dict(
@@ -72,13 +640,30 @@ class Spec2Bids(Interface):
             metavar="TYPE",
             doc="specify snippet type to convert. If given only this type of "
                 "specification snippets is considered for conversion",
-            constraints=EnsureStr() | EnsureNone(),)
+            constraints=EnsureStr() | EnsureNone(),),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of acquisitions to convert in parallel. "auto"
+            corresponds to the number of CPUs.""",
+            constraints=EnsureInt() | EnsureNone() | EnsureChoice('auto')),
+        incremental=Parameter(
+            args=("--incremental",),
+            action="store_true",
+            doc="""skip procedures, that were run successfully for a
+            specification snippet before, unless the snippet (including the
+            commit of the dataset it refers to), the procedure or its call
+            changed since, or a procedure they depend on needs to be run
+            again. Conversions are recorded in
+            .git/datalad/hirni/spec2bids_manifest.json of the dataset,
+            whether or not this switch is given."""),
     )
 
     @staticmethod
     @datasetmethod(name='hirni_spec2bids')
     @eval_results
-    def __call__(specfile, dataset=None, anonymize=False, only_type=None):
+    def __call__(specfile, dataset=None, anonymize=False, only_type=None,
+                 jobs=None, incremental=False):
 
         dataset = require_dataset(dataset, check_installed=True,
                                   purpose="spec2bids")
@@ -87,21 +672,24 @@ class Spec2Bids(Interface):
         specfile = [resolve_path(p, dataset) for p in specfile]
         specfile = [str(p) for p in specfile]
 
+        groups = _group_by_acquisition(dataset, specfile)
+        n_jobs = min(_get_n_jobs(jobs), len(groups))
+        if n_jobs > 1:
+            for r in _convert_parallel(dataset, groups, anonymize, only_type,
+                                       incremental,
+                                       n_jobs):
+                yield r
+            return
+
+        # procedures looked up so far:
+        procedures = dict()
+        manifest = get_manifest(dataset) if incremental else None
+        # calls made so far and whether they succeeded:
+        calls = dict()
+        history = set(dataset.repo.call_git(
+            ['rev-list', 'HEAD']).split()) if manifest else set()
         for spec_path in specfile:
 
-            # Note/TODO: ran_procedure per spec file still isn't ideal. Could
-            # be different spec files for same acquisition. It's actually about
-            # the exact same call. How to best get around substitutions?
-            # Also: per snippet isn't correct either.
-            # substitutions is real issue. Example "copy {location} ."
-            #
-            # => datalad.interface.run.format_command / normalize_command ?
-
-            # TODO: Also can we skip prepare_inputs within run? At least specify
-            # more specifically. Note: Can be globbed!
-
-            ran_procedure = dict()
-
             if not lexists(spec_path):
                 yield get_status_dict(
                     action='spec2bids',
@@ -133,215 +721,37 @@ class Spec2Bids(Interface):
             rel_spec_path = relpath(spec_path, dataset.path) \
                 if isabs(spec_path) else spec_path
 
-            # check each dict (snippet) in the specification for what to do
-            # wrt conversion:
-            for spec_snippet in load_stream(spec_path):
-
-                if only_type and not spec_snippet['type'].startswith(only_type):
-                    # ignore snippets not matching `only_type`
-                    # Note/TODO: the .startswith part is meant for
-                    # matching "dicomseries:all" to given "dicomseries" but not
-                    # vice versa. This prob. needs refinement (and doc)
-                    continue
-
-                if 'procedures' not in spec_snippet:
-                    # no conversion procedures defined at all:
-                    yield get_status_dict(
-                            action='spec2bids',
-                            path=spec_path,
-                            snippet=spec_snippet,
-                            status='notneeded',
-                    )
-                    continue
-
-                procedure_list = spec_snippet['procedures']
-                if not procedure_list:
-                    # no conversion procedures defined at all:
-                    yield get_status_dict(
-                            action='spec2bids',
-                            path=spec_path,
-                            snippet=spec_snippet,
-                            status='notneeded',
-                    )
-                    continue
-
-                # accept a single dict as a one item list:
-                if isinstance(procedure_list, dict):
-                    procedure_list = [procedure_list]
-
-                # build a dict available for placeholders in format strings:
-                # Note: This is flattening the structure since we don't need
-                # value/approved for the substitutions. In addition 'subject'
-                # and 'anon_subject' are not passed on, but a new key
-                # 'bids_subject' instead the value of which depends on the
-                # --anonymize switch.
-                # Additionally 'location' is recomputed to be relative to
-                # dataset.path, since this is where the procedures are running
-                # from within.
-                replacements = dict()
-                for k, v in spec_snippet.items():
-                    if k == 'subject':
-                        if not anonymize:
-                            replacements['bids-subject'] = v['value']
-                    elif k == 'anon-subject':
-                        if anonymize:
-                            replacements['bids-subject'] = v['value']
-                    elif k == 'location':
-                        replacements[k] = op.join(op.dirname(rel_spec_path), v)
-                    elif k == 'procedures':
-                        # 'procedures' is a list of dicts (not suitable for
-                        # substitutions) and it makes little sense to be
-                        # referenced by converter format strings anyway:
-                        continue
-                    else:
-                        replacements[k] = v['value'] if isinstance(v, dict) else v
-
-                # build dict to patch os.environ with for passing
-                # replacements on to procedures:
-                env_subs = dict()
-                for k, v in replacements.items():
-                    env_subs['DATALAD_RUN_SUBSTITUTIONS_{}'
-                             ''.format(k.upper().replace('-', '__'))] = str(v)
-                env_subs['DATALAD_RUN_SUBSTITUTIONS_SPECPATH'] = rel_spec_path
-                env_subs['DATALAD_RUN_SUBSTITUTIONS_ANONYMIZE'] = str(anonymize)
-
-                # TODO: The above two blocks to build replacements dict and
-                # env_subs should be joined eventually.
-
-                for proc in procedure_list:
-                    if has_specval(proc, 'procedure-name'):
-                        proc_name = get_specval(proc, 'procedure-name')
-                    else:
-                        # invalid procedure spec
-                        lgr.warning("conversion procedure missing key "
-                                    "'procedure-name' in %s: %s",
-                                    spec_path, proc)
-                        # TODO: continue or yield impossible/error so it can be
-                        # dealt with via on_failure?
-                        continue
-
-                    if has_specval(proc, 'on-anonymize') \
-                        and anything2bool(
-                            get_specval(proc, 'on-anonymize')
-                            ) and not anonymize:
-                        # don't run that procedure, if we weren't called with
-                        # --anonymize while procedure is specified to be run on
-                        # that switch only
-                        continue
-
-                    proc_call = get_specval(proc, 'procedure-call') \
-                        if has_specval(proc, 'procedure-call') \
-                        else None
-
-                    if ran_procedure.get(hash((proc_name, proc_call)), None):
-                        # if we ran the exact same call already,
-                        # don't call it again
-                        # TODO: notneeded?
-                        continue
-
-                    # if spec comes with call format string, it takes precedence
-                    # over what is generally configured for the procedure
-                    # TODO: Not sure yet whether this is how we should deal with it
-                    if proc_call:
-                        env_subs['DATALAD_PROCEDURES_{}_CALL__FORMAT'
-                                 ''.format(proc_name.upper().replace('-', '__'))
-                                 ] = proc_call
-
-                    run_results = list()
-                    # Note, that we can't use dataset.config.overrides to
-                    # pass run-substitution config to procedures, since we
-                    # leave python context and thereby loose the dataset
-                    # instance. Use patched os.environ instead. Note also,
-                    # that this requires names of substitutions to not
-                    # contain underscores, since they would be translated to
-                    # '.' by ConfigManager when reading them from within the
-                    # procedure's datalad-run calls.
-                    from unittest.mock import patch
-
-                    # TODO: Reconsider that patching. Shouldn't it be an update?
-                    with patch.dict('os.environ', env_subs):
-                        # apparently reload is necessary to consider config
-                        # overrides via env:
-                        dataset.config.reload()
-                        for r in dataset.run_procedure(
-                                spec=proc_name,
-                                return_type='generator'
-                        ):
-
-                            # # if there was an issue yield original result,
-                            # # otherwise swallow:
-                            # if r['status'] not in ['ok', 'notneeded']:
-                            yield r
-                            run_results.append(r)
-
-                    if not all(r['status'] in ['ok', 'notneeded']
-                               for r in run_results):
-                        yield {'action': proc_name,
-                               'path': spec_path,
-                               'snippet': spec_snippet,
-                               'status': 'error',
-                               'message': "acquisition conversion failed. "
-                                          "See previous message(s)."}
-
-                    else:
-                        yield {'action': proc_name,
-                               'path': spec_path,
-                               'snippet': spec_snippet,
-                               'status': 'ok',
-                               'message': "acquisition converted."}
-
-                    # mark as a procedure we ran on this acquisition:
-                    # TODO: rethink. Doesn't work that way. Disabled for now
-                    # ran_procedure[hash((proc_name, proc_call))] = True
-
-
-
-
-                    # elif proc_name != 'hirni-dicom-converter':
-                    #     # specific converter procedure call
-                    #
-                    #     from mock import patch
-                    #     with patch.dict('os.environ', env_subs):
-                    #         # apparently reload is necessary to consider config
-                    #         # overrides via env:
-                    #         dataset.config.reload()
-                    #
-                    #         for r in dataset.run_procedure(
-                    #                 spec=[proc_name, rel_spec_path, anonymize],
-                    #                 return_type='generator'
-                    #         ):
-                    #
-                    #             # if there was an issue with containers-run,
-                    #             # yield original result, otherwise swallow:
-                    #             if r['status'] not in ['ok', 'notneeded']:
-                    #                 yield r
-                    #
-                    #             run_results.append(r)
-                    #
-                    #     if not all(r['status'] in ['ok', 'notneeded']
-                    #                for r in run_results):
-                    #         yield {'action': proc_name,
-                    #                'path': spec_path,
-                    #                'snippet': spec_snippet,
-                    #                'status': 'error',
-                    #                'message': "Conversion failed. "
-                    #                           "See previous message(s)."}
-                    #
-                    #     else:
-                    #         yield {'action': proc_name,
-                    #                'path': spec_path,
-                    #                'snippet': spec_snippet,
-                    #                'status': 'ok',
-                    #                'message': "specification converted."}
-
-                    # elif ran_heudiconv and proc_name == 'hirni-dicom-converter':
-                    #     # in this case we acted upon this snippet already and
-                    #     # do not have to produce a result
-                    #     pass
-                    #
-                    # else:
-                    #     # this shouldn't happen!
-                    #     raise RuntimeError
+            results, tasks = _plan_conversion(dataset, spec_path,
+                                              rel_spec_path, anonymize,
+                                              only_type, procedures)
+            for r in results:
+                yield r
+
+            graph = _build_task_graph(tasks)
+            failed = False
+            ran = set()
+            recorded = dict()
+            for r in graph.run(lambda i: _convert_task(
+                    dataset, graph, i, rel_spec_path, manifest, history, ran,
+                    recorded, calls)):
+                if r['status'] not in ['ok', 'notneeded']:
+                    failed = True
+                yield r
+            add_to_manifest(dataset, recorded)
+            for i, cause in graph.blocked().items():
+                failed = True
+                yield {'action': graph[i]['proc_name'],
+                       'path': spec_path,
+                       'snippet': graph[i]['snippet'],
+                       'status': 'impossible',
+                       'message': ("not run, since %s failed for %s",
+                                   graph[cause]['proc_name'],
+                                   graph[cause]['location'])}
+
+            if not failed and not only_type:
+                # the DICOMs of this acquisition are converted
+                for r in _drop_converted(spec_path):
+                    yield r
 
             yield {'action': 'spec2bids',
                    'path': spec_path,
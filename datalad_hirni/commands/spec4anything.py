@@ -3,6 +3,11 @@
 
 import os.path as op
 import posixpath
+from copy import deepcopy
+from collections import (
+    Counter,
+    OrderedDict
+)
 from six import text_type
 
 from datalad.interface.base import build_doc, Interface
@@ -20,6 +25,8 @@ from datalad.utils import assure_list
 from datalad.interface.annotate_paths import AnnotatePaths
 from datalad.interface.results import get_status_dict
 
+from datalad_hirni.support.spec_helpers import SpecContainer
+
 # bound dataset method
 import datalad_metalad.dump
 
@@ -36,11 +43,33 @@ def _get_edit_dict(value=None, approved=False):
     return dict(approved=approved, value=value)
 
 
-def _add_to_spec(spec, spec_dir, path, ds, overrides=None, replace=False):
+def _count_editables(snippet, counts, delta=1):
+    """Add (or remove) values of `snippet`'s editable fields to/from `counts`
+
+    `counts` maps field names to a `Counter` of their values. Values whose
+    count drops to zero are removed, so the length of a `Counter` is the number
+    of distinct values of that field across the specification.
+    """
+    for k, v in snippet.items():
+        if isinstance(v, dict) and 'value' in v:
+            c = counts.setdefault(k, Counter())
+            c[v['value']] += delta
+            if c[v['value']] <= 0:
+                del c[v['value']]
+
+
+def _get_unique_overrides(counts):
+    """Editable records for the fields having a single value in `counts`"""
+    return {k: _get_edit_dict(value=next(iter(c)), approved=False)
+            for k, c in counts.items() if len(c) == 1}
+
+
+def _add_to_spec(spec, spec_dir, path, ds, overrides=None, replace=False,
+                 counts=None, refcommit=None):
     """
     Parameters
     ----------
-    spec: list of dict
+    spec: SpecContainer or list of dict
       specification to add the snippet to
     spec_dir:
       path to where the spec file is (paths in spec are relative to that location)
@@ -50,14 +79,21 @@ def _add_to_spec(spec, spec_dir, path, ds, overrides=None, replace=False):
       metadata of the dataset (for dataset_id and refcommit)
     overrides: dict
       key, values to add/overwrite the default
+    counts: dict or None
+      if given, value counts of editable fields as maintained by
+      `_count_editables`. Will be kept up-to-date with the change to `spec`.
+    refcommit: str or None
+      refcommit of `ds`; determined if not given
     """
 
-    from datalad_metalad import get_refcommit
+    if refcommit is None:
+        from datalad_metalad import get_refcommit
+        refcommit = get_refcommit(ds)
     snippet = {
         'type': 'generic_' + path['type'],
         'location': posixpath.relpath(path['path'], spec_dir),
         'dataset-id': ds.id,
-        'dataset-refcommit': get_refcommit(ds),
+        'dataset-refcommit': refcommit,
         'id': _get_edit_dict(),
         'procedures': _get_edit_dict(),
         'comment': _get_edit_dict(value=""),
@@ -65,20 +101,29 @@ def _add_to_spec(spec, spec_dir, path, ds, overrides=None, replace=False):
 
     snippet.update(overrides)
 
+    if not isinstance(spec, SpecContainer):
+        spec = SpecContainer(spec)
+
     # figure, whether we need to append the snippet or replace an
     # existing one
     if replace:
-        for s in spec:
-            if s['type'] == snippet['type'] and \
-               s['location'] == snippet['location'] and \
-               s['id']['value'] == snippet['id']['value']:
-                # replace existing snippet:
-                # Note: This needs to be documented. The identification as well
-                # as the fact that only first occurence will be replaced.
-                s.update(snippet)
-                return spec
+        existing = spec.get_by_location(snippet['type'],
+                                        snippet['location'],
+                                        snippet['id']['value'])
+        if existing:
+            # replace existing snippet:
+            # Note: This needs to be documented. The identification as well
+            # as the fact that only first occurence will be replaced.
+            if counts is not None:
+                _count_editables(existing[0], counts, delta=-1)
+            spec.update(existing[0], snippet)
+            if counts is not None:
+                _count_editables(existing[0], counts)
+            return spec
 
     spec.append(snippet)
+    if counts is not None:
+        _count_editables(snippet, counts)
     return spec
 
 
@@ -152,8 +197,10 @@ class Spec4Anything(Interface):
         ds_path = PathRI(dataset.path)
         # ###
 
-        updated_files = []
-        paths = []
+        # Note: Snippets are collected per specification file first, so that
+        # each file is read and written only once, no matter how many paths
+        # are to be added to it. If we fail amidst, nothing is written.
+        paths_by_spec = OrderedDict()
         for ap in AnnotatePaths.__call__(
                 dataset=dataset,
                 path=path,
@@ -202,91 +249,96 @@ class Spec4Anything(Interface):
                 else posixpath.join(ds_path.posixpath, acq,
                                     dataset.config.get("datalad.hirni.studyspec.filename",
                                                        "studyspec.json"))
+            paths_by_spec.setdefault(spec_path, []).append(ap)
+
+        spec_props = dict()
+        if properties:
+
+            # TODO: This entire reading of properties needs to be RF'd
+            # into proper generalized functions.
+            # spec got more complex. update() prob. can't simply override
+            # (think: 'procedures' and 'tags' prob. need to be appended
+            # instead)
+
+            # load from file or json string
+            if isinstance(properties, dict):
+                props = properties
+            elif op.exists(properties):
+                props = json_py.load(properties)
+            else:
+                props = json_py.loads(properties)
+            # turn into editable, pre-approved records
+            spec_props = {k: dict(value=v, approved=True)
+                          for k, v in props.items()
+                          if k not in non_editables + ['tags', 'procedures']}
+            spec_props.update({k: v
+                               for k, v in props.items()
+                               if k in non_editables + ['tags']})
+
+            # TODO: still wrong. It's a list. Append or override? How to decide?
+            spec_props.update({o_k: [{i_k: dict(value=i_v, approved=True)
+                                     for i_k, i_v in o_v.items()}]
+                               for o_k, o_v in props.items()
+                               if o_k in ['procedures']})
+
+        from datalad_hirni.support.spec_helpers import sort_spec
+        from datalad_metalad import get_refcommit
+        # nothing is committed before we're done, so the refcommit of the
+        # dataset is the same for all snippets:
+        refcommit = get_refcommit(dataset) if paths_by_spec else None
+        updated_files = []
+        paths = []
+        for spec_path, spec_aps in paths_by_spec.items():
 
-            spec = [r for r in json_py.load_stream(spec_path)] \
-                if posixpath.exists(spec_path) else list()
-
-            lgr.debug("Add specification snippet for %s", ap['path'])
-            # XXX 'add' does not seem to be the thing we want to do
-            # rather 'set', so we have to check whether a spec for a location
-            # is already known and fail or replace it (maybe with --force)
+            spec = SpecContainer.from_file(spec_path)
 
-            # go through all existing specs and extract unique value
-            # and also assign them to the new record (subjects, ...), but only
-            # editable fields!!
-            uniques = dict()
+            # go through all existing specs and count values of editable fields
+            # in order to extract unique values and assign them to the new
+            # records (subjects, ...). The counts are kept up-to-date with
+            # every snippet added, rather than going through the entire spec
+            # again.
+            counts = dict()
             for s in spec:
-                for k in s:
-                    if isinstance(s[k], dict) and 'value' in s[k]:
-                        if k not in uniques:
-                            uniques[k] = set()
-                        uniques[k].add(s[k]['value'])
-            overrides = dict()
-            for k in uniques:
-                if len(uniques[k]) == 1:
-                    overrides[k] = _get_edit_dict(value=uniques[k].pop(),
-                                                  approved=False)
-
-            if properties:
-
-                # TODO: This entire reading of properties needs to be RF'd
-                # into proper generalized functions.
-                # spec got more complex. update() prob. can't simply override
-                # (think: 'procedures' and 'tags' prob. need to be appended
-                # instead)
-
-                # load from file or json string
-                if isinstance(properties, dict):
-                    props = properties
-                elif op.exists(properties):
-                    props = json_py.load(properties)
-                else:
-                    props = json_py.loads(properties)
-                # turn into editable, pre-approved records
-                spec_props = {k: dict(value=v, approved=True)
-                              for k, v in props.items()
-                              if k not in non_editables + ['tags', 'procedures']}
-                spec_props.update({k: v
-                                   for k, v in props.items()
-                                   if k in non_editables + ['tags']})
-
-                # TODO: still wrong. It's a list. Append or override? How to decide?
-                spec_props.update({o_k: [{i_k: dict(value=i_v, approved=True)
-                                         for i_k, i_v in o_v.items()}]
-                                   for o_k, o_v in props.items()
-                                   if o_k in ['procedures']})
-
-                overrides.update(spec_props)
-
-            # TODO: It's probably wrong to use uniques for overwriting! At least
-            # they cannot be used to overwrite values explicitly set in
-            # _add_to_spec like "location", "type", etc.
-            #
-            # But then: This should concern non-editable fields only, right?
-
-            spec = _add_to_spec(spec, posixpath.split(spec_path)[0], ap,
-                                dataset, overrides=overrides, replace=replace)
-
-            # Note: Not sure whether we really want one commit per snippet.
-            #       If not - consider:
-            #       - What if we fail amidst? => Don't write to file yet.
-            #       - What about input paths from different acquisitions?
-            #         => store specs per acquisition in memory
+                _count_editables(s, counts)
+
+            for ap in spec_aps:
+                lgr.debug("Add specification snippet for %s", ap['path'])
+                # XXX 'add' does not seem to be the thing we want to do
+                # rather 'set', so we have to check whether a spec for a
+                # location is already known and fail or replace it (maybe with
+                # --force)
+
+                overrides = _get_unique_overrides(counts)
+                # every snippet gets its own copy of the records:
+                overrides.update(deepcopy(spec_props))
+
+                # TODO: It's probably wrong to use uniques for overwriting! At
+                # least they cannot be used to overwrite values explicitly set
+                # in _add_to_spec like "location", "type", etc.
+                #
+                # But then: This should concern non-editable fields only,
+                # right?
+
+                spec = _add_to_spec(spec, posixpath.split(spec_path)[0], ap,
+                                    dataset, overrides=overrides,
+                                    replace=replace, counts=counts,
+                                    refcommit=refcommit)
+
             # MIH: One commit per line seems silly. why not update all files
             # collect paths of updated files, and give them to a single `add`
             # at the very end?
             # MIH: if we fail, we fail and nothing is committed
-            from datalad_hirni.support.spec_helpers import sort_spec
             json_py.dump2stream(sorted(spec, key=lambda x: sort_spec(x)),
                                 spec_path)
             updated_files.append(spec_path)
 
-            yield get_status_dict(
-                    status='ok',
-                    type=ap['type'],
-                    path=ap['path'],
-                    **res_kwargs)
-            paths.append(ap)
+            for ap in spec_aps:
+                yield get_status_dict(
+                        status='ok',
+                        type=ap['type'],
+                        path=ap['path'],
+                        **res_kwargs)
+                paths.append(ap)
 
         from datalad.dochelpers import single_or_plural
         from os import linesep
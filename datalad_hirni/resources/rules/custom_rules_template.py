@@ -1,5 +1,9 @@
 """Template for writing custom rules for dicom2spec"""
 
+# Note: Guesses of hirni's default rules that are based on the protocol name
+# can be reused via
+# datalad_hirni.support.default_rules.analyze_protocol_name(ProtocolName)
+
 
 class MyDICOM2SpecRules(object):
 
@@ -1,5 +1,11 @@
 """BIDS-specific helper functions"""
 
+import re
+
+from six import string_types
+
+_non_alphanumeric = re.compile(r'[\W_]+')
+
 
 def apply_bids_label_restrictions(value):
     """Sanitize file names for BIDS.
@@ -12,10 +18,7 @@ def apply_bids_label_restrictions(value):
         # spec.
         return None
 
-    from six import string_types
     if not isinstance(value, string_types):
         value = str(value)
 
-    import re
-    pattern = re.compile('[\W_]+')  # check
-    return pattern.sub('', value)
+    return _non_alphanumeric.sub('', value)
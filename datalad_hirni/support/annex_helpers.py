@@ -0,0 +1,361 @@
+"""Helpers to get content into git-annex with as little I/O as possible
+
+git-annex reads every file it adds in order to compute its key. For large
+tarballs, we rather compute the key on our own, while we have the content at
+hand anyway. Archives with lots of small files are extracted in a single
+streaming pass and directories are reflinked (or hard linked) rather than
+copied, before the files are annexed by parallel `git annex add` jobs.
+"""
+
+import hashlib
+import os
+import os.path as op
+import re
+import shutil
+import tarfile
+import tempfile
+from collections import OrderedDict
+
+from datalad.dochelpers import exc_str
+from datalad.support.network import URL
+
+import logging
+lgr = logging.getLogger('datalad.hirni.annex_helpers')
+
+
+# read/write in chunks of that size, when streaming tarballs into the annex:
+_chunk_size = 8 * 1024 * 1024
+
+# hashlib names for the annex backends we can compute keys for on our own:
+_backend_hashes = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'SHA512': 'sha512',
+}
+
+# Linux ioctl to clone a file's extents (reflink) on CoW filesystems:
+_FICLONE = 0x40049409
+
+
+def _annex_key_extension(filename):
+    """Extension as git-annex includes it into keys of *E backends"""
+    # Note: Follows git-annex' default: up to two extensions, each at most
+    # four alphanumeric characters long (annex.maxextensionlength).
+    exts = []
+    for part in reversed(filename.split('.')[1:]):
+        if len(exts) == 2 or not part or len(part) > 4 or \
+                not part.isalnum():
+            break
+        exts.insert(0, part)
+    return ''.join('.' + e for e in exts)
+
+
+def _annex_key(backend, digest, size, filename):
+    ext = _annex_key_extension(filename) if backend.endswith('E') else ''
+    return "{}-s{}--{}{}".format(backend, size, digest, ext)
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _hash_file(path, hash_name):
+    hasher = hashlib.new(hash_name)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _put_with_hash(src, dst, hash_name, mode='auto'):
+    """Put a file's content at `dst` and compute its hash on the way
+
+    Parameters
+    ----------
+    src: str
+    dst: str
+    hash_name: str
+      name of the hashlib algorithm to use
+    mode: {'auto', 'reflink', 'hardlink', 'copy'}
+      'reflink' and 'hardlink' need `src` and `dst` to be on the same
+      filesystem and only read `src` for hashing. 'copy' hashes while
+      streaming the content into `dst`. 'auto' tries a reflink and falls back
+      to 'copy'. Note, that with 'hardlink', `src` becomes read-only once it
+      is in the annex.
+
+    Returns
+    -------
+    tuple
+      (hex digest, mode used)
+    """
+    if mode in ('auto', 'reflink'):
+        try:
+            _reflink(src, dst)
+            return _hash_file(dst, hash_name), 'reflink'
+        except (OSError, ImportError) as e:
+            if op.lexists(dst):
+                os.unlink(dst)
+            if mode == 'reflink':
+                raise
+            lgr.debug("Cannot reflink %s: %s", src, exc_str(e))
+    elif mode == 'hardlink':
+        os.link(src, dst)
+        return _hash_file(dst, hash_name), 'hardlink'
+
+    hasher = hashlib.new(hash_name)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(_chunk_size), b''):
+            hasher.update(chunk)
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+    return hasher.hexdigest(), 'copy'
+
+
+def _get_key_size(key):
+    """Size of the content of an annex key or None if it isn't in the key"""
+    match = re.match(r'^[A-Z0-9]+-s(\d+)-', key)
+    return int(match.group(1)) if match else None
+
+
+def _get_key_digest(key):
+    """Hash digest of an annex key (without extension) or None"""
+    match = re.match(r'^[A-Z0-9]+-s\d+--([0-9a-f]+)', key)
+    return match.group(1) if match else None
+
+
+def _get_backend(repo, path):
+    """Annex backend to be used for `path` in `repo`"""
+    attrs = repo.get_gitattributes(path).get(path, {})
+    return attrs.get('annex.backend') or \
+        repo.config.get('annex.backend', None) or 'SHA256E'
+
+
+def _get_hash_name(backend):
+    """hashlib name for `backend` or None if we can't compute its keys"""
+    return _backend_hashes.get(
+        backend[:-1] if backend.endswith('E') else backend, None)
+
+
+def _call_annex_batch(repo, args, lines):
+    """Run a git-annex command in --batch mode, feeding it `lines`
+
+    Returns
+    -------
+    list of str
+      output lines
+    """
+    if not lines:
+        return []
+    with tempfile.TemporaryFile() as f:
+        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        f.seek(0)
+        out = repo._call_annex(args + ['--batch'], stdin=f)['stdout']
+    return out.splitlines()
+
+
+def _extract_members(tarball, dest):
+    """Extract a tarball into `dest` in a single streaming pass
+
+    Returns
+    -------
+    list of str
+      paths of the extracted files, relative to `dest`
+
+    Raises
+    ------
+    ValueError
+      for members we don't handle (links, devices, paths outside `dest`)
+    """
+    files = []
+    with tarfile.open(tarball, 'r|*') as tar:
+        for member in tar:
+            name = op.normpath(member.name)
+            if op.isabs(name) or name == op.pardir or \
+                    name.startswith(op.pardir + os.sep):
+                raise ValueError("archive member {} points outside of the "
+                                 "archive".format(member.name))
+            if member.isdir():
+                os.makedirs(op.join(dest, name), exist_ok=True)
+                continue
+            if not member.isfile():
+                raise ValueError("archive member {} isn't a regular file"
+                                 "".format(member.name))
+            target = op.join(dest, name)
+            os.makedirs(op.dirname(target), exist_ok=True)
+            with tar.extractfile(member) as fsrc, open(target, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, _chunk_size)
+            files.append(name)
+    return files
+
+
+def _link_file(src, dst, mode='auto'):
+    """Put a file's content at `dst` without copying it, if possible
+
+    Parameters
+    ----------
+    mode: {'auto', 'reflink', 'hardlink', 'copy'}
+      see `_put_with_hash`
+
+    Returns
+    -------
+    str
+      mode used
+    """
+    if mode in ('auto', 'reflink'):
+        try:
+            _reflink(src, dst)
+            return 'reflink'
+        except (OSError, ImportError) as e:
+            if op.lexists(dst):
+                os.unlink(dst)
+            if mode == 'reflink':
+                raise
+            lgr.debug("Cannot reflink %s: %s", src, exc_str(e))
+    elif mode == 'hardlink':
+        os.link(src, dst)
+        return 'hardlink'
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def _link_members(directory, dest, mode='auto'):
+    """Put the files of a directory tree into `dest` (see `_link_file`)
+
+    Returns
+    -------
+    tuple
+      paths of the files relative to `dest` and the mode used. If 'auto'
+      fails to reflink the first file, the rest is copied right away.
+
+    Raises
+    ------
+    ValueError
+      for symlinks and anything else that isn't a regular file or directory
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            src = op.join(root, name)
+            if op.islink(src) or not (op.isdir(src) or op.isfile(src)):
+                raise ValueError("{} isn't a regular file".format(src))
+        for name in sorted(files):
+            src = op.join(root, name)
+            path = op.relpath(src, directory)
+            target = op.join(dest, path)
+            os.makedirs(op.dirname(target), exist_ok=True)
+            used = _link_file(src, target, mode=mode)
+            if mode == 'auto' and used == 'copy':
+                mode = 'copy'
+            paths.append(path)
+    return paths, mode if mode != 'auto' else 'reflink'
+
+
+def _annex_staged(repo, staging, paths, jobs=1):
+    """Annex files staged in `staging` at the same paths in the worktree
+
+    The files are moved into the worktree, so a hard link or reflink into
+    `staging` is never copied, and added by `git annex add` with `jobs`
+    parallel jobs. That way, git-annex decides what goes into git
+    (annex.largefiles) and whether files are unlocked, and it takes care of
+    its object store.
+
+    Returns
+    -------
+    dict
+      annex keys of the files, that were annexed, by path
+    """
+    for path in paths:
+        target = op.join(repo.path, path)
+        os.makedirs(op.dirname(target), exist_ok=True)
+        os.replace(op.join(staging, path), target)
+    repo.add(paths, jobs=jobs)
+    # Note: no key for files added to git
+    return OrderedDict(
+        (p, k) for p, k in zip(paths, repo.get_file_key(paths, batch=True))
+        if k)
+
+
+def _import_directory(repo, directory, mode='auto', jobs=1):
+    """Annex the files of a directory tree into the worktree of `repo`
+
+    The files end up underneath the directory's name. Within a filesystem,
+    the content is reflinked (or hard linked; see `_put_with_hash` for the
+    implications) into the annex rather than copied.
+
+    Returns
+    -------
+    tuple
+      number of files, their total size and the mode used
+
+    Raises
+    ------
+    ValueError
+      if the directory can't be imported this way, before anything in the
+      worktree was changed
+    """
+    name = op.basename(op.normpath(directory))
+    if op.lexists(op.join(repo.path, name)):
+        raise ValueError("{} exists already".format(name))
+    tmp_dir = op.join(str(repo.dot_git), 'annex', 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='hirni-import-', dir=tmp_dir)
+    try:
+        paths, used_mode = _link_members(directory, op.join(staging, name),
+                                         mode=mode)
+        paths = [op.join(name, p) for p in paths]
+        size = sum(op.getsize(op.join(staging, p)) for p in paths)
+        _annex_staged(repo, staging, paths, jobs=jobs)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return len(paths), size, used_mode
+
+
+def _extract_archive(repo, filename, archive_key, jobs=1):
+    """Extract an annexed archive into the worktree of `repo`
+
+    This replaces datalad's add_archive_content for archives with lots of
+    (small) files, which adds every single file via `git annex addurl`. The
+    archive is extracted in one streaming pass, the files are annexed by
+    parallel jobs (see `_annex_staged`) and git-annex is told about their
+    datalad-archives URLs by a batched call. The archive is removed from the
+    worktree afterwards.
+
+    Returns
+    -------
+    int
+      number of extracted files
+
+    Raises
+    ------
+    ValueError
+      if the archive can't be handled this way, before anything in the
+      worktree was changed
+    """
+    archive = op.realpath(op.join(repo.path, filename))
+    tmp_dir = op.join(str(repo.dot_git), 'annex', 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='hirni-extract-', dir=tmp_dir)
+    try:
+        paths = _extract_members(archive, staging)
+        existing = [p for p in paths if op.lexists(op.join(repo.path, p))]
+        if existing:
+            raise ValueError("extracted files exist already: {}"
+                             "".format(existing[:5]))
+        keys = _annex_staged(repo, staging, paths, jobs=jobs)
+        _call_annex_batch(
+            repo, ['registerurl'],
+            ['{} {}'.format(
+                key,
+                URL(scheme='dl+archive', path=archive_key,
+                    fragment=OrderedDict(
+                        [('path', path),
+                         ('size', _get_key_size(key))])))
+             for path, key in keys.items()])
+        repo.call_git(['rm', '-f', '--', filename])
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return len(paths)
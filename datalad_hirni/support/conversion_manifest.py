@@ -0,0 +1,75 @@
+"""Manifest of conversions done by hirni-spec2bids
+
+For every procedure successfully run for a specification snippet, a digest
+of what determines its outcome is recorded along with the commit of the BIDS
+dataset after the procedure ran. That is the snippet (including the commit
+of the source dataset it refers to), the procedure's call format, the values
+substituted into it and the content of the procedure's script. An
+incremental conversion can then skip procedures, whose digest is in the
+manifest with a commit, that is still part of the dataset's history.
+
+Like other state of hirni commands, the manifest is kept in the dataset's
+.git directory and therefore local to a clone.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+
+from fasteners import InterProcessLock
+
+from datalad.support import json_py
+
+
+def get_manifest_file(dataset):
+    return op.join(str(dataset.repo.dot_git), 'datalad', 'hirni',
+                   'spec2bids_manifest.json')
+
+
+def _read(manifest_file):
+    return json_py.load(manifest_file) if op.exists(manifest_file) \
+        else dict()
+
+
+def get_digest(snippet, call_format, substitutions, procedure_version):
+    """Return the digest identifying the conversion of a snippet by a
+    procedure"""
+    return hashlib.sha256(json.dumps(
+        [snippet, call_format, substitutions, procedure_version],
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_procedure_version(path):
+    """Return a digest of a procedure's script"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_manifest(dataset):
+    """Return the conversion manifest of `dataset`
+
+    Returns
+    -------
+    dict
+      maps digests to a dict with the 'commit' of the conversion, the 'spec'
+      file (relative to `dataset`) and the 'procedure' name
+    """
+    return _read(get_manifest_file(dataset))
+
+
+def add_to_manifest(dataset, entries):
+    """Record conversions given as a dict like the one `get_manifest`
+    returns"""
+    if not entries:
+        return
+    manifest_file = get_manifest_file(dataset)
+    os.makedirs(op.dirname(manifest_file), exist_ok=True)
+    with InterProcessLock(manifest_file + '.lck'):
+        manifest = _read(manifest_file)
+        manifest.update(entries)
+        json_py.dump(manifest, manifest_file + '.tmp')
+        os.replace(manifest_file + '.tmp', manifest_file)
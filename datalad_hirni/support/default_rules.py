@@ -4,161 +4,174 @@
 # TODO: RF: Repronim rules to dedicated rule set. Plus: default numbering for runs, aborted run detection etc.
 # Are default rules a fallback or a configured rule set?
 
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 from datalad_hirni.support.BIDS_helper import apply_bids_label_restrictions
+from datalad_hirni.support.subject_rules import \
+    builtin_rules as builtin_subject_rules
 
 
-def _guess_subject(record):
-    # Subject identification depends on scanner site:
-    # Note: This possibly is overspecified ATM. Let's check out all
-    #       scanners before being clear about how to safely distinguish
-    #       them.
-    if record.get("StationName") == "3T-PHILIPSMR" and \
-            record.get(
-                    "InstitutionName") == "Leibniz Institut Magdeburg" and \
-            record.get("Manufacturer") == "Philips Medical Systems" and \
-            record.get("ManufacturerModelName") == "Achieva dStream":
-
-        subject = record.get("PatientName", None)
-    elif record.get("StationName") == "AWP66017" and \
-            record.get("InstitutionName") == "Neurologie" and \
-            record.get("Manufacturer") == "SIEMENS" and \
-            record.get("ManufacturerModelName") == "Prisma":
-
-        subject = record.get("PatientID", None)
-        if subject:
-            subject = subject.split("_")[0]
-    elif record.get("StationName") == "PCR7T1-15" and \
-            record.get("InstitutionName") == "LIN" and \
-            record.get("Manufacturer") == "SIEMENS" and \
-            record.get("ManufacturerModelName") == "Investigational_Device_7T":
-
-        subject = record.get("PatientID", None)
-        if subject:
-            subject = subject.split("_")[0]
-    else:
-        subject = record.get("PatientID", None)
-
-    return subject
+def _guess_subject(record, subject_rules=None):
+    # Subject identification depends on scanner site. See
+    # datalad_hirni.support.subject_rules for how sites are described.
+    if subject_rules is None:
+        subject_rules = builtin_subject_rules
+    return subject_rules.get_subject(record)
 
 
-def _guess_task(record):
+# Note: All of the guesses based on the protocol name are derived from a single
+# tokenization of it. This is done once per distinct protocol name, since
+# typically lots of series share the same protocol.
+
+_protocol_split = re.compile(r'_|-|\s')
+_run_part = re.compile(r'r[0-9]+')
+_session_pattern = re.compile(r"(?<=ses[_-])([a-zA-Z0-9]+)")
+
+_modality_terms = ["t1", "t1w", "t2", "t2w",
+                   "t1rho", "t1map", "t2map", "t2star", "flair",
+                   "flash", "pd", "pdmap", "pdt2", "inplanet1",
+                   "inplanet2", "angio", "dwi", "phasediff",
+                   "phase1", "phase2", "magnitude1", "magnitude2",
+                   "fieldmap", "epi", "meg", "bold"]
+
+
+ProtocolNameAnalysis = namedtuple('ProtocolNameAnalysis',
+                                  ['parts', 'task', 'modality', 'run',
+                                   'session'])
+ProtocolNameAnalysis.__doc__ = \
+    """Guesses derived from a protocol name by `analyze_protocol_name`"""
+
+
+def _pad_run(run):
+    # TODO: Actually check number of runs and do the zero padding
+    # accordingly (prob. still minimum 2 digits)
+    # Q&D:
+    if len(run) == 1:
+        run = "0" + run
+    return run
 
-    protocol = record.get("ProtocolName", None)
-    if protocol:
-        import re
-        prot_parts = re.split('_|-|\s', protocol.lower())
-        try:
-            idx = prot_parts.index("task")
-            task = prot_parts[idx + 1]
-            return task
-        except (ValueError, IndexError):
-            # default to entire protocol name?
-            # This should actually check the results of other guesses
-            # (like modality) to determine a better default than nothing.
-            # At least parts of the protocol name that were already matched elsewhere
-            # should be excluded
-            return None
-    else:
+
+def _guess_task_from_parts(prot_parts):
+    try:
+        idx = prot_parts.index("task")
+        return prot_parts[idx + 1]
+    except (ValueError, IndexError):
         # default to entire protocol name?
-        # see above
+        # This should actually check the results of other guesses
+        # (like modality) to determine a better default than nothing.
+        # At least parts of the protocol name that were already matched elsewhere
+        # should be excluded
         return None
 
 
-def _guess_modality(record):
+def _guess_modality_from_parts(protocol, prot_parts):
+
+    # BEGIN Additional rule for forrest-structural
+    # TODO: Probably to be moved to some rule enhancement
+    if "VEN_BOLD" in protocol:
+        # TODO: Not clear yet; swi might be considered a datatype rather than
+        # a modality by respective BIDS extension:
+        # https://docs.google.com/document/d/1kyw9mGgacNqeMbp4xZet3RnDhcMmf4_BmRgKaOkO2Sc
+        return "swi"
+
+    if "DTI_" in protocol:
+        # TODO: What actually is the relevant part of protocol here?
+        return "dwi"
 
-    protocol = record.get("ProtocolName", None)
-    if protocol:
-
-        # BEGIN Additional rule for forrest-structural
-        # TODO: Probably to be moved to some rule enhancement
-        if "VEN_BOLD" in protocol:
-            # TODO: Not clear yet; swi might be considered a datatype rather than
-            # a modality by respective BIDS extension:
-            # https://docs.google.com/document/d/1kyw9mGgacNqeMbp4xZet3RnDhcMmf4_BmRgKaOkO2Sc
-            return "swi"
-
-        if "DTI_" in protocol:
-            # TODO: What actually is the relevant part of protocol here?
-            return "dwi"
-
-        if "field map" in protocol:
-            return "fieldmap"
-        # END
-
-        import re
-        prot_parts = re.split('_|-|\s', protocol.lower())
-        direct_search_terms = ["t1", "t1w", "t2", "t2w",
-                               "t1rho", "t1map", "t2map", "t2star", "flair",
-                               "flash", "pd", "pdmap", "pdt2", "inplanet1",
-                               "inplanet2", "angio", "dwi", "phasediff",
-                               "phase1", "phase2", "magnitude1", "magnitude2",
-                               "fieldmap", "epi", "meg", "bold"]
-
-        for m in direct_search_terms:
-            if m in prot_parts:
-                return m
-
-        # BEGIN: Additional rule for forrest-structural
-        # TODO: Probably to be moved to some rule enhancement
-        if "st1w" in prot_parts:
-            return "t1w"
-        if "st2w" in prot_parts:
-            return "t2w"
-        if "tof" in prot_parts:
-            return "angio"
-        # END
-
-        # TEMP: Reproin workaround
-        if "func" in prot_parts:
-            return "bold"
+    if "field map" in protocol:
+        return "fieldmap"
+    # END
+
+    parts = set(prot_parts)
+    for m in _modality_terms:
+        if m in parts:
+            return m
+
+    # BEGIN: Additional rule for forrest-structural
+    # TODO: Probably to be moved to some rule enhancement
+    if "st1w" in parts:
+        return "t1w"
+    if "st2w" in parts:
+        return "t2w"
+    if "tof" in parts:
+        return "angio"
+    # END
+
+    # TEMP: Reproin workaround
+    if "func" in parts:
+        return "bold"
 
     # found nothing, but modality isn't necessarily required
     return None
 
 
-def _guess_run(record):
-    protocol = record.get("ProtocolName", None)
-    if protocol:
-        import re
-        prot_parts = re.split('_|-|\s', protocol.lower())
-        try:
-            idx = prot_parts.index("run")
-            run = prot_parts[idx + 1]
-            # TODO: Actually check number of runs and do the zero padding
-            # accordingly (prob. still minimum 2 digits)
-            # Q&D:
-            if len(run) == 1:
-                run = "0" + run
-            return run
-        except (ValueError, IndexError):
-            # no result yet
-            pass
-
-        pattern = re.compile(r'r[0-9]+')
-        for part in prot_parts:
-            match = re.match(pattern, part)
-            if match:
-                run = match.group(0)[1:]
-                # TODO: correct padding; see above
-                if len(run) == 1:
-                    run = "0" + run
-                return run
+def _guess_run_from_parts(prot_parts):
+    try:
+        idx = prot_parts.index("run")
+        return _pad_run(prot_parts[idx + 1])
+    except (ValueError, IndexError):
+        # no result yet
+        pass
+
+    for part in prot_parts:
+        match = _run_part.match(part)
+        if match:
+            # TODO: correct padding; see above
+            return _pad_run(match.group(0)[1:])
     # default to None will lead to counting series with same protocol
     return None
 
 
-def _guess_session(record):
+@lru_cache(maxsize=4096)
+def analyze_protocol_name(protocol):
+    """Derive BIDS related guesses from a protocol name in a single pass
+
+    The protocol name is tokenized once and all guesses are made based on that.
+    Results are memoized per protocol name. Custom rules can use this to build
+    upon (or deviate from) what the default rules guess.
+
+    Parameters
+    ----------
+    protocol: str or None
+      value of a series' 'ProtocolName'
+
+    Returns
+    -------
+    ProtocolNameAnalysis
+      with fields 'parts' (tuple of lower case tokens), 'task', 'modality',
+      'run' and 'session'. Fields are None, if there's nothing to guess from.
+    """
+    if not protocol:
+        return ProtocolNameAnalysis(parts=(), task=None, modality=None,
+                                    run=None, session=None)
+
+    prot_parts = _protocol_split.split(protocol.lower())
+    session = _session_pattern.search(protocol)
+    return ProtocolNameAnalysis(
+        parts=tuple(prot_parts),
+        task=_guess_task_from_parts(prot_parts),
+        modality=_guess_modality_from_parts(protocol, prot_parts),
+        run=_guess_run_from_parts(prot_parts),
+        session=session.group(1) if session else None
+    )
 
-    protocol = record.get("ProtocolName", None)
-    if protocol:
-        import re
-        match = re.search(r"(?<=ses[_-])([a-zA-Z0-9]+).*", protocol)
-        if match:
-            return match.group(1)
-        else:
-            return None
-    else:
-        return None
+
+def _guess_task(record):
+    return analyze_protocol_name(record.get("ProtocolName", None)).task
+
+
+def _guess_modality(record):
+    return analyze_protocol_name(record.get("ProtocolName", None)).modality
+
+
+def _guess_run(record):
+    return analyze_protocol_name(record.get("ProtocolName", None)).run
+
+
+def _guess_session(record):
+    return analyze_protocol_name(record.get("ProtocolName", None)).session
 
 # MPRAGE => T1w
 
@@ -177,15 +190,19 @@ def _guess_session(record):
 
 class DefaultRules(object):
 
-    def __init__(self, dicommetadata):
+    def __init__(self, dicommetadata, subject_rules=None):
         """
 
         Parameter
         ----------
         dicommetadata: list of dict
             dicom metadata as extracted by datalad; one dict per image series
+        subject_rules: SubjectRules or None
+            scanner site based rules to identify the subject. Defaults to the
+            built-in rules.
         """
         self._dicom_series = dicommetadata
+        self._subject_rules = subject_rules
         self.runs = dict()
 
     def __call__(self, subject=None, anon_subject=None, session=None):
@@ -213,8 +230,9 @@ class DefaultRules(object):
                session=None):
 
         protocol_name = series_dict.get('ProtocolName', None)
+        protocol = analyze_protocol_name(protocol_name)
 
-        run = _guess_run(series_dict)
+        run = protocol.run
         # TODO: Default numbering should still fill up leading zero(s)
         if run is None:
             # count appearances of protocol as a guess:
@@ -233,12 +251,12 @@ class DefaultRules(object):
                 # SeriesTime
                 'description': series_dict['SeriesDescription'] if "SeriesDescription" in series_dict else '',
                 'comment': '',
-                'subject': apply_bids_label_restrictions(_guess_subject(series_dict) if not subject else subject),
+                'subject': apply_bids_label_restrictions(_guess_subject(series_dict, self._subject_rules) if not subject else subject),
                 'anon-subject': apply_bids_label_restrictions(anon_subject) if anon_subject else None,
-                'bids-session': apply_bids_label_restrictions(_guess_session(series_dict) if not session else session),
-                'bids-task': apply_bids_label_restrictions(_guess_task(series_dict)),
+                'bids-session': apply_bids_label_restrictions(protocol.session if not session else session),
+                'bids-task': apply_bids_label_restrictions(protocol.task),
                 'bids-run': apply_bids_label_restrictions(run) if run else str(self.runs[protocol_name]),
-                'bids-modality': apply_bids_label_restrictions(_guess_modality(series_dict)),
+                'bids-modality': apply_bids_label_restrictions(protocol.modality),
 
                 # TODO: No defaults yet (May be there shouldn't be defaults, but
                 # right now, that's not a conscious decision ...):
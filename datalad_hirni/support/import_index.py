@@ -0,0 +1,105 @@
+"""Index of DICOM archives and image series imported into a study dataset
+
+Importing an archive is expensive (extraction, metadata, specification), so
+imports record the annex key of the archive and the SeriesInstanceUIDs of
+the image series it contained in an index within the study dataset's .git
+directory. Before importing another archive, it's looked up there in order
+to detect archives (and series) that were imported before, possibly under a
+different name.
+
+Note, that the index is local to the clone of the study dataset imports are
+done in. Entries pointing to acquisitions that don't exist anymore are
+ignored.
+"""
+
+import os
+import os.path as op
+
+from fasteners import InterProcessLock
+
+from datalad.support import json_py
+
+from datalad_hirni.support.annex_helpers import (
+    _get_hash_name,
+    _get_key_digest,
+    _get_key_size,
+    _hash_file,
+)
+
+
+def _get_index_file(dataset):
+    return op.join(str(dataset.repo.dot_git), 'datalad', 'hirni',
+                   'import_index.json')
+
+
+def _read(index_file):
+    index = json_py.load(index_file) if op.exists(index_file) else dict()
+    index.setdefault('archives', dict())
+    index.setdefault('series', dict())
+    return index
+
+
+def _lock(index_file):
+    os.makedirs(op.dirname(index_file), exist_ok=True)
+    return InterProcessLock(index_file + '.lck')
+
+
+def get_index(dataset):
+    """Return the import index of `dataset`
+
+    Returns
+    -------
+    dict
+      'archives' maps annex keys of imported archives and 'series' maps
+      SeriesInstanceUIDs to the acquisition (path relative to `dataset`) they
+      were imported into
+    """
+    return _read(_get_index_file(dataset))
+
+
+def add_to_index(dataset, acquisition, archive_keys=None, series_uids=None):
+    """Record archives and image series as imported into `acquisition`"""
+    index_file = _get_index_file(dataset)
+    with _lock(index_file):
+        index = _read(index_file)
+        for key in archive_keys or []:
+            index['archives'][key] = acquisition
+        for uid in series_uids or []:
+            index['series'].setdefault(uid, acquisition)
+        json_py.dump(index, index_file + '.tmp')
+        os.replace(index_file + '.tmp', index_file)
+
+
+def _exists(dataset, acquisition):
+    return op.isdir(op.join(dataset.path, acquisition))
+
+
+def find_archive(dataset, path):
+    """Return the acquisition a local archive was imported into or None
+
+    Only archives of the same size are compared by content, so the archive
+    is read at most once per hash function used by the keys in the index
+    and not at all, if there's no archive of that size.
+    """
+    size = op.getsize(path)
+    candidates = [(key, acq) for key, acq in get_index(dataset)['archives']
+                  .items()
+                  if _get_key_size(key) == size and _exists(dataset, acq)]
+    digests = dict()
+    for key, acq in candidates:
+        hash_name = _get_hash_name(key.split('-', 1)[0])
+        if hash_name is None:
+            continue
+        if hash_name not in digests:
+            digests[hash_name] = _hash_file(path, hash_name)
+        if digests[hash_name] == _get_key_digest(key):
+            return acq
+    return None
+
+
+def find_series(dataset, uids):
+    """Return a dict mapping those of `uids` that were imported before to
+    their acquisition"""
+    series = get_index(dataset)['series']
+    return {uid: series[uid] for uid in uids
+            if uid in series and _exists(dataset, series[uid])}
@@ -0,0 +1,109 @@
+"""Journal and status of hirni-ingest
+
+hirni-ingest records every archive it picks up from its drop directory in a
+journal within the study dataset's .git directory, along with the state of
+its import:
+
+- 'queued': the archive is complete and waits for a free worker
+- 'importing': a worker is importing it
+- 'done': it was imported and saved to the study dataset
+- 'failed': importing it failed; it isn't retried unless it changes
+
+The journal is an append-only file of JSON records, the last record for a
+path being its current state. After a restart, 'queued' and 'importing'
+archives are imported (or resumed; see hirni-import-dcm) again.
+
+In addition, a status file is (re)written whenever something changes. It
+reports the number of archives per state, the archives currently imported
+and the latency of each stage of the pipeline.
+"""
+
+import json
+import os
+import os.path as op
+import time
+from collections import OrderedDict
+
+from datalad.support import json_py
+
+
+# stages of the pipeline an archive goes through, for latency statistics:
+stages = ('settle', 'queue', 'import', 'commit', 'total')
+
+
+def _get_hirni_dir(dataset):
+    return op.join(str(dataset.repo.dot_git), 'datalad', 'hirni')
+
+
+def get_status_file(dataset):
+    return op.join(_get_hirni_dir(dataset), 'ingest_status.json')
+
+
+class IngestJournal(object):
+    """Persistent state of the archives seen by hirni-ingest in `dataset`"""
+
+    def __init__(self, dataset):
+        self._file = op.join(_get_hirni_dir(dataset), 'ingest_journal')
+        self._status_file = get_status_file(dataset)
+        self.entries = OrderedDict()
+        self.latency = OrderedDict((s, dict(count=0, mean=0.0, max=0.0,
+                                            last=None))
+                                   for s in stages)
+        if op.exists(self._file):
+            for record in json_py.load_stream(self._file):
+                self.entries[record['path']] = record
+            # compact, so the journal doesn't grow forever:
+            json_py.dump2stream(list(self.entries.values()),
+                                self._file + '.tmp')
+            os.replace(self._file + '.tmp', self._file)
+        else:
+            os.makedirs(op.dirname(self._file), exist_ok=True)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def in_state(self, *states):
+        """Return the entries in any of `states`, oldest first"""
+        return [e for e in self.entries.values() if e['state'] in states]
+
+    def update(self, path, **kwargs):
+        """Update the entry for `path` and append it to the journal"""
+        entry = self.entries.setdefault(path, dict(path=path))
+        entry.update(kwargs)
+        with open(self._file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    def add_latency(self, stage, seconds):
+        stats = self.latency[stage]
+        stats['count'] += 1
+        stats['mean'] += (seconds - stats['mean']) / stats['count']
+        stats['max'] = max(stats['max'], seconds)
+        stats['last'] = seconds
+
+    def write_status(self, drop_dir, waiting=0):
+        """Write the status file
+
+        Parameters
+        ----------
+        drop_dir: str
+        waiting: int
+          number of archives in the drop directory, that aren't complete yet
+        """
+        counts = OrderedDict((s, 0) for s in
+                             ('queued', 'importing', 'done', 'failed'))
+        for e in self.entries.values():
+            counts[e['state']] += 1
+        status = OrderedDict([
+            ('pid', os.getpid()),
+            ('updated', time.time()),
+            ('drop-dir', drop_dir),
+            ('waiting', waiting),
+            ('counts', counts),
+            ('importing', [e['path'] for e in self.in_state('importing')]),
+            ('latency', self.latency),
+        ])
+        json_py.dump(status, self._status_file + '.tmp')
+        os.replace(self._status_file + '.tmp', self._status_file)
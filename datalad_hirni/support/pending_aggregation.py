@@ -0,0 +1,66 @@
+"""Queue of acquisitions, whose metadata is yet to be aggregated
+
+Aggregating metadata into the study dataset rewrites its aggregated metadata
+store, which gets slower with every acquisition. Imports can therefore defer
+that and just record the imported subdataset in a queue file within the
+study dataset's .git directory. All pending subdatasets are then aggregated
+in one go by hirni-aggregate-pending. Until then, their metadata is available
+from the subdatasets themselves.
+
+The same kind of queue is used for other deferred work on imported
+subdatasets, namely dropping their extracted content ('drop') and garbage
+collecting their git objects ('gc'); see hirni-cleanup.
+"""
+
+import os
+import os.path as op
+
+from fasteners import InterProcessLock
+
+
+def _get_queue_file(dataset, queue='aggregation'):
+    return op.join(str(dataset.repo.dot_git), 'datalad', 'hirni',
+                   'pending_' + queue)
+
+
+def _read(queue_file):
+    if not op.exists(queue_file):
+        return []
+    with open(queue_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _lock(queue_file):
+    os.makedirs(op.dirname(queue_file), exist_ok=True)
+    return InterProcessLock(queue_file + '.lck')
+
+
+def get_pending(dataset, queue='aggregation'):
+    """Return absolute paths of subdatasets pending aggregation into
+    `dataset` (or pending whatever else `queue` is about)"""
+    return [op.join(dataset.path, p)
+            for p in _read(_get_queue_file(dataset, queue))]
+
+
+def add_pending(dataset, paths, queue='aggregation'):
+    """Record subdatasets at `paths` as pending aggregation into `dataset`"""
+    queue_file = _get_queue_file(dataset, queue)
+    with _lock(queue_file):
+        pending = _read(queue_file)
+        with open(queue_file, 'a') as f:
+            for p in paths:
+                p = op.relpath(p, dataset.path)
+                if p not in pending:
+                    pending.append(p)
+                    f.write(p + '\n')
+
+
+def remove_pending(dataset, paths, queue='aggregation'):
+    """Remove subdatasets at `paths` from the queue of `dataset`"""
+    queue_file = _get_queue_file(dataset, queue)
+    remove = set(op.relpath(p, dataset.path) for p in paths)
+    with _lock(queue_file):
+        pending = [p for p in _read(queue_file) if p not in remove]
+        with open(queue_file + '.tmp', 'w') as f:
+            f.writelines(p + '\n' for p in pending)
+        os.replace(queue_file + '.tmp', queue_file)
@@ -5,6 +5,15 @@
 
 # Also: heuristic to resources?
 
+import json
+import os.path as op
+from bisect import (
+    bisect_left,
+    insort
+)
+
+from datalad.support import json_py
+
 
 def sort_spec(spec):
     """Helper to provide a key function for `sorted`
@@ -35,3 +44,125 @@ def get_specval(spec, key):
 
 def has_specval(spec, key):
     return key in spec and 'value' in spec[key] and spec[key]['value']
+
+
+def _index_key(value):
+    # values of editable fields come from JSON and therefore may be lists or
+    # dicts, which can't be used as dict keys as is:
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class SpecContainer(object):
+    """In-memory study specification with indexed snippet lookup
+
+    Holds the snippets of a specification in their original order, while
+    maintaining indexes on 'uid', 'type' and ('type', 'location', 'id'). That
+    way finding the snippet to update doesn't require a scan over the entire
+    specification. Snippets must not be modified in place with respect to
+    those keys, use `update` instead to keep the indexes consistent.
+    """
+
+    def __init__(self, snippets=None):
+        """
+        Parameters
+        ----------
+        snippets: iterable of dict or None
+          specification snippets to start with
+        """
+        self._snippets = []
+        # snippet positions by index name and key:
+        self._indexes = {'uid': dict(), 'type': dict(), 'location': dict()}
+        self._pos = dict()
+        for s in snippets or []:
+            self.append(s)
+
+    @classmethod
+    def from_file(cls, path):
+        """Load specification from a JSON stream file
+
+        A non-existing `path` results in an empty specification.
+        """
+        return cls(json_py.load_stream(path) if op.exists(path) else None)
+
+    def __iter__(self):
+        return iter(self._snippets)
+
+    def __len__(self):
+        return len(self._snippets)
+
+    def __getitem__(self, idx):
+        return self._snippets[idx]
+
+    @staticmethod
+    def _location_key(snippet):
+        id_ = snippet.get('id')
+        return (snippet.get('type'),
+                snippet.get('location'),
+                _index_key(id_.get('value') if isinstance(id_, dict) else id_))
+
+    def _index_keys(self, snippet):
+        keys = {'type': snippet.get('type'),
+                'location': self._location_key(snippet)}
+        if 'uid' in snippet:
+            keys['uid'] = snippet['uid']
+        return keys
+
+    def append(self, snippet):
+        """Add a snippet at the end of the specification"""
+        pos = len(self._snippets)
+        self._snippets.append(snippet)
+        self._pos[id(snippet)] = pos
+        # new snippet has the highest position, so index lists stay sorted:
+        for name, key in self._index_keys(snippet).items():
+            self._indexes[name].setdefault(key, []).append(pos)
+        return snippet
+
+    def update(self, snippet, values):
+        """Update an existing snippet with `values` and reindex it
+
+        Parameters
+        ----------
+        snippet: dict
+          snippet as returned by any of the getters of this container
+        values: dict
+          passed on to `dict.update` of `snippet`
+        """
+        # identity, not equality - there may be identical snippets:
+        pos = self._pos.get(id(snippet))
+        if pos is None or self._snippets[pos] is not snippet:
+            raise ValueError("snippet is not part of this specification")
+        old_keys = self._index_keys(snippet)
+        snippet.update(values)
+        new_keys = self._index_keys(snippet)
+        # indexes hold positions rather than the snippets themselves, so
+        # lookups return matches in specification order even after updates:
+        for name, key in old_keys.items():
+            if name in new_keys and new_keys[name] == key:
+                continue
+            positions = self._indexes[name][key]
+            del positions[bisect_left(positions, pos)]
+            if not positions:
+                del self._indexes[name][key]
+        for name, key in new_keys.items():
+            if name in old_keys and old_keys[name] == key:
+                continue
+            insort(self._indexes[name].setdefault(key, []), pos)
+        return snippet
+
+    def get_by_type(self, type_):
+        """Return list of snippets of type `type_` in specification order"""
+        return [self._snippets[p] for p in self._indexes['type'].get(type_, [])]
+
+    def get_by_uid(self, uid, type_=None):
+        """Return list of snippets with `uid` (and type `type_` if given)"""
+        return [self._snippets[p] for p in self._indexes['uid'].get(uid, [])
+                if type_ is None or self._snippets[p].get('type') == type_]
+
+    def get_by_location(self, type_, location, id_):
+        """Return list of snippets matching type, location and id value"""
+        return [self._snippets[p] for p in self._indexes['location'].get(
+            (type_, location, _index_key(id_)), [])]
@@ -0,0 +1,176 @@
+"""Declarative rules for identifying the subject based on the scanner site
+
+Which DICOM field holds the subject identifier (and how to extract it from
+that field) depends on the scanner site. Rather than hard-coding this, sites
+are described by a table of rules. Each rule consists of the scanner
+signature (values of `signature_fields`) and specifies the field to take the
+subject from:
+
+    [{"StationName": "AWP66017",
+      "InstitutionName": "Neurologie",
+      "Manufacturer": "SIEMENS",
+      "ManufacturerModelName": "Prisma",
+      "subject-field": "PatientID",
+      "split": "_",
+      "split-index": 0}]
+
+"split" and "split-index" are optional. If given, the field's value is split
+by "split" and the part at "split-index" (default: 0) is used. A value, that
+can't be split that way, is used as it is.
+
+Additional tables can be provided as JSON (or YAML, if PyYAML is available)
+files via the config variable datalad.hirni.dicom2spec.subject-rules. Rules
+in such files take precedence over built-in ones with the same signature.
+"""
+
+import hashlib
+import json
+import os.path as op
+
+from datalad.dochelpers import exc_str
+from datalad.support import json_py
+
+import logging
+lgr = logging.getLogger('datalad.hirni.subject_rules')
+
+
+signature_fields = ('StationName', 'InstitutionName', 'Manufacturer',
+                    'ManufacturerModelName')
+
+# field to use if no rule matches a series' signature
+default_subject_field = 'PatientID'
+
+# Note: This possibly is overspecified ATM. Let's check out all
+#       scanners before being clear about how to safely distinguish
+#       them.
+builtin_subject_rules = [
+    {"StationName": "3T-PHILIPSMR",
+     "InstitutionName": "Leibniz Institut Magdeburg",
+     "Manufacturer": "Philips Medical Systems",
+     "ManufacturerModelName": "Achieva dStream",
+     "subject-field": "PatientName"},
+    {"StationName": "AWP66017",
+     "InstitutionName": "Neurologie",
+     "Manufacturer": "SIEMENS",
+     "ManufacturerModelName": "Prisma",
+     "subject-field": "PatientID",
+     "split": "_"},
+    {"StationName": "PCR7T1-15",
+     "InstitutionName": "LIN",
+     "Manufacturer": "SIEMENS",
+     "ManufacturerModelName": "Investigational_Device_7T",
+     "subject-field": "PatientID",
+     "split": "_"},
+]
+
+
+def _load_rule_file(path):
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is required to read it")
+        with open(path) as f:
+            return yaml.safe_load(f)
+    return json_py.load(path)
+
+
+class SubjectRules(object):
+    """Scanner signature based subject identification
+
+    Rules are compiled into a hash index on the signature tuple, so the lookup
+    for a series doesn't depend on the number of rules.
+    """
+
+    def __init__(self, rules=None):
+        """
+        Parameters
+        ----------
+        rules: list of dict or None
+          rules in addition to (and taking precedence over) the built-in ones
+        """
+        self._index = dict()
+        self._rules = []
+        for rule in builtin_subject_rules + list(rules or []):
+            self.add(rule)
+
+    def add(self, rule):
+        """Add a rule; replaces an existing one with the same signature"""
+        missing = [f for f in signature_fields + ('subject-field',)
+                   if f not in rule]
+        if missing:
+            raise ValueError("Subject rule {} misses key(s) {}"
+                             "".format(rule, missing))
+        self._rules.append(rule)
+        self._index[tuple(rule[f] for f in signature_fields)] = rule
+
+    @property
+    def digest(self):
+        """Hash of the effective rules; changes whenever a rule does"""
+        return hashlib.sha1(json.dumps(self._rules, sort_keys=True)
+                            .encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_files(cls, paths):
+        """Build rules from built-in ones plus those defined in `paths`"""
+        rules = []
+        for path in paths:
+            try:
+                loaded = _load_rule_file(path)
+            except Exception as e:
+                raise ValueError("Subject rules file {} is broken: {}"
+                                 "".format(path, e))
+            if not isinstance(loaded, list):
+                raise ValueError("Subject rules file {} must contain a list "
+                                 "of rules".format(path))
+            rules.extend(loaded)
+        return cls(rules)
+
+    @classmethod
+    def from_config(cls, cfg, basepath=None):
+        """Build rules as configured in `cfg`
+
+        Relative paths in datalad.hirni.dicom2spec.subject-rules are
+        interpreted relative to `basepath` (a dataset's root).
+        """
+        from datalad.utils import assure_list
+        paths = assure_list(cfg.get("datalad.hirni.dicom2spec.subject-rules"))
+        if basepath:
+            paths = [op.join(basepath, p) for p in paths]
+        lgr.debug("loading subject rules from: %s", paths)
+        return cls.from_files(paths)
+
+    def get_rule(self, record):
+        """Return the rule matching `record`'s scanner signature or None"""
+        return self._index.get(tuple(record.get(f) for f in signature_fields))
+
+    def get_subject(self, record):
+        """Guess the subject identifier for a series
+
+        Parameters
+        ----------
+        record: dict
+          DICOM metadata of a series
+
+        Returns
+        -------
+        str or None
+        """
+        rule = self.get_rule(record)
+        if rule is None:
+            return record.get(default_subject_field, None)
+        subject = record.get(rule['subject-field'], None)
+        if subject and rule.get('split'):
+            try:
+                subject = subject.split(
+                    rule['split'])[rule.get('split-index', 0)]
+            except (AttributeError, IndexError, TypeError) as e:
+                # value doesn't fit the rule; better than no subject at all
+                lgr.warning("Cannot split %s %r by %r as the subject rule "
+                            "says (%s). Using it as is.",
+                            rule['subject-field'], subject, rule['split'],
+                            exc_str(e))
+        return subject
+
+
+builtin_rules = SubjectRules()
@@ -0,0 +1,127 @@
+"""Dependency graph of tasks, like the conversion procedures of a study
+
+Tasks are added along with the tasks they depend on, which need to be known
+already. Hence the graph can't have cycles. A task becomes ready, once all of
+its dependencies succeeded. If a task fails, all tasks depending on it
+(directly or indirectly) are blocked and never become ready.
+"""
+
+from collections import OrderedDict
+import heapq
+
+
+class TaskGraph(object):
+
+    def __init__(self):
+        # key -> task
+        self._tasks = OrderedDict()
+        # key -> set of keys it depends on
+        self._deps = dict()
+        # key -> list of keys depending on it
+        self._dependents = dict()
+        # key -> number of its dependencies, that didn't succeed (yet)
+        self._waiting = dict()
+        # key -> position in the order tasks were added
+        self._order = dict()
+        # heap of (position, key) of tasks, that became ready; might contain
+        # tasks started already
+        self._ready = []
+        # key -> None (pending), 'running', 'ok', 'failed' or 'blocked'
+        self._state = dict()
+        # key of a blocked task -> key of the failed task blocking it
+        self._blocked = OrderedDict()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __getitem__(self, key):
+        return self._tasks[key]
+
+    def add(self, key, task, after=None):
+        """Add `task` depending on tasks with keys `after`"""
+        if key in self._tasks:
+            raise ValueError("duplicate task {}".format(key))
+        after = set(after or [])
+        unknown = [k for k in after if k not in self._tasks]
+        if unknown:
+            raise ValueError("unknown dependencies of {}: {}".format(
+                key, sorted(unknown)))
+        self._tasks[key] = task
+        self._deps[key] = after
+        self._dependents[key] = []
+        for d in after:
+            self._dependents[d].append(key)
+        self._waiting[key] = sum(1 for d in after if self._state[d] != 'ok')
+        self._order[key] = len(self._order)
+        self._state[key] = None
+        if not self._waiting[key]:
+            heapq.heappush(self._ready, (self._order[key], key))
+
+    def dependencies(self, key):
+        """Return keys of the tasks `key` depends on directly"""
+        return set(self._deps[key])
+
+    def ready(self):
+        """Return keys of all tasks, that can be run now, in the order they
+        were added"""
+        return [k for _, k in sorted(self._ready)
+                if self._state[k] is None and not self._waiting[k]]
+
+    def start(self, key):
+        self._state[key] = 'running'
+
+    def finish(self, key, ok):
+        """Record a task's outcome and block what depends on a failed task
+
+        Returns
+        -------
+        list
+          keys of tasks, that got blocked
+        """
+        self._state[key] = 'ok' if ok else 'failed'
+        if ok:
+            for k in self._dependents[key]:
+                self._waiting[k] -= 1
+                if not self._waiting[k] and self._state[k] is None:
+                    heapq.heappush(self._ready, (self._order[k], k))
+            return []
+        blocked = []
+        failed = [key]
+        while failed:
+            for k in self._dependents[failed.pop()]:
+                if self._state[k] is None:
+                    self._state[k] = 'blocked'
+                    failed.append(k)
+                    blocked.append(k)
+        blocked.sort(key=self._order.get)
+        for k in blocked:
+            self._blocked[k] = key
+        return blocked
+
+    def blocked(self):
+        """Return a dict mapping keys of blocked tasks to the key of the
+        failed task, that blocked them"""
+        return OrderedDict(self._blocked)
+
+    def run(self, func):
+        """Run all tasks one after another, respecting their dependencies
+
+        Of the tasks ready to run, the one added first is run first. `func`
+        is called with a task's key and is expected to return a generator.
+        Whatever it yields is passed on. The task is considered failed, if
+        anything it yields is a dict with a 'status' other than 'ok' or
+        'notneeded'.
+        """
+        while self._ready:
+            key = heapq.heappop(self._ready)[1]
+            if self._state[key] is not None:
+                # started by someone else
+                continue
+            self.start(key)
+            ok = True
+            for r in func(key):
+                if isinstance(r, dict) and \
+                        r.get('status') not in (None, 'ok', 'notneeded'):
+                    ok = False
+                yield r
+            self.finish(key, ok)
@@ -0,0 +1,64 @@
+"""Test deferred metadata aggregation"""
+
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.tests.utils import (
+    assert_equal,
+    assert_result_count,
+    with_tempfile
+)
+from datalad_neuroimaging.tests.utils import create_dicom_tarball
+
+from datalad_hirni.support.pending_aggregation import (
+    add_pending,
+    get_pending,
+    remove_pending,
+)
+
+
+@with_tempfile(mkdir=True)
+def test_pending_queue(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    assert_equal(get_pending(ds), [])
+    add_pending(ds, [opj(path, 'acq1', 'dicoms'), opj(path, 'acq2', 'dicoms')])
+    add_pending(ds, [opj(path, 'acq1', 'dicoms'), opj(path, 'acq3', 'dicoms')])
+    assert_equal(get_pending(ds), [opj(path, acq, 'dicoms')
+                                   for acq in ('acq1', 'acq2', 'acq3')])
+    remove_pending(ds, [opj(path, 'acq2', 'dicoms')])
+    assert_equal(get_pending(ds), [opj(path, 'acq1', 'dicoms'),
+                                   opj(path, 'acq3', 'dicoms')])
+    # queue isn't part of the dataset's content:
+    assert not ds.repo.dirty
+
+
+@with_tempfile(mkdir=True)
+def test_aggregate_pending_vanished(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    add_pending(ds, [opj(path, 'gone', 'dicoms')])
+    res = ds.hirni_aggregate_pending()
+    assert_result_count(res, 1, status='notneeded',
+                        path=opj(path, 'gone', 'dicoms'))
+    assert_equal(get_pending(ds), [])
+    assert_equal(ds.hirni_aggregate_pending(), [])
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile
+def test_import_deferred_aggregation(src, path):
+
+    filename = opj(src, "structural.tar.gz")
+    create_dicom_tarball(flavor="structural", path=filename)
+    ds = Dataset(path).create()
+    ds.hirni_import_dcm(path=filename, acqid='acq1', defer_aggregation=True)
+    # the metadata aggregated into the DICOM dataset is saved:
+    assert not ds.repo.dirty
+    assert_equal(get_pending(ds), [opj(ds.path, 'acq1', 'dicoms')])
+
+    res = ds.hirni_aggregate_pending()
+    assert_result_count(res, 1, action='hirni aggregate pending', status='ok',
+                        path=opj(ds.path, 'acq1', 'dicoms'))
+    assert_equal(get_pending(ds), [])
+    assert not ds.repo.dirty
@@ -0,0 +1,182 @@
+"""Test helpers for getting content into git-annex"""
+
+import os
+import tarfile
+from io import BytesIO
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+    ok_file_under_git,
+    with_tempfile
+)
+
+from datalad_hirni.support.annex_helpers import (
+    _annex_staged,
+    _extract_archive,
+    _extract_members,
+    _import_directory,
+    _link_members,
+)
+
+
+def _make_tarball(path, files):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, BytesIO(content))
+
+
+def _write_files(path, files):
+    for name, content in files.items():
+        os.makedirs(opj(path, os.path.dirname(name)), exist_ok=True)
+        with open(opj(path, name), 'wb') as f:
+            f.write(content)
+
+
+@with_tempfile(mkdir=True)
+def test_extract_members(path):
+
+    files = {'series{}/img{}.dcm'.format(s, i): os.urandom(100 + i)
+             for s in range(3) for i in range(20)}
+    tarball = opj(path, 'session.tar.gz')
+    _make_tarball(tarball, files)
+
+    dest = opj(path, 'extracted')
+    paths = _extract_members(tarball, dest)
+    assert_equal(sorted(paths), sorted(files))
+    for p in paths:
+        with open(opj(dest, p), 'rb') as f:
+            assert_equal(f.read(), files[p])
+
+    # refuse members pointing outside:
+    evil = opj(path, 'evil.tar.gz')
+    _make_tarball(evil, {'../outside': b'x'})
+    assert_raises(ValueError, _extract_members, evil, opj(path, 'evil'))
+
+
+@with_tempfile(mkdir=True)
+def test_link_members(path):
+
+    src = opj(path, 'session')
+    files = {opj('series{}'.format(s), 'img{}.dcm'.format(i)): os.urandom(10)
+             for s in range(2) for i in range(3)}
+    _write_files(src, files)
+
+    paths, mode = _link_members(src, opj(path, 'hardlinked'),
+                                mode='hardlink')
+    assert_equal(mode, 'hardlink')
+    assert_equal(paths, sorted(files))
+    for p in paths:
+        assert_equal(os.stat(opj(path, 'hardlinked', p)).st_ino,
+                     os.stat(opj(src, p)).st_ino)
+
+    paths, mode = _link_members(src, opj(path, 'copied'), mode='copy')
+    assert_equal(mode, 'copy')
+    for p in paths:
+        with open(opj(path, 'copied', p), 'rb') as f:
+            assert_equal(f.read(), files[p])
+    # 'auto' either reflinks or copies all of them:
+    paths, mode = _link_members(src, opj(path, 'auto'))
+    assert mode in ('reflink', 'copy')
+    assert_equal(len(paths), len(files))
+
+    os.symlink(opj(src, paths[0]), opj(src, 'link'))
+    assert_raises(ValueError, _link_members, src, opj(path, 'evil'))
+
+
+@with_tempfile(mkdir=True)
+def test_annex_staged(path):
+
+    ds = Dataset(opj(path, 'ds')).create()
+    # annex.largefiles is up to git-annex:
+    ds.repo.set_gitattributes([('*.txt', {'annex.largefiles': 'nothing'})])
+    ds.save(message="keep text in git")
+    files = {opj('series1', 'img1.dcm'): os.urandom(100),
+             opj('series1', 'img2.dcm'): os.urandom(101),
+             'README.txt': b'no DICOM'}
+    staging = opj(ds.repo.dot_git, 'annex', 'tmp', 'staging')
+    _write_files(staging, files)
+
+    keys = _annex_staged(ds.repo, staging, sorted(files), jobs=2)
+    assert_equal(sorted(keys), [opj('series1', 'img1.dcm'),
+                                opj('series1', 'img2.dcm')])
+    for p, content in files.items():
+        assert not os.path.lexists(opj(staging, p))
+        with open(opj(ds.path, p), 'rb') as f:
+            assert_equal(f.read(), content)
+    for p, key in keys.items():
+        ok_file_under_git(opj(ds.path, p), annexed=True)
+        assert_equal(ds.repo.get_file_key(p), key)
+    ok_file_under_git(opj(ds.path, 'README.txt'), annexed=False)
+    assert all(r['success'] for r in ds.repo.fsck(list(keys)))
+
+
+@with_tempfile(mkdir=True)
+def test_extract_archive(path):
+    from datalad.consts import (
+        ARCHIVES_SPECIAL_REMOTE,
+        DATALAD_SPECIAL_REMOTES_UUIDS,
+    )
+
+    ds = Dataset(opj(path, 'ds')).create()
+    ds.repo.init_remote(
+        ARCHIVES_SPECIAL_REMOTE,
+        options=['encryption=none', 'type=external',
+                 'externaltype=%s' % ARCHIVES_SPECIAL_REMOTE,
+                 'autoenable=true',
+                 'uuid={}'.format(
+                     DATALAD_SPECIAL_REMOTES_UUIDS[ARCHIVES_SPECIAL_REMOTE])])
+    files = {'series{}/img{}.dcm'.format(s, i): os.urandom(100 + i)
+             for s in range(2) for i in range(5)}
+    _make_tarball(opj(ds.path, 'session.tar.gz'), files)
+    ds.save(message="add archive")
+    archive_key = ds.repo.get_file_key('session.tar.gz')
+
+    assert_equal(_extract_archive(ds.repo, 'session.tar.gz', archive_key,
+                                  jobs=2),
+                 len(files))
+    assert not os.path.lexists(opj(ds.path, 'session.tar.gz'))
+    for p, content in files.items():
+        ok_file_under_git(opj(ds.path, p), annexed=True)
+        with open(opj(ds.path, p), 'rb') as f:
+            assert_equal(f.read(), content)
+        # content can be retrieved from the archive:
+        assert ds.repo.get_urls(p)[0].startswith(
+            'dl+archive:{}#path={}'.format(archive_key, p))
+    ds.save(message="extracted")
+
+    # doesn't overwrite anything:
+    ds.repo.call_git(['checkout', 'HEAD~1', '--', 'session.tar.gz'])
+    assert_raises(ValueError, _extract_archive, ds.repo, 'session.tar.gz',
+                  archive_key)
+
+
+@with_tempfile(mkdir=True)
+def test_import_directory(path):
+
+    src = opj(path, 'session')
+    files = {opj('series{}'.format(s), 'img{}.dcm'.format(i)): os.urandom(10)
+             for s in range(2) for i in range(3)}
+    _write_files(src, files)
+
+    ds = Dataset(opj(path, 'ds')).create()
+    n_files, size, mode = _import_directory(ds.repo, src, mode='copy',
+                                            jobs=2)
+    assert_equal((n_files, size, mode), (len(files), 10 * len(files), 'copy'))
+    for p, content in files.items():
+        ok_file_under_git(opj(ds.path, 'session', p), annexed=True)
+        with open(opj(ds.path, 'session', p), 'rb') as f:
+            assert_equal(f.read(), content)
+    assert_raises(ValueError, _import_directory, ds.repo, src)
+
+    # unlocked files are up to git-annex as well:
+    ds = Dataset(opj(path, 'unlocked')).create()
+    ds.config.set('annex.addunlocked', 'true', where='local')
+    _import_directory(ds.repo, src, mode='copy')
+    for p in files:
+        assert not os.path.islink(opj(ds.path, 'session', p))
+        assert ds.repo.get_file_key(opj('session', p))
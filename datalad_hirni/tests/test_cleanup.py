@@ -0,0 +1,66 @@
+"""Test deferred drop and gc of imported acquisitions"""
+
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+    assert_result_count,
+    with_tempfile
+)
+
+from datalad_hirni.support.pending_aggregation import (
+    add_pending,
+    get_pending,
+)
+
+
+@with_tempfile(mkdir=True)
+def test_cleanup_policies(path):
+    from datalad_hirni.commands.import_dicoms import _get_cleanup_policies
+
+    ds = Dataset(path).create(no_annex=True)
+    assert_equal(_get_cleanup_policies(ds), ('import', 'import'))
+    ds.config.set('datalad.hirni.import.drop', 'convert', where='local')
+    ds.config.set('datalad.hirni.import.gc', 'deferred', where='local')
+    assert_equal(_get_cleanup_policies(ds), ('convert', 'deferred'))
+    ds.config.set('datalad.hirni.import.gc', 'later', where='local')
+    assert_raises(ValueError, _get_cleanup_policies, ds)
+
+
+@with_tempfile(mkdir=True)
+def test_cleanup_gc(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    subs = [Dataset(opj(path, acq, 'dicoms')).create(no_annex=True)
+            for acq in ('acq1', 'acq2')]
+    add_pending(ds, [s.path for s in subs] + [opj(path, 'gone', 'dicoms')],
+                queue='gc')
+    # other queues aren't affected:
+    add_pending(ds, [subs[0].path])
+
+    res = ds.hirni_cleanup(jobs=2)
+    assert_result_count(res, 3)
+    assert_result_count(res, 2, status='ok', action='hirni gc')
+    assert_result_count(res, 1, status='notneeded',
+                        path=opj(path, 'gone', 'dicoms'))
+    assert_equal(get_pending(ds, queue='gc'), [])
+    assert_equal(get_pending(ds), [subs[0].path])
+    assert_equal(ds.hirni_cleanup(), [])
+
+
+@with_tempfile(mkdir=True)
+def test_drop_converted(path):
+    from datalad_hirni.commands.spec2bids import _drop_converted
+
+    ds = Dataset(path).create(no_annex=True)
+    # Note: Gone datasets don't need dropping, but are done with as well
+    add_pending(ds, [opj(path, 'acq1', 'dicoms'), opj(path, 'acq2', 'dicoms')],
+                queue='drop')
+    assert_equal(
+        list(_drop_converted(opj(path, 'acq1', 'studyspec.json'))), [])
+    assert_equal(get_pending(ds, queue='drop'), [opj(path, 'acq2', 'dicoms')])
+
+    ds.hirni_cleanup(drop=True)
+    assert_equal(get_pending(ds, queue='drop'), [])
@@ -0,0 +1,103 @@
+# emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# -*- coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test dicom2spec default rules"""
+
+from datalad.support.json_py import dump
+from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+    with_tempfile
+)
+
+from datalad_hirni.support.default_rules import (
+    analyze_protocol_name,
+    DefaultRules,
+)
+from datalad_hirni.support.subject_rules import SubjectRules
+
+
+def test_analyze_protocol_name():
+
+    a = analyze_protocol_name('func_task-oneback_run-1')
+    assert_equal(a.parts, ('func', 'task', 'oneback', 'run', '1'))
+    assert_equal((a.task, a.modality, a.run, a.session),
+                 ('oneback', 'bold', '01', None))
+
+    a = analyze_protocol_name('anat-T1w_ses-Pre2_r3')
+    assert_equal((a.task, a.modality, a.run, a.session),
+                 (None, 't1w', '03', 'Pre2'))
+
+    # special cases based on the raw protocol name:
+    assert_equal(analyze_protocol_name('VEN_BOLD').modality, 'swi')
+    assert_equal(analyze_protocol_name('DTI_64dir').modality, 'dwi')
+    assert_equal(analyze_protocol_name('my field map').modality, 'fieldmap')
+    # trailing 'task'/'run' without a value:
+    assert analyze_protocol_name('rest_task').task is None
+    assert analyze_protocol_name('rest_run').run is None
+
+    for p in (None, ''):
+        a = analyze_protocol_name(p)
+        assert_equal(a.parts, ())
+        assert a.task is a.modality is a.run is a.session is None
+
+    # memoized:
+    assert analyze_protocol_name('anat-T1w_ses-Pre2_r3') is \
+        analyze_protocol_name('anat-T1w_ses-Pre2_r3')
+
+
+def test_default_rules_run_counting():
+
+    series = [dict(SeriesNumber=i, ProtocolName=p, PatientID='02')
+              for i, p in enumerate(['anat', 'anat', 'func_run-3'], 1)]
+    derived = DefaultRules(series)(subject='01')
+    assert_equal([d['bids-run'] for d, valid in derived], ['1', '2', '03'])
+    assert_equal([d['subject'] for d, valid in derived], ['01'] * 3)
+    assert all(valid for d, valid in derived)
+
+
+@with_tempfile
+def test_subject_rules(path):
+
+    prisma = dict(StationName='AWP66017', InstitutionName='Neurologie',
+                  Manufacturer='SIEMENS', ManufacturerModelName='Prisma')
+    philips = dict(StationName='3T-PHILIPSMR',
+                   InstitutionName='Leibniz Institut Magdeburg',
+                   Manufacturer='Philips Medical Systems',
+                   ManufacturerModelName='Achieva dStream')
+    series = [dict(prisma, PatientID='02_xyz', PatientName='name'),
+              dict(philips, PatientID='id', PatientName='03'),
+              dict(PatientID='04', PatientName='other')]
+    for i, s in enumerate(series, 1):
+        s['SeriesNumber'] = i
+
+    # built-in rules:
+    assert_equal([d['subject'] for d, valid in DefaultRules(series)()],
+                 ['02', '03', '04'])
+
+    # custom rule overrides a built-in one for the same signature:
+    dump([dict(prisma, **{'subject-field': 'PatientID', 'split': '_',
+                          'split-index': 1})], path)
+    rules = SubjectRules.from_files([path])
+    assert_equal(rules.get_subject(series[0]), 'xyz')
+    assert_equal(rules.get_subject(series[1]), '03')
+    assert rules.digest != SubjectRules().digest
+    assert_equal(
+        [d['subject'] for d, valid in DefaultRules(series,
+                                                   subject_rules=rules)()],
+        ['xyz', '03', '04'])
+    # values not fitting the rule are taken as they are:
+    assert_equal(rules.get_subject(dict(prisma, PatientID='02')), '02')
+    assert_equal(rules.get_subject(dict(prisma, PatientID=2)), 2)
+
+    # invalid rules:
+    dump([dict(prisma)], path)
+    assert_raises(ValueError, SubjectRules.from_files, [path])
+    dump(dict(prisma), path)
+    assert_raises(ValueError, SubjectRules.from_files, [path])
@@ -9,7 +9,9 @@
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Test dicom2spec command; DICOM metadata based specification creation"""
 
+import os
 import os.path as op
+import sys
 
 from unittest.mock import patch
 from datalad.api import (
@@ -20,9 +22,11 @@ from datalad.api import (
 from datalad.tests.utils import (
     assert_result_count,
     assert_in,
+    assert_raises,
     known_failure_windows,
     known_failure_osx,
     ok_clean_git,
+    skip_if_no_module,
     with_tempfile,
     assert_equal
 )
@@ -316,3 +320,332 @@ def test_dicom2spec(path, toolbox_url):
     mtime = stat(op.join(ds.path, '.gitattributes')).st_mtime
     res = ds.hirni_dicom2spec(path='acq100', spec='spec_structural.json')
     assert_equal(stat(op.join(ds.path, '.gitattributes')).st_mtime, mtime)
+
+
+def test_ignore_duplicate_runs():
+    from datalad_hirni.commands.dicom2spec import ignore_duplicate_runs
+
+    def _snippet(id_, description, run, type_='dicomseries'):
+        return {'type': type_,
+                'tags': [],
+                'id': {'value': id_, 'approved': False},
+                'description': {'value': description, 'approved': False},
+                'bids-run': {'value': run, 'approved': False}}
+
+    spec = [_snippet(3, 'func', '01'),
+            _snippet(1, 'func', '01'),
+            _snippet(2, 'func', '02'),
+            _snippet(4, 'anat', '01'),
+            _snippet(5, 'func', '01'),
+            _snippet(6, 'anat', None),
+            _snippet(7, 'anat', None),
+            {'type': 'dicomseries:all'}]
+
+    ignored = ignore_duplicate_runs(spec)
+    assert_equal(sorted(get_specval(s, 'id') for s in ignored), [1, 3])
+    assert_equal([get_specval(s, 'id') for s in spec
+                  if 'hirni-dicom-converter-ignore' in s.get('tags', [])],
+                 [3, 1])
+
+    # applying it again doesn't tag twice:
+    assert_equal(ignore_duplicate_runs(spec), [])
+    assert_equal(spec[0]['tags'], ['hirni-dicom-converter-ignore'])
+
+
+_rules_template = '''
+class Rules(object):
+    def __init__(self, dicommetadata):
+        self._dicom_series = dicommetadata
+
+    def __call__(self, subject=None, anon_subject=None, session=None):
+        return [({{'comment': '{comment}'}}, True)
+                for s in self._dicom_series]
+
+
+__datalad_hirni_rules = Rules
+'''
+
+
+@with_tempfile(mkdir=True)
+def test_rule_module_cache(path):
+    from datalad_hirni.commands.dicom2spec import (
+        RuleSet,
+        get_rule_cache_stats,
+    )
+
+    ds = Dataset(path).create(no_annex=True)
+    rule_file = op.join(path, 'code', 'my_rules.py')
+    os.makedirs(op.dirname(rule_file))
+    with open(rule_file, 'w') as f:
+        f.write(_rules_template.format(comment='first'))
+    ds.config.add("datalad.hirni.dicom2spec.rules", rule_file, where='local')
+
+    stats = get_rule_cache_stats()
+    res = RuleSet(dataset=ds).apply([{}])
+    assert_equal(res[0]['comment']['value'], 'first')
+    new_stats = get_rule_cache_stats()
+    assert_equal(new_stats['misses'], stats['misses'] + 1)
+
+    # rules are imported once per process:
+    for i in range(3):
+        RuleSet(dataset=ds)
+    stats = get_rule_cache_stats()
+    assert_equal(stats['misses'], new_stats['misses'])
+    assert_equal(stats['hits'], new_stats['hits'] + 3)
+
+    # touching doesn't trigger a reload, but a change does:
+    os.utime(rule_file, ns=(0, 0))
+    RuleSet(dataset=ds)
+    assert_equal(get_rule_cache_stats()['misses'], stats['misses'])
+    with open(rule_file, 'w') as f:
+        f.write(_rules_template.format(comment='second'))
+    res = RuleSet(dataset=ds).apply([{}])
+    assert_equal(res[0]['comment']['value'], 'second')
+    assert_equal(get_rule_cache_stats()['misses'], stats['misses'] + 1)
+
+
+_columnar_rules = '''
+class ColumnarRules(object):
+    columnar = True
+
+    def __init__(self, table):
+        self._table = table
+
+    def __call__(self, subject=None, anon_subject=None, session=None):
+        return ({'bids-run': self._table['SeriesNumber'] * 10,
+                 'description': self._table['Comment'],
+                 'comment': 'columnar'},
+                self._table['SeriesNumber'] > 1)
+
+
+__datalad_hirni_rules = ColumnarRules
+'''
+
+
+@with_tempfile(mkdir=True)
+def test_columnar_rules(path):
+    skip_if_no_module('pandas')
+    from datalad_hirni.commands.dicom2spec import RuleSet
+
+    ds = Dataset(path).create(no_annex=True)
+    rule_files = [op.join(path, 'code', f) for f in ('a.py', 'b.py')]
+    os.makedirs(op.join(path, 'code'))
+    with open(rule_files[0], 'w') as f:
+        f.write(_rules_template.format(comment='per-series'))
+    with open(rule_files[1], 'w') as f:
+        f.write(_columnar_rules)
+    for f in rule_files:
+        ds.config.add("datalad.hirni.dicom2spec.rules", f, where='local')
+
+    series = [dict(SeriesNumber=1, Comment='one'), dict(SeriesNumber=2)]
+    for i in range(2):
+        # second time from the derivation cache:
+        res = RuleSet(dataset=ds).apply(series)
+        # columnar rules are applied on top of per-series rules:
+        assert_equal([r['comment']['value'] for r in res], ['columnar'] * 2)
+        assert_equal([r['bids-run']['value'] for r in res], [10, 20])
+        # missing values come back as None:
+        assert_equal([r['description']['value'] for r in res], ['one', None])
+        assert_in('hirni-dicom-converter-ignore', res[0]['tags'])
+        assert 'tags' not in res[1]
+
+
+@with_tempfile(mkdir=True)
+def test_rule_timings(path):
+    import pstats
+    from datalad_hirni.commands.dicom2spec import RuleSet
+
+    ds = Dataset(path).create(no_annex=True)
+    ds.config.add("datalad.hirni.dicom2spec.profile", 'profiles',
+                  where='local')
+    series = _fake_dicom_meta('dicoms')['metadata']['dicom']['Series']
+
+    rules = RuleSet(dataset=ds)
+    rules.apply(series)
+    rules.apply(series)
+    rules.apply(series[:2], subject='01')
+    timing = rules.timings['DefaultRules (builtin)']
+    # second application came from the derivation cache:
+    assert_equal((timing['calls'], timing['cached'], timing['series']),
+                 (2, 1, 5))
+    assert timing['seconds'] > 0
+    prof_dir = op.join(ds.repo.dot_git, 'datalad', 'hirni', 'profiles')
+    prof_files = os.listdir(prof_dir)
+    assert_equal(len(prof_files), 1)
+    assert prof_files[0].startswith('DefaultRules-')
+    assert prof_files[0].endswith('-{}.prof'.format(os.getpid()))
+    pstats.Stats(op.join(prof_dir, prof_files[0]))
+    assert not ds.repo.dirty
+
+    # profiler is stopped, if a rule fails:
+    class _FailingRules(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __call__(self, **kwargs):
+            raise RuntimeError("failed")
+
+    with patch.object(rules, '_rule_set', [_FailingRules]), \
+            patch.object(rules, '_cache', None):
+        assert_raises(RuntimeError, rules.apply, series)
+    assert sys.getprofile() is None
+
+
+def _fake_dicom_meta(path, n_series=3):
+    return dict(
+        status='ok',
+        type='dataset',
+        path=path,
+        dsid='00000000-0000-0000-0000-000000000000',
+        refcommit='0' * 40,
+        metadata=dict(dicom=dict(Series=[
+            dict(SeriesInstanceUID='{}.{}'.format(op.basename(path), i),
+                 SeriesNumber=i,
+                 SeriesDescription='func_task-oneback_run-{}'.format(i),
+                 ProtocolName='func_task-oneback_run-{}'.format(i),
+                 PatientID='02')
+            for i in range(1, n_series + 1)])))
+
+
+@with_tempfile(mkdir=True)
+def test_dicom2spec_multiple_paths(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    acqs = ['acq1', 'acq2', 'acq3']
+    for acq in acqs:
+        os.makedirs(op.join(path, acq, 'dicoms'))
+    n_commits = len(ds.repo.get_revisions())
+
+    def fake_meta_dump(self, path, **kwargs):
+        for p in path:
+            yield _fake_dicom_meta(p)
+
+    with patch('datalad.distribution.dataset.Dataset.meta_dump',
+               fake_meta_dump, create=True):
+        res = ds.hirni_dicom2spec(
+            path=[op.join(acq, 'dicoms') for acq in acqs], jobs=2)
+
+    # one spec per acquisition plus .gitattributes; all in one commit:
+    assert_result_count(res, 4, action='dicom2spec', status='ok')
+    assert_equal(len(ds.repo.get_revisions()), n_commits + 1)
+    # spec files report the time spent by the rules; identical metadata of
+    # later acquisitions may come from the derivation cache:
+    for r in res:
+        if r['path'].endswith('studyspec.json'):
+            timing = r['timings']['DefaultRules (builtin)']
+            assert_equal(timing['calls'] + timing['cached'], 1)
+    ok_clean_git(ds.path)
+    for acq in acqs:
+        spec = list(load_stream(op.join(path, acq, 'studyspec.json')))
+        assert_equal(len(spec), 4)
+        assert_equal(set(s['location'] for s in spec), {'dicoms'})
+        assert_equal(
+            sorted(s['uid'] for s in spec if s['type'] == 'dicomseries'),
+            ['dicoms.{}'.format(i) for i in range(1, 4)])
+
+    # rerun in-process; existing snippets are updated, not duplicated:
+    with patch('datalad.distribution.dataset.Dataset.meta_dump',
+               fake_meta_dump, create=True):
+        ds.hirni_dicom2spec(path=[op.join(acq, 'dicoms') for acq in acqs],
+                            properties='{"comment": "rerun"}')
+    for acq in acqs:
+        spec = list(load_stream(op.join(path, acq, 'studyspec.json')))
+        assert_equal(len(spec), 4)
+        assert all(get_specval(s, 'comment') == 'rerun'
+                   for s in spec if s['type'] == 'dicomseries')
+
+
+@with_tempfile(mkdir=True)
+def test_dicom2spec_shared_spec(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    locations = ['func', 'anat']
+    for loc in locations:
+        os.makedirs(op.join(path, loc))
+
+    def fake_meta_dump(self, path, **kwargs):
+        for p in path:
+            yield _fake_dicom_meta(p)
+
+    for i in range(2):
+        # second time around, existing snippets are updated:
+        with patch('datalad.distribution.dataset.Dataset.meta_dump',
+                   fake_meta_dump, create=True):
+            ds.hirni_dicom2spec(path=locations, spec='studyspec.json')
+        spec = list(load_stream(op.join(path, 'studyspec.json')))
+        assert_equal(len(spec), 8)
+        # one dicomseries:all snippet per location, preceding its series:
+        all_dicoms = [s for s in spec if s['type'] == 'dicomseries:all']
+        assert_equal([s['location'] for s in all_dicoms], locations)
+        for s in all_dicoms:
+            assert_equal(get_specval(s, 'subject'), '02')
+            series = [x for x in spec if x['type'] == 'dicomseries'
+                      and x['location'] == s['location']]
+            assert_equal(len(series), 3)
+            assert spec.index(s) < min(spec.index(x) for x in series)
+    ok_clean_git(ds.path)
+
+
+@with_tempfile(mkdir=True)
+def test_dicom2spec_pending_aggregation(path):
+    from datalad_hirni.support.pending_aggregation import add_pending
+
+    ds = Dataset(path).create(no_annex=True)
+    for acq in ('acq1', 'acq2'):
+        os.makedirs(op.join(path, acq, 'dicoms'))
+    add_pending(ds, [op.join(path, 'acq2', 'dicoms')])
+    queried = []
+
+    def fake_meta_dump(self, path=None, **kwargs):
+        queried.append((self.path, path))
+        for p in path or [self.path]:
+            yield _fake_dicom_meta(p)
+
+    with patch('datalad.distribution.dataset.Dataset.meta_dump',
+               fake_meta_dump, create=True):
+        res = ds.hirni_dicom2spec(
+            path=[op.join(acq, 'dicoms') for acq in ('acq1', 'acq2')])
+    assert_result_count(res, 3, action='dicom2spec', status='ok')
+    # pending subdataset is asked directly; the other one via the superds:
+    assert_equal(sorted(queried),
+                 sorted([(op.join(path, 'acq2', 'dicoms'), None),
+                         (path, [op.join(path, 'acq1', 'dicoms')])]))
+
+
+@with_tempfile(mkdir=True)
+def test_derivation_cache(path):
+    from datalad_hirni.commands.dicom2spec import RuleSet
+
+    ds = Dataset(path).create(no_annex=True)
+    series = _fake_dicom_meta('dicoms')['metadata']['dicom']['Series']
+    cache_dir = op.join(path, '.git', 'datalad', 'hirni', 'dicom2spec_cache')
+
+    rules = RuleSet(dataset=ds)
+    derived = rules.apply(series, subject='01')
+    assert_equal((rules._cache.hits, rules._cache.misses), (0, 1))
+    assert op.isdir(cache_dir)
+    assert_equal(RuleSet(dataset=ds).apply(series, subject='01'), derived)
+    # different arguments or metadata are different keys:
+    rules = RuleSet(dataset=ds)
+    rules.apply(series, subject='02')
+    rules.apply(series[:2], subject='01')
+    rules.apply(series, subject='01')
+    assert_equal((rules._cache.hits, rules._cache.misses), (1, 2))
+    ok_clean_git(ds.path)
+
+    # editing a rule file invalidates its results only:
+    rule_file = op.join(path, 'my_rules.py')
+    with open(rule_file, 'w') as f:
+        f.write(_rules_template.format(comment='first'))
+    ds.config.add("datalad.hirni.dicom2spec.rules", rule_file, where='local')
+    rules = RuleSet(dataset=ds)
+    assert_equal(rules.apply(series)[0]['comment']['value'], 'first')
+    with open(rule_file, 'w') as f:
+        f.write(_rules_template.format(comment='second'))
+    rules = RuleSet(dataset=ds)
+    assert_equal(rules.apply(series)[0]['comment']['value'], 'second')
+    assert_equal(rules._cache.misses, 1)
+
+    # cache can be switched off:
+    ds.config.add("datalad.hirni.dicom2spec.cache", "false", where='local')
+    assert RuleSet(dataset=ds)._cache is None
@@ -1,9 +1,14 @@
+import hashlib
+import os
 from os.path import join as opj
 from unittest.mock import patch
 import datalad_hirni
 from datalad.api import Dataset
 
 from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+    assert_result_count,
     known_failure_windows,
     known_failure_osx,
     ok_exists,
@@ -64,3 +69,295 @@ def test_import_tarball(src, ds_path, toolbox_url):
     ok_file_under_git(opj(ds.path, 'sub-02', 'studyspec.json'), annexed=False)
     ok_exists(opj(ds.path, 'sub-02', 'dicoms', 'structural'))
 
+
+def test_annex_key():
+    from datalad_hirni.commands.import_dicoms import _annex_key
+
+    assert_equal(_annex_key('MD5E', 'abc', 10, 'session.tar.gz'),
+                 'MD5E-s10--abc.tar.gz')
+    assert_equal(_annex_key('MD5E', 'abc', 10, 'ses-2020.01.01.tar.gz'),
+                 'MD5E-s10--abc.tar.gz')
+    assert_equal(_annex_key('SHA256E', 'abc', 1, 'archive.tarball'),
+                 'SHA256E-s1--abc')
+    assert_equal(_annex_key('SHA256E', 'abc', 1, 'noext'), 'SHA256E-s1--abc')
+    assert_equal(_annex_key('MD5', 'abc', 10, 'session.tar.gz'),
+                 'MD5-s10--abc')
+
+
+@with_tempfile(mkdir=True)
+def test_put_with_hash(path):
+    from datalad_hirni.commands.import_dicoms import _put_with_hash
+
+    src = opj(path, 'src.tar')
+    content = os.urandom(1024 * 1024 + 17)
+    with open(src, 'wb') as f:
+        f.write(content)
+    md5 = hashlib.md5(content).hexdigest()
+
+    for mode in ('auto', 'copy', 'hardlink'):
+        dst = opj(path, mode)
+        digest, used_mode = _put_with_hash(src, dst, 'md5', mode=mode)
+        assert_equal(digest, md5)
+        with open(dst, 'rb') as f:
+            assert_equal(f.read(), content)
+        if mode != 'auto':
+            assert_equal(used_mode, mode)
+    assert_equal(os.stat(opj(path, 'hardlink')).st_ino, os.stat(src).st_ino)
+    assert os.stat(opj(path, 'copy')).st_ino != os.stat(src).st_ino
+    # an explicit link mode doesn't silently fall back:
+    assert_raises(OSError, _put_with_hash, src, opj(path, 'hardlink'), 'md5',
+                  mode='hardlink')
+
+
+def _write_dicom(path, patient_id, series_number, series_uid=None):
+    from pydicom.dataset import (
+        Dataset as DicomDataset,
+        FileMetaDataset
+    )
+    from pydicom.uid import (
+        ExplicitVRLittleEndian,
+        generate_uid
+    )
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm = DicomDataset()
+    dcm.file_meta = meta
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.SOPClassUID = meta.MediaStorageSOPClassUID
+    dcm.PatientID = patient_id
+    dcm.PatientName = 'Doe^John'
+    dcm.SeriesNumber = series_number
+    if series_uid:
+        dcm.SeriesInstanceUID = series_uid
+    dcm.ImageType = ['ORIGINAL', 'PRIMARY']
+    dcm.BitsAllocated = 8
+    dcm.PixelData = b'\0' * 1024
+    dcm.save_as(path, write_like_original=False)
+
+
+@with_tempfile(mkdir=True)
+def test_prescan_acquisition_id(path):
+    import tarfile
+    from datalad_hirni.commands.import_dicoms import (
+        _prescan_acquisition_id,
+        _read_first_dicom_header,
+    )
+
+    os.makedirs(opj(path, 'session', 'series1'))
+    with open(opj(path, 'session', 'README'), 'w') as f:
+        f.write('no DICOM')
+    _write_dicom(opj(path, 'session', 'series1', 'img1'), '02', 1)
+    _write_dicom(opj(path, 'session', 'series1', 'img2'), '03', 2)
+    tarball = opj(path, 'session.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        tar.add(opj(path, 'session', 'README'), 'session/README')
+        tar.add(opj(path, 'session', 'series1'), 'session/series1')
+
+    assert_equal(_prescan_acquisition_id(tarball, '{PatientID}'), '02')
+    assert_equal(
+        _prescan_acquisition_id(tarball, 'sub-{PatientID}_{SeriesNumber}'),
+        'sub-02_1')
+    assert_equal(_prescan_acquisition_id(tarball, '{ImageType[1]}'),
+                 'PRIMARY')
+    assert_equal(_prescan_acquisition_id(tarball, 'fixed'), 'fixed')
+    # header not fitting into the chunk read at first:
+    assert_equal(_read_first_dicom_header(tarball, head_size=256)['PatientID'],
+                 '02')
+    # unknown field and no DICOMs at all:
+    assert _prescan_acquisition_id(tarball, '{NoSuchField}') is None
+    empty = opj(path, 'empty.tar')
+    with tarfile.open(empty, 'w') as tar:
+        tar.add(opj(path, 'session', 'README'), 'README')
+    assert _prescan_acquisition_id(empty, '{PatientID}') is None
+    # a directory does as well:
+    assert_equal(_prescan_acquisition_id(opj(path, 'session'),
+                                         '{PatientID}'), '02')
+    # can't scan what's not local:
+    assert _prescan_acquisition_id('http://example.com/s.tar',
+                                   '{PatientID}') is None
+
+
+@with_tempfile(mkdir=True)
+def test_import_existing_acquisition(path):
+    import tarfile
+
+    ds = Dataset(opj(path, 'study')).create()
+    ds.config.set('datalad.hirni.import.dedup', 'off', where='local')
+    os.makedirs(opj(path, 'session'))
+    _write_dicom(opj(path, 'session', 'img1'), '02', 1)
+    for name in ('first.tar.gz', 'second.tar.gz'):
+        with tarfile.open(opj(path, name), 'w:gz') as tar:
+            tar.add(opj(path, 'session', 'img1'), 'img1')
+
+    res = ds.hirni_import_dcm(opj(path, 'first.tar.gz'))
+    assert_result_count(res, 1, status='ok', path=opj(ds.path, '02', 'dicoms'))
+    # acquisition ID derived from the second archive is taken:
+    head = ds.repo.get_hexsha()
+    res = ds.hirni_import_dcm(opj(path, 'second.tar.gz'), on_failure='ignore')
+    assert_result_count(res, 1, status='impossible', path=opj(ds.path, '02'))
+    assert_equal(ds.repo.get_hexsha(), head)
+    # unless it's meant to be added to it:
+    res = ds.hirni_import_dcm(opj(path, 'second.tar.gz'), acqid='02')
+    assert_result_count(res, 1, status='ok', path=opj(ds.path, '02', 'dicoms'))
+
+
+@with_tempfile(mkdir=True)
+def test_import_resume(path):
+    import tarfile
+    from datalad_hirni.commands import import_dicoms
+
+    ds = Dataset(opj(path, 'study')).create()
+    os.makedirs(opj(path, 'session'))
+    _write_dicom(opj(path, 'session', 'img1'), '02', 1)
+    tarball = opj(path, 'session.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        tar.add(opj(path, 'session', 'img1'), 'img1')
+
+    # interrupted after extracting the tarball:
+    with patch.object(import_dicoms, '_merge_import',
+                      side_effect=RuntimeError("interrupted")):
+        assert_raises(RuntimeError, ds.hirni_import_dcm, tarball)
+    dicom_repo = Dataset(opj(ds.path, '02', 'dicoms')).repo
+    assert_equal(dicom_repo.get_active_branch(), 'incoming-processed')
+    # lost track of the branch to return to:
+    dicom_repo.config.unset('datalad.hirni.import.branch', where='local')
+
+    res = ds.hirni_import_dcm(tarball)
+    assert_result_count(res, 1, status='ok', path=opj(ds.path, '02', 'dicoms'),
+                        import_stages=['merge'])
+    assert_equal(dicom_repo.get_active_branch(), ds.repo.get_active_branch())
+    assert os.path.lexists(opj(ds.path, '02', 'dicoms', 'img1'))
+    ok_exists(opj(ds.path, '02', 'studyspec.json'))
+    assert not ds.repo.dirty
+    # done for good now:
+    assert_result_count(ds.hirni_import_dcm(tarball), 1, status='notneeded')
+
+
+@with_tempfile(mkdir=True)
+def test_import_state(path):
+    from datalad_hirni.commands.import_dicoms import (
+        _begin_import,
+        _get_archive_key,
+        _get_key_size,
+        _is_extracted,
+    )
+
+    key = 'MD5E-s42--d41d8cd98f00b204e9800998ecf8427e.tar.gz'
+    assert_equal(_get_key_size(key), 42)
+    assert _get_key_size('URL--http&c%%example.com%s.tar') is None
+
+    ds = Dataset(path).create(no_annex=True)
+    repo = ds.repo
+    master = repo.get_active_branch()
+    repo.checkout('incoming', options=['-b'])
+    assert _get_archive_key(repo, 'incoming', 's.tar.gz') is None
+    os.symlink(opj('.git', 'annex', 'objects', 'Xy', 'Zk', key, key),
+               opj(path, 's.tar.gz'))
+    repo.add('s.tar.gz')
+    repo.commit(msg="Retrieved s.tar.gz")
+    assert_equal(_get_archive_key(repo, 'incoming', 's.tar.gz'), key)
+
+    assert not _is_extracted(repo, key)
+    repo.checkout('incoming-processed', options=['-b'])
+    repo.commit(msg="Extracted s.tar.gz\n\nhirni-archive-key: {}".format(key),
+                options=['--allow-empty'])
+    repo.checkout(master)
+    assert _is_extracted(repo, key)
+    assert not _is_extracted(repo, key.replace('s42', 's43'))
+
+    # resuming without knowing where the import started from:
+    repo.checkout('incoming')
+    assert_equal(_begin_import(repo), master)
+    repo.call_git(['branch', '-m', master, 'other'])
+    repo.call_git(['branch', 'another', 'other'])
+    assert_raises(ValueError, _begin_import, repo)
+
+
+@with_tempfile(mkdir=True)
+def test_import_index(path):
+    import tarfile
+    from datalad.support import json_py
+    from datalad_hirni.commands.import_dicoms import (
+        _check_imported,
+        _ignore_known_series,
+        _record_import,
+        _scan_series_uids,
+    )
+    from datalad_hirni.support.import_index import get_index
+
+    ds = Dataset(opj(path, 'study')).create(no_annex=True)
+    os.makedirs(opj(path, 'session'))
+    for i, uid in enumerate(['1.2.1', '1.2.1', '1.2.2']):
+        _write_dicom(opj(path, 'session', 'img%d' % i), '02', 1, uid)
+    _write_dicom(opj(path, 'session', 'img3'), '02', 3, '1.2.3')
+
+    def _tar(name, files):
+        tarball = opj(path, name)
+        with tarfile.open(tarball, 'w:gz') as tar:
+            for f in files:
+                tar.add(opj(path, 'session', f), f)
+        return tarball
+
+    first = _tar('first.tar.gz', ['img0', 'img1', 'img2'])
+    assert_equal(_scan_series_uids(first), {'1.2.1', '1.2.2'})
+    assert_equal(_scan_series_uids(opj(path, 'session')),
+                 {'1.2.1', '1.2.2', '1.2.3'})
+    assert_equal(_check_imported(ds, first, dedup='series'), ([], dict()))
+
+    # record an import of `first` into acquisition 'acq1':
+    os.makedirs(opj(ds.path, 'acq1'))
+    spec_file = opj(ds.path, 'acq1', 'studyspec.json')
+    json_py.dump2stream([{'type': 'dicomseries:all'}] +
+                        [{'type': 'dicomseries', 'uid': uid}
+                         for uid in ('1.2.1', '1.2.2')], spec_file)
+    with open(first, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    key = 'MD5E-s{}--{}.tar.gz'.format(os.path.getsize(first), digest)
+    _record_import(ds, 'acq1', key, spec_file)
+    assert_equal(get_index(ds),
+                 {'archives': {key: 'acq1'},
+                  'series': {'1.2.1': 'acq1', '1.2.2': 'acq1'}})
+
+    # same content under a different name:
+    import shutil
+    renamed = opj(path, 'renamed.tgz')
+    shutil.copy(first, renamed)
+    for dedup in ('archive', 'series'):
+        assert_equal(_check_imported(ds, renamed, dedup=dedup),
+                     (['acq1'], dict()))
+    assert_equal(_check_imported(ds, renamed, dedup='off'), ([], dict()))
+
+    # same series in a different archive:
+    repacked = _tar('repacked.tar.gz', ['img2', 'img0'])
+    assert_equal(_check_imported(ds, repacked, dedup='archive'),
+                 ([], dict()))
+    assert_equal(_check_imported(ds, repacked, dedup='series'),
+                 (['acq1'], {'1.2.1': 'acq1', '1.2.2': 'acq1'}))
+
+    # new series on top of known ones:
+    more = _tar('more.tar.gz', ['img1', 'img3'])
+    existing, known = _check_imported(ds, more, dedup='series')
+    assert_equal(existing, [])
+    assert_equal(known, {'1.2.1': 'acq1'})
+    spec2 = opj(path, 'studyspec.json')
+    json_py.dump2stream([{'type': 'dicomseries', 'uid': uid, 'tags': []}
+                         for uid in ('1.2.1', '1.2.3')], spec2)
+    # nothing to ignore within the same acquisition:
+    assert_equal(_ignore_known_series(spec2, known, 'acq1'), [])
+    assert_equal(_ignore_known_series(spec2, known, 'acq2'), ['1.2.1'])
+    assert_equal([s['tags'] for s in json_py.load_stream(spec2)],
+                 [['hirni-dicom-converter-ignore'], []])
+
+    # directories are looked up by their series only:
+    assert_equal(_check_imported(ds, opj(path, 'session'), dedup='archive'),
+                 ([], dict()))
+    assert_equal(_check_imported(ds, opj(path, 'session'), dedup='series'),
+                 ([], {'1.2.1': 'acq1', '1.2.2': 'acq1'}))
+
+    # entries of vanished acquisitions are ignored:
+    shutil.rmtree(opj(ds.path, 'acq1'))
+    assert_equal(_check_imported(ds, renamed, dedup='series'),
+                 ([], dict()))
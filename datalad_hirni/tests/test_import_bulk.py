@@ -0,0 +1,92 @@
+"""Test bulk import of DICOM tarballs"""
+
+import tarfile
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.tests.utils import (
+    assert_equal,
+    assert_in,
+    assert_result_count,
+    with_tempfile
+)
+
+from datalad_hirni.commands.import_bulk import _read_manifest
+
+
+@with_tempfile(mkdir=True)
+def test_read_manifest(path):
+
+    manifest = opj(path, 'manifest.txt')
+    with open(manifest, 'w') as f:
+        f.write("# archived sessions\n"
+                "s1.tar.gz\n"
+                "\n"
+                "/data/s2.tar.gz   sub-02_ses-pre \n"
+                "http://example.com/s3.tar acq3\n")
+    assert_equal(_read_manifest(manifest),
+                 [(opj(path, 's1.tar.gz'), None),
+                  ('/data/s2.tar.gz', 'sub-02_ses-pre'),
+                  ('http://example.com/s3.tar', 'acq3')])
+
+
+@with_tempfile(mkdir=True)
+def test_import_bulk_no_acqid(path):
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    with open(opj(path, 'README'), 'w') as f:
+        f.write('no DICOM')
+    for name in ('a', 'b'):
+        with tarfile.open(opj(path, name + '.tar'), 'w') as tar:
+            tar.add(opj(path, 'README'), 'README')
+    n_commits = len(ds.repo.get_revisions())
+
+    res = ds.hirni_import_dcm_bulk(opj(path, '*.tar'), on_failure='ignore')
+    assert_result_count(res, 2, status='impossible',
+                        action='import DICOM tarball')
+    assert_equal(len(ds.repo.get_revisions()), n_commits)
+
+
+@with_tempfile(mkdir=True)
+def test_import_bulk_imported_before(path):
+    import hashlib
+    import os
+    from datalad_hirni.support.import_index import add_to_index
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    with open(opj(path, 'README'), 'w') as f:
+        f.write('no DICOM')
+    with tarfile.open(opj(path, 'a.tar'), 'w') as tar:
+        tar.add(opj(path, 'README'), 'README')
+    with open(opj(path, 'a.tar'), 'rb') as f:
+        content = f.read()
+    os.makedirs(opj(ds.path, 'acq1'))
+    add_to_index(ds, 'acq1', archive_keys=[
+        'MD5E-s{}--{}.tar'.format(len(content),
+                                  hashlib.md5(content).hexdigest())])
+    n_commits = len(ds.repo.get_revisions())
+
+    res = ds.hirni_import_dcm_bulk(opj(path, '*.tar'), on_failure='ignore')
+    assert_result_count(res, 1)
+    assert_result_count(res, 1, status='notneeded', acquisitions=['acq1'],
+                        path=opj(path, 'a.tar'))
+    assert_equal(len(ds.repo.get_revisions()), n_commits)
+
+
+@with_tempfile(mkdir=True)
+def test_import_bulk_invalid_config(path):
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    with open(opj(path, 'README'), 'w') as f:
+        f.write('no DICOM')
+    with tarfile.open(opj(path, 'a.tar'), 'w') as tar:
+        tar.add(opj(path, 'README'), 'README')
+    for var, value in (('tarball-mode', 'move'), ('dedup', 'content'),
+                       ('drop', 'later'), ('gc', 'never')):
+        ds.config.set('datalad.hirni.import.' + var, value, where='local')
+        res = ds.hirni_import_dcm_bulk(opj(path, '*.tar'),
+                                       on_failure='ignore')
+        assert_result_count(res, 1)
+        assert_result_count(res, 1, status='impossible', path=ds.path)
+        assert_in(value, res[0]['message'])
+        ds.config.unset('datalad.hirni.import.' + var, where='local')
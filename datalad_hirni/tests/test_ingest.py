@@ -0,0 +1,181 @@
+"""Test watch-folder ingestion of DICOM archives"""
+
+import hashlib
+import os
+import os.path as op
+import tarfile
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.support import json_py
+from datalad.tests.utils import (
+    assert_equal,
+    assert_result_count,
+    with_tempfile
+)
+
+from datalad_hirni.commands.ingest import _StabilityTracker
+from datalad_hirni.support.import_index import add_to_index
+from datalad_hirni.support.ingest_journal import (
+    IngestJournal,
+    get_status_file,
+)
+
+
+@with_tempfile(mkdir=True)
+def test_stability_tracker(path):
+
+    tracker = _StabilityTracker(settle=10)
+    archive = opj(path, 'a.tar')
+    with open(archive, 'w') as f:
+        f.write('123')
+    assert_equal(tracker.update([archive], now=0), [])
+    assert_equal(tracker.update([], now=5), [])
+    # still being written:
+    with open(archive, 'a') as f:
+        f.write('456')
+    assert_equal(tracker.update([archive], now=12), [])
+    assert_equal(len(tracker), 1)
+    stable = tracker.update([], now=22)
+    assert_equal([(p, s[0], seen) for p, s, seen in stable],
+                 [(archive, 6, 0)])
+    assert_equal(len(tracker), 0)
+
+    # directories are stable once nothing within changes:
+    os.makedirs(opj(path, 'session', 'series1'))
+    assert_equal(tracker.update([opj(path, 'session')], now=30), [])
+    with open(opj(path, 'session', 'series1', 'img'), 'w') as f:
+        f.write('dicom')
+    assert_equal(tracker.update([], now=40), [])
+    assert_equal(tracker.update([], now=45), [])
+    assert_equal(len(tracker.update([], now=50)), 1)
+
+    # vanished ones are forgotten:
+    assert_equal(tracker.update([archive], now=60), [])
+    os.unlink(archive)
+    assert_equal(tracker.update([], now=80), [])
+    assert_equal(len(tracker), 0)
+
+
+@with_tempfile(mkdir=True)
+def test_ingest_once(path):
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    drop = opj(path, 'drop')
+    os.makedirs(drop)
+    with open(opj(path, 'README'), 'w') as f:
+        f.write('no DICOM')
+    for name in ('a.tar', 'b.tar', '.incomplete.tar'):
+        with tarfile.open(opj(drop, name), 'w') as tar:
+            tar.add(opj(path, 'README'), 'README' + name)
+    # b.tar was imported before:
+    with open(opj(drop, 'b.tar'), 'rb') as f:
+        content = f.read()
+    os.makedirs(opj(ds.path, 'acq1'))
+    add_to_index(ds, 'acq1', archive_keys=[
+        'MD5E-s{}--{}.tar'.format(len(content),
+                                  hashlib.md5(content).hexdigest())])
+    n_commits = len(ds.repo.get_revisions())
+
+    res = ds.hirni_ingest(drop, settle=0, interval=0, once=True,
+                          on_failure='ignore')
+    assert_result_count(res, 2)
+    assert_result_count(res, 1, status='impossible', path=opj(drop, 'a.tar'))
+    assert_result_count(res, 1, status='notneeded', path=opj(drop, 'b.tar'),
+                        acquisitions=['acq1'])
+    assert_equal(len(ds.repo.get_revisions()), n_commits)
+
+    journal = IngestJournal(ds)
+    assert_equal(journal.get(opj(drop, 'a.tar'))['state'], 'failed')
+    assert_equal(journal.get(opj(drop, 'b.tar'))['state'], 'done')
+    assert journal.get(opj(drop, '.incomplete.tar')) is None
+    status = json_py.load(get_status_file(ds))
+    assert_equal(status['counts'],
+                 {'queued': 0, 'importing': 0, 'done': 1, 'failed': 1})
+    assert_equal(status['latency']['settle']['count'], 2)
+    assert_equal(status['latency']['queue']['count'], 0)
+
+    # nothing changed, nothing to do:
+    assert_result_count(
+        ds.hirni_ingest(drop, settle=0, interval=0, once=True,
+                        on_failure='ignore'), 0)
+    # a changed archive is picked up again:
+    with tarfile.open(opj(drop, 'a.tar'), 'w') as tar:
+        tar.add(opj(path, 'README'), 'other')
+    assert_result_count(
+        ds.hirni_ingest(drop, settle=0, interval=0, once=True,
+                        on_failure='ignore'), 1, status='impossible')
+
+
+@with_tempfile(mkdir=True)
+def test_ingest_resume(path):
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    drop = opj(path, 'drop')
+    os.makedirs(drop)
+    journal = IngestJournal(ds)
+    journal.update(opj(drop, 'gone.tar'), state='importing', acqid='acq1',
+                   signature=[1, 1], seen=0, stable=0, started=1)
+    journal.update(opj(drop, 'gone.tar'), state='importing', acqid='acq1')
+    # the journal is read back, last record wins:
+    journal = IngestJournal(ds)
+    assert_equal(journal.in_state('importing')[0]['acqid'], 'acq1')
+    with open(journal._file) as f:
+        assert_equal(len(f.readlines()), 1)
+
+    # a pending import is resumed, but the archive vanished meanwhile:
+    assert_result_count(
+        ds.hirni_ingest(drop, settle=0, interval=0, once=True), 0)
+    assert_equal(IngestJournal(ds).get(opj(drop, 'gone.tar'))['state'],
+                 'failed')
+
+    # an archive vanishing while the drop directory is scanned is skipped:
+    from unittest.mock import patch
+    open(opj(drop, 'vanishing.tar'), 'w').close()
+    IngestJournal(ds).update(opj(drop, 'vanishing.tar'), state='done',
+                             signature=[0, 0])
+    with patch('datalad_hirni.commands.ingest._get_signature',
+               side_effect=OSError):
+        assert_result_count(
+            ds.hirni_ingest(drop, settle=0, interval=0, once=True), 0)
+
+
+def _fake_import(ds_path, tarball, acqid, known_series=None, **kwargs):
+    return dict(dicom_ds=opj(ds_path, acqid, 'dicoms'), tarball=tarball)
+
+
+def _fake_save(ds, imported, defer_aggregation=False):
+    for acqid, stats in imported:
+        yield dict(status='ok', path=stats['dicom_ds'], type='dataset',
+                   action='import DICOM tarball')
+
+
+@with_tempfile(mkdir=True)
+def test_ingest_pipeline(path):
+    from unittest.mock import patch
+    from datalad_hirni.tests.test_import import _write_dicom
+
+    ds = Dataset(opj(path, 'ds')).create(no_annex=True)
+    drop = opj(path, 'drop')
+    os.makedirs(opj(path, 'src'))
+    os.makedirs(drop)
+    for i, subject in enumerate(['01', '02', '01']):
+        _write_dicom(opj(path, 'src', 'img'), subject, 1)
+        with tarfile.open(opj(drop, 's{}.tar'.format(i)), 'w') as tar:
+            tar.add(opj(path, 'src', 'img'), 'img')
+
+    with patch('datalad_hirni.commands.ingest._import_acquisition',
+               _fake_import), \
+            patch('datalad_hirni.commands.ingest._save_acquisitions',
+                  _fake_save):
+        res = ds.hirni_ingest(drop, settle=0, interval=0, once=True,
+                              jobs=2)
+    assert_result_count(res, 3, status='ok')
+    journal = IngestJournal(ds)
+    assert_equal({op.basename(e['path']): e['acqid']
+                  for e in journal.in_state('done')},
+                 {'s0.tar': '01', 's1.tar': '02', 's2.tar': '01'})
+    status = json_py.load(get_status_file(ds))
+    assert_equal(status['counts']['done'], 3)
+    for stage in ('settle', 'queue', 'import', 'commit', 'total'):
+        assert_equal(status['latency'][stage]['count'], 3)
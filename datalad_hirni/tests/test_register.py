@@ -6,5 +6,9 @@ def test_register():
     assert hasattr(da, 'hirni_spec4anything')
     assert hasattr(da, 'hirni_dicom2spec')
     assert hasattr(da, 'hirni_import_dcm')
+    assert hasattr(da, 'hirni_import_dcm_bulk')
+    assert hasattr(da, 'hirni_aggregate_pending')
+    assert hasattr(da, 'hirni_ingest')
+    assert hasattr(da, 'hirni_cleanup')
     assert hasattr(da, 'hirni_spec2bids')
 
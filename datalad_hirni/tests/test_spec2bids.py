@@ -0,0 +1,383 @@
+"""Test conversion based on study specification"""
+
+import os
+from os.path import join as opj
+
+from datalad.api import Dataset
+from datalad.support import json_py
+from datalad.tests.utils import (
+    assert_equal,
+    assert_in,
+    assert_not_in,
+    assert_result_count,
+    with_tempfile
+)
+
+# stands in for a converter: logs the snippets it's called for and registers
+# the subject, committing both. Fails for all series of subject 'bad'.
+_converter = """\
+set -e
+cd "$1"
+[ "$2" != "bad" ] || [ "$3" != "dicomseries:all" ]
+echo "$3" >> "order-$2.log"
+if [ "$3" = "dicomseries:all" ]; then echo "sub-$2" >> participants.tsv; fi
+git add "order-$2.log" participants.tsv
+git commit -q -m "convert $2 $3"
+"""
+
+
+def _make_bids_ds(path, acquisitions):
+    """BIDS dataset with a spec per acquisition and a converter procedure
+
+    `acquisitions` maps acquisition names to subject and snippet types. A
+    snippet type can be given along with its location.
+    """
+    ds = Dataset(path).create(no_annex=True)
+    os.makedirs(opj(ds.path, '.datalad', 'procedures'))
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-converter.sh'),
+              'w') as f:
+        f.write(_converter)
+    with open(opj(ds.path, 'participants.tsv'), 'w') as f:
+        f.write("participant_id\n")
+    for acq, (subject, types) in acquisitions.items():
+        os.makedirs(opj(ds.path, acq))
+        json_py.dump2stream(
+            [{'type': type_,
+              'location': location,
+              'subject': {'value': subject, 'approved': False},
+              'procedures': [{
+                  'procedure-name': {'value': 'test-converter'},
+                  'procedure-call': {
+                      'value': 'bash {script} {ds} {{bids-subject}} '
+                               '{{type}}'}}]}
+             for type_, location in [
+                 t if isinstance(t, tuple) else (t, 'dicoms')
+                 for t in types]],
+            opj(ds.path, acq, 'studyspec.json'))
+    ds.save(message="add specs")
+    return ds
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_jobs(path):
+
+    ds = _make_bids_ds(opj(path, 'bids'), {
+        'acq1': ('01', ['dicomseries:all', 'dicomseries']),
+        'acq2': ('02', ['dicomseries:all']),
+        'acq3': ('03', ['dicomseries:all']),
+    })
+    res = ds.hirni_spec2bids(['acq1', opj('acq2', 'studyspec.json'), 'acq3'],
+                             jobs=2)
+    assert_result_count(res, 3, action='spec2bids', status='ok')
+    assert_result_count(res, 1, action='spec2bids', status='ok',
+                        path=opj(ds.path, 'acq1', 'studyspec.json'))
+    assert_result_count(res, 4, action='test-converter', status='ok')
+
+    # order within an acquisition is kept:
+    with open(opj(ds.path, 'order-01.log')) as f:
+        assert_equal(f.read().splitlines(),
+                     ['dicomseries:all', 'dicomseries'])
+    # every conversion made it into participants.tsv:
+    with open(opj(ds.path, 'participants.tsv')) as f:
+        assert_equal(sorted(f.read().splitlines()),
+                     ['participant_id', 'sub-01', 'sub-02', 'sub-03'])
+    # the procedures' commits are kept:
+    messages = ds.repo.call_git(['log', '--format=%s']).splitlines()
+    for m in ('convert 01 dicomseries:all', 'convert 01 dicomseries',
+              'convert 02 dicomseries:all', 'convert 03 dicomseries:all'):
+        assert_in(m, messages)
+    # no leftovers:
+    assert_equal(ds.repo.call_git(['branch', '--list', 'hirni-spec2bids-*']),
+                 '')
+    hirni_dir = opj(ds.repo.dot_git, 'datalad', 'hirni')
+    assert_equal([p for p in os.listdir(hirni_dir)
+                  if p.startswith('spec2bids-')], [])
+    assert_equal(ds.repo.call_git(['status', '--porcelain']), '')
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_jobs_conflict(path):
+
+    ds = _make_bids_ds(opj(path, 'bids'), {
+        'acq1': ('01', ['dicomseries:all']),
+        'acq2': ('02', ['dicomseries:all']),
+    })
+    # both conversions write the same file differently:
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-converter.sh'),
+              'a') as f:
+        f.write('echo "$2" > CHANGES\ngit add CHANGES\n'
+                'git commit -q -m "changes $2"\n')
+    ds.save(message="conflicting converter")
+    res = ds.hirni_spec2bids(['acq1', 'acq2'], jobs=2, on_failure='ignore')
+    assert_result_count(res, 1, action='spec2bids', status='ok')
+    assert_result_count(res, 1, action='spec2bids', status='error')
+    # the conversion that couldn't be merged is left on a branch:
+    assert_equal(len(ds.repo.call_git(
+        ['branch', '--list', 'hirni-spec2bids-*']).splitlines()), 1)
+    assert_equal(ds.repo.call_git(['status', '--porcelain']), '')
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_jobs_subdataset(path):
+
+    ds = _make_bids_ds(opj(path, 'bids'), {
+        'acq1': ('01', ['dicomseries:all']),
+    })
+    # an acquisition in a subdataset, that is cloned ephemerally as well:
+    sub = ds.create('acq2')
+    json_py.dump2stream(
+        [{'type': 'dicomseries:all',
+          'location': 'dicoms',
+          'subject': {'value': '02', 'approved': False},
+          'procedures': [{
+              'procedure-name': {'value': 'test-converter'},
+              'procedure-call': {
+                  'value': 'bash {script} {ds} {{bids-subject}} '
+                           '{{type}}'}}]}],
+        opj(sub.path, 'studyspec.json'))
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-converter.sh'),
+              'a') as f:
+        f.write('[ "$2" != "02" ] || [ -L acq2/.git/annex ]\n')
+    ds.save(recursive=True, message="add subdataset")
+    res = ds.hirni_spec2bids(['acq1', 'acq2'], jobs=2)
+    assert_result_count(res, 2, action='spec2bids', status='ok')
+    assert_result_count(res, 2, action='test-converter', status='ok')
+    assert_equal(ds.repo.call_git(['status', '--porcelain']), '')
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_dependencies(path):
+
+    ds = _make_bids_ds(opj(path, 'bids'), {
+        # all series are converted before single ones:
+        'acq1': ('01', ['dicomseries', 'dicomseries:all',
+                        ('events_file', 'events.tsv')]),
+        'acq2': ('bad', ['dicomseries:all', 'dicomseries',
+                         ('events_file', 'events.tsv')]),
+    })
+    res = ds.hirni_spec2bids(['acq1'])
+    assert_result_count(res, 3, action='test-converter', status='ok')
+    with open(opj(ds.path, 'order-01.log')) as f:
+        order = f.read().splitlines()
+    assert_equal(sorted(order),
+                 ['dicomseries', 'dicomseries:all', 'events_file'])
+    assert order.index('dicomseries:all') < order.index('dicomseries')
+
+    # a failed conversion of all series blocks the single series, but not
+    # what is independent of them:
+    res = ds.hirni_spec2bids(['acq2'], on_failure='ignore')
+    assert_result_count(res, 1, action='test-converter', status='error')
+    assert_result_count(res, 1, action='test-converter', status='impossible')
+    assert_result_count(res, 1, action='test-converter', status='ok')
+    with open(opj(ds.path, 'order-bad.log')) as f:
+        assert_equal(f.read().splitlines(), ['events_file'])
+
+
+def test_build_task_graph():
+    from datalad_hirni.commands.spec2bids import _build_task_graph
+
+    def _task(snippet_idx, type_, location):
+        return dict(snippet_idx=snippet_idx, type=type_, location=location)
+
+    tasks = [_task(0, 'dicomseries', 'dicoms'),
+             _task(0, 'dicomseries', 'dicoms'),
+             _task(1, 'dicomseries:all', 'dicoms'),
+             _task(2, 'dicomseries:all', 'other'),
+             _task(2, 'dicomseries:all', 'other'),
+             _task(3, 'events_file', 'events.tsv')]
+    graph = _build_task_graph(tasks)
+    # aggregating snippets go first:
+    assert_equal([graph[i]['snippet_idx'] for i in range(len(graph))],
+                 [1, 2, 2, 0, 0, 3])
+    assert_equal([graph.dependencies(i) for i in range(len(graph))],
+                 [set(), set(), {1}, {0, 2}, {0, 2, 3}, set()])
+
+    # linked to the latest tasks only:
+    graph = _build_task_graph(
+        [_task(i, 'dicomseries', 'dicoms') for i in range(3000)])
+    assert_equal(graph.dependencies(2999), {2998})
+    assert_equal(graph.ready(), [0])
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_substitutions(path):
+    from unittest.mock import patch
+    from datalad.config import ConfigManager
+
+    ds = Dataset(opj(path, 'bids')).create(no_annex=True)
+    os.makedirs(opj(ds.path, '.datalad', 'procedures'))
+    # no call format; substitutions are available from the environment:
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-env.sh'),
+              'w') as f:
+        f.write('echo "$DATALAD_RUN_SUBSTITUTIONS_BIDS__SUBJECT '
+                '$DATALAD_RUN_SUBSTITUTIONS_SPECPATH" > "$1/env.txt"\n')
+    os.makedirs(opj(ds.path, 'acq1'))
+    json_py.dump2stream(
+        [{'type': 'events_file',
+          'location': 'events.tsv',
+          'subject': {'value': "{0}'s", 'approved': False},
+          'procedures': [{'procedure-name': {'value': 'test-env'}},
+                         {'procedure-name': {'value': 'test-env'},
+                          'procedure-call': {
+                              'value': 'echo {{location}} {{type}} {{pwd}} '
+                                       '> loc.txt'}},
+                         {'procedure-name': {'value': 'not-there'}}]}],
+        opj(ds.path, 'acq1', 'studyspec.json'))
+    ds.save(message="add spec")
+
+    environ = dict(os.environ)
+    with patch.object(ConfigManager, 'reload',
+                      autospec=True, side_effect=ConfigManager.reload) \
+            as reload:
+        res = ds.hirni_spec2bids(['acq1'], on_failure='ignore')
+    # no forced reloads; looking up a procedure may reload (once per name)
+    # but running it doesn't:
+    assert_not_in(True, [c[1].get('force') for c in reload.call_args_list])
+    assert reload.call_count <= 2
+    assert_equal(dict(os.environ), environ)
+    assert_result_count(res, 2, action='test-env', status='ok')
+    assert_result_count(res, 1, action='not-there', status='impossible')
+    with open(opj(ds.path, 'env.txt')) as f:
+        assert_equal(f.read(), "{0}'s acq1/studyspec.json\n")
+    with open(opj(ds.path, 'loc.txt')) as f:
+        assert_equal(f.read(), "acq1/events.tsv events_file {}\n".format(
+            ds.path))
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_incremental(path):
+    from datalad_hirni.support.conversion_manifest import get_manifest
+
+    ds = _make_bids_ds(opj(path, 'bids'), {
+        'acq1': ('01', ['dicomseries:all', 'dicomseries']),
+        'acq2': ('02', ['dicomseries:all']),
+    })
+    spec_file = opj(ds.path, 'acq1', 'studyspec.json')
+    # conversions are recorded, even if not incremental:
+    res = ds.hirni_spec2bids(['acq1', 'acq2'], jobs=2)
+    assert_result_count(res, 3, action='test-converter', status='ok')
+    manifest = get_manifest(ds)
+    assert_equal(len(manifest), 3)
+    assert_equal(sorted(e['spec'] for e in manifest.values()),
+                 [opj('acq1', 'studyspec.json')] * 2 +
+                 [opj('acq2', 'studyspec.json')])
+
+    n_commits = len(ds.repo.get_revisions())
+    res = ds.hirni_spec2bids(['acq1', 'acq2'], incremental=True)
+    assert_result_count(res, 3, action='test-converter', status='notneeded')
+    assert_equal(len(ds.repo.get_revisions()), n_commits)
+
+    def _change_snippet(idx, description):
+        snippets = list(json_py.load_stream(spec_file))
+        snippets[idx]['description'] = {'value': description,
+                                        'approved': True}
+        os.unlink(spec_file)
+        json_py.dump2stream(snippets, spec_file)
+        ds.save(message="change snippet")
+
+    # only the changed snippet is converted again:
+    _change_snippet(1, 'T1w')
+    res = ds.hirni_spec2bids(['acq1', 'acq2'], incremental=True, jobs=2)
+    assert_result_count(res, 1, action='test-converter', status='ok')
+    assert_result_count(res, 2, action='test-converter', status='notneeded')
+    with open(opj(ds.path, 'order-01.log')) as f:
+        assert_equal(f.read().splitlines(),
+                     ['dicomseries:all', 'dicomseries', 'dicomseries'])
+    # what depends on a changed snippet is converted again, too:
+    _change_snippet(0, 'all')
+    res = ds.hirni_spec2bids(['acq1'], incremental=True)
+    assert_result_count(res, 2, action='test-converter', status='ok')
+    # conversions, that are no longer part of the history, don't count:
+    ds.repo.call_git(['reset', '--hard', 'HEAD~2'])
+    res = ds.hirni_spec2bids(['acq1'], incremental=True)
+    assert_result_count(res, 2, action='test-converter', status='ok')
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_dedup(path):
+
+    ds = Dataset(opj(path, 'bids')).create(no_annex=True)
+    os.makedirs(opj(ds.path, '.datalad', 'procedures'))
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-log.sh'),
+              'w') as f:
+        f.write('echo "$2 $DATALAD_RUN_SUBSTITUTIONS_ID" >> "$1/log.txt"\n')
+    for acq in ('acq1', 'acq2'):
+        os.makedirs(opj(ds.path, acq))
+        json_py.dump2stream(
+            [{'type': 'dicomseries',
+              'location': 'dicoms',
+              'id': {'value': i, 'approved': False},
+              'procedures': [
+                  # the same for all snippets and acquisitions:
+                  {'procedure-name': {'value': 'test-log'},
+                   'procedure-call': {
+                       'value': 'bash {script} {ds} {{type}}'}},
+                  # differs by acquisition:
+                  {'procedure-name': {'value': 'test-log'},
+                   'procedure-call': {
+                       'value': 'bash {script} {ds} {{specpath}}'}},
+                  # relies on the environment only:
+                  {'procedure-name': {'value': 'test-log'}}]}
+             for i in (1, 2)],
+            opj(ds.path, acq, 'studyspec.json'))
+    ds.save(message="add specs")
+
+    res = ds.hirni_spec2bids(['acq1', 'acq2'])
+    assert_result_count(res, 12, action='test-log')
+    assert_result_count(res, 7, action='test-log', status='ok')
+    assert_result_count(res, 5, action='test-log', status='notneeded')
+    with open(opj(ds.path, 'log.txt')) as f:
+        assert_equal(f.read().splitlines(), [
+            'dicomseries 1',
+            'acq1/studyspec.json 1',
+            ' 1',
+            ' 2',
+            'acq2/studyspec.json 1',
+            ' 1',
+            ' 2',
+        ])
+
+
+@with_tempfile(mkdir=True)
+def test_spec2bids_anonymize_records(path):
+    from unittest.mock import patch
+    from datalad.core.local.run import format_command
+
+    ds = Dataset(opj(path, 'bids')).create(no_annex=True)
+    os.makedirs(opj(ds.path, '.datalad', 'procedures'))
+    # records its own conversion with datalad-run:
+    with open(opj(ds.path, '.datalad', 'procedures', 'test-record.sh'),
+              'w') as f:
+        f.write('cd "$1"\n'
+                'datalad run -m "record $2" '
+                '"echo {bids-subject} {location} >> subjects.txt"\n')
+    # acquisitions tend to be named after the subject:
+    os.makedirs(opj(ds.path, 'SECRET'))
+    json_py.dump2stream(
+        [{'type': 'dicomseries:all',
+          'location': 'dicoms',
+          'subject': {'value': 'SECRET', 'approved': False},
+          'anon-subject': {'value': '001', 'approved': False},
+          'procedures': [{
+              'procedure-name': {'value': 'test-record'},
+              'procedure-call': {
+                  'value': 'bash {script} {ds} {{bids-subject}}'}}]}],
+        opj(ds.path, 'SECRET', 'studyspec.json'))
+    ds.save(message="add spec")
+
+    with patch('datalad_hirni.commands.spec2bids.format_command',
+               wraps=format_command) as fmt:
+        res = ds.hirni_spec2bids(['SECRET'], anonymize=True)
+    assert_result_count(res, 1, action='test-record', status='ok')
+    # the procedure's command comes with placeholders only:
+    cmd = fmt.call_args[0][1]
+    assert_in('{bids-subject}', cmd)
+    assert_not_in('001', cmd)
+    assert_not_in('SECRET', cmd)
+    with open(opj(ds.path, 'subjects.txt')) as f:
+        assert_equal(f.read(), "001 SECRET/dicoms\n")
+    # and so do the records of its datalad-run calls:
+    log = ds.repo.call_git(['log', '--format=%B', '-1'])
+    assert_in('"cmd": "echo {bids-subject} {location} >> subjects.txt"',
+              log)
+    assert_in('record 001', log)
@@ -0,0 +1,61 @@
+# emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# -*- coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test spec4anything command; specification snippets for arbitrary paths"""
+
+import os.path as op
+from os import makedirs
+
+from datalad.api import Dataset
+from datalad.support.json_py import load_stream
+from datalad.tests.utils import (
+    assert_equal,
+    assert_result_count,
+    ok_clean_git,
+    with_tempfile
+)
+
+from datalad_hirni.support.spec_helpers import get_specval
+
+
+@with_tempfile
+def test_spec4anything_batch(path):
+
+    ds = Dataset(path).create(no_annex=True)
+    for acq in ('acq1', 'acq2'):
+        makedirs(op.join(path, acq))
+        for i in range(3):
+            with open(op.join(path, acq, 'f{}.txt'.format(i)), 'w') as f:
+                f.write(str(i))
+    ds.save()
+    n_commits = len(ds.repo.get_revisions())
+
+    res = ds.hirni_spec4anything(
+        [op.join('acq1', 'f{}.txt'.format(i)) for i in range(3)] +
+        [op.join('acq2', 'f0.txt')],
+        properties={"subject": "01"})
+    assert_result_count(res, 4, action='hirni spec4anything', status='ok')
+    # all snippets go into a single commit:
+    assert_equal(len(ds.repo.get_revisions()), n_commits + 1)
+    ok_clean_git(ds.path)
+
+    spec = list(load_stream(op.join(path, 'acq1', 'studyspec.json')))
+    assert_equal([s['location'] for s in spec],
+                 ['f0.txt', 'f1.txt', 'f2.txt'])
+    assert all(get_specval(s, 'subject') == '01' for s in spec)
+    assert_equal(
+        len(list(load_stream(op.join(path, 'acq2', 'studyspec.json')))), 1)
+
+    # replace existing snippet; unique values of the spec still apply:
+    ds.hirni_spec4anything(op.join('acq1', 'f1.txt'), replace=True,
+                           properties={"comment": "new"})
+    spec = list(load_stream(op.join(path, 'acq1', 'studyspec.json')))
+    assert_equal(len(spec), 3)
+    assert_equal([get_specval(s, 'comment') for s in spec], ['', 'new', ''])
+    assert all(get_specval(s, 'subject') == '01' for s in spec)
@@ -0,0 +1,85 @@
+# emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# -*- coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test helpers for handling study specifications"""
+
+import os.path as op
+
+from datalad.support.json_py import (
+    dump2stream,
+    load_stream
+)
+from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+    with_tempfile
+)
+
+from datalad_hirni.support.spec_helpers import SpecContainer
+
+
+def _series(uid, id_=None, location='dicoms'):
+    return {'type': 'dicomseries',
+            'location': location,
+            'uid': uid,
+            'id': {'value': id_, 'approved': False}}
+
+
+def test_spec_container_lookup():
+
+    spec = SpecContainer([{'type': 'dicomseries:all', 'location': 'dicoms'},
+                          _series('1.2.3', id_=1),
+                          _series('1.2.4', id_=2),
+                          {'type': 'generic_file', 'location': 'events.tsv',
+                           'id': {'value': 2, 'approved': False}}])
+
+    assert_equal(len(spec), 4)
+    assert_equal(len(spec.get_by_type('dicomseries')), 2)
+    assert_equal(len(spec.get_by_type('dicomseries:all')), 1)
+    assert_equal(spec.get_by_type('nothing'), [])
+    assert spec.get_by_uid('1.2.4')[0] is spec[2]
+    assert_equal(spec.get_by_uid('1.2.4', type_='generic_file'), [])
+    assert spec.get_by_location('generic_file', 'events.tsv', 2)[0] is spec[3]
+    assert_equal(spec.get_by_location('generic_file', 'events.tsv', 1), [])
+
+    # update reindexes, but keeps position:
+    spec.update(spec[1], {'uid': '1.2.5', 'id': {'value': 5,
+                                                'approved': True}})
+    assert_equal(spec.get_by_uid('1.2.3'), [])
+    assert spec.get_by_uid('1.2.5')[0] is spec[1]
+    assert spec.get_by_location('dicomseries', 'dicoms', 5)[0] is spec[1]
+    assert_equal([s['uid'] for s in spec.get_by_type('dicomseries')],
+                 ['1.2.5', '1.2.4'])
+
+    # identical, but distinct snippets are different entries:
+    spec.append(_series('1.2.4', id_=2))
+    assert_equal(len(spec.get_by_uid('1.2.4')), 2)
+    spec.update(spec[4], {'location': 'other'})
+    assert spec.get_by_uid('1.2.4')[0] is spec[2]
+    assert spec.get_by_location('dicomseries', 'other', 2)[0] is spec[4]
+
+    # unhashable id values are fine:
+    spec.append(_series('1.2.6', id_=[1, 2]))
+    assert spec.get_by_location('dicomseries', 'dicoms', [1, 2])[0] is spec[5]
+
+    assert_raises(ValueError, spec.update, _series('1.2.4', id_=2), {})
+
+
+@with_tempfile
+def test_spec_container_roundtrip(path):
+
+    spec = SpecContainer.from_file(path)
+    assert_equal(len(spec), 0)
+    for uid in ['3', '1', '2']:
+        spec.append(_series(uid))
+    dump2stream(spec, path)
+    assert op.exists(path)
+    assert_equal([s['uid'] for s in load_stream(path)], ['3', '1', '2'])
+    assert_equal([s['uid'] for s in SpecContainer.from_file(path)],
+                 ['3', '1', '2'])
@@ -0,0 +1,52 @@
+"""Test dependency graph of tasks"""
+
+from datalad.tests.utils import (
+    assert_equal,
+    assert_raises,
+)
+
+from datalad_hirni.support.task_graph import TaskGraph
+
+
+def test_task_graph():
+
+    graph = TaskGraph()
+    graph.add('all', 'convert all')
+    graph.add('s1', 'convert series 1', after=['all'])
+    graph.add('s2', 'convert series 2', after=['all'])
+    graph.add('events', 'copy events')
+    graph.add('deface', 'deface', after=['s1'])
+    assert_equal(len(graph), 5)
+    assert_equal(graph['s1'], 'convert series 1')
+    assert_raises(ValueError, graph.add, 's1', 'again')
+    assert_raises(ValueError, graph.add, 'early', 'unknown', after=['late'])
+
+    # everything independent of anything is ready right away:
+    assert_equal(graph.ready(), ['all', 'events'])
+    graph.start('all')
+    assert_equal(graph.ready(), ['events'])
+    assert_equal(graph.finish('all', True), [])
+    assert_equal(graph.ready(), ['s1', 's2', 'events'])
+    # a failure blocks dependents, directly or not:
+    assert_equal(graph.finish('s1', False), ['deface'])
+    assert_equal(graph.ready(), ['s2', 'events'])
+    assert_equal(dict(graph.blocked()), {'deface': 's1'})
+
+
+def test_task_graph_run():
+
+    graph = TaskGraph()
+    graph.add(1, 'ok')
+    graph.add(2, 'error', after=[1])
+    graph.add(3, 'ok', after=[2])
+    graph.add(4, 'ok', after=[1])
+    ran = []
+
+    def _run(key):
+        ran.append(key)
+        yield dict(status=graph[key])
+
+    res = list(graph.run(_run))
+    assert_equal(ran, [1, 2, 4])
+    assert_equal([r['status'] for r in res], ['ok', 'error', 'ok'])
+    assert_equal(list(graph.blocked()), [3])